@@ -0,0 +1,51 @@
+'''Benchmark the argument formatters over a parameter grid.
+
+Usage:
+    python benchmarks/bench_args.py [n_repeats]
+
+This compares formatting each job's command line one at a time (with and
+without the value cache) against ``Argument.format_batch``.
+'''
+import sys
+import time
+import slurmjobs
+
+
+def make_grid():
+    return slurmjobs.Grid([
+        ('lr', [1e-4, 3e-4, 1e-3, 3e-3]),
+        ('batch_size', [16, 32, 64, 128]),
+        ('model', ['resnet18', 'resnet50', 'vit-b/16']),
+        ('augment', [True, False]),
+        ('dataset', ['imagenet', 'places 365']),
+        ('seed', list(range(10))),
+    ])
+
+
+def bench(func, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(repeats=5):
+    items = list(make_grid())
+    shared = dict(epochs=500, data_dir='/scratch/me/data')
+    print(f'{len(items)} grid items, best of {repeats}\n')
+    print(f'{"cli":10s} {"uncached":>10s} {"cached":>10s} {"batch":>10s}')
+    for name in ['fire', 'argparse', 'sacred', 'hydra']:
+        uncached = slurmjobs.args.Argument.get(name)
+        uncached.cache_size = 0
+        cached = slurmjobs.args.Argument.get(name)
+        t_uncached = bench(lambda: [uncached(d, indent=4, **shared) for d in items], repeats)
+        t_cached = bench(lambda: [cached(d, indent=4, **shared) for d in items], repeats)
+        t_batch = bench(lambda: cached.format_batch(items, indent=4, **shared), repeats)
+        assert cached.format_batch(items, indent=4, **shared) == [uncached(d, indent=4, **shared) for d in items]
+        print(f'{name:10s} {t_uncached*1e3:8.2f}ms {t_cached*1e3:8.2f}ms {t_batch*1e3:8.2f}ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,45 @@
+'''Benchmark how long it takes to import parts of slurmjobs in a fresh interpreter.
+
+Usage:
+    python benchmarks/bench_import.py [n_repeats]
+
+Job-side modules (receipts, runtime helpers) should not pay for loading Jinja.
+'''
+import os
+import sys
+import subprocess
+
+
+IMPORTS = [
+    'import slurmjobs',
+    'import slurmjobs.runtime',
+    'import slurmjobs.receipt',
+    'import slurmjobs.core',
+    'import slurmjobs; slurmjobs.core.get_env()',
+]
+
+
+def import_time(code):
+    '''The import time in seconds, measured using ``python -X importtime``.'''
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], 
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        capture_output=True, text=True, check=True).stderr
+    # sum the cumulative time of the top-level imports
+    total = 0
+    for line in out.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return total / 1e6
+
+
+def main(repeats=5):
+    print(f'best of {repeats}\n')
+    for code in IMPORTS:
+        best = min(import_time(code) for _ in range(repeats))
+        print(f'{code:50s} {best*1e3:8.2f}ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,41 @@
+'''Benchmark generating job scripts with and without split rendering.
+
+Usage:
+    python benchmarks/bench_render.py [n_jobs]
+
+Split rendering renders the batch-invariant parts of the template once and
+only renders the job-specific blocks for each job (see ``slurmjobs.render``).
+'''
+import sys
+import time
+import tempfile
+import slurmjobs
+
+
+def main(n=1000):
+    grid = [('a', list(range(n)))]
+    kws = {
+        'Slurm': dict(modules=['cuda11'], conda_env='myenv', email='me@nyu.edu', sbatch={'n_gpus': 2}),
+        'Singularity': dict(overlay='overlay.ext3', sif='cuda.sif', n_gpus=1),
+    }
+    print(f'{n} jobs\n')
+    print(f'{"class":12s} {"full":>10s} {"split":>10s}')
+    for name, kw in kws.items():
+        times = []
+        for split in [False, True]:
+            with tempfile.TemporaryDirectory() as d:
+                jobs = getattr(slurmjobs, name)('python train.py', root_dir=d, backup=False, split_render=split, **kw)
+                # only time rendering
+                render = jobs.get_renderer() or slurmjobs.core.get_template(jobs.template).render
+                variables = dict(jobs.options, command=jobs.command, cli=jobs.cli, grid=grid, params_args=None)
+                items = list(slurmjobs.Grid(grid))
+                t0 = time.perf_counter()
+                for d in items:
+                    job_id = jobs.format_job_id(d)
+                    render(job_id=job_id, args=d, paths=jobs.paths.specify(job_id=job_id), **variables)
+                times.append(time.perf_counter() - t0)
+        print(f'{name:12s} {times[0]*1e3:8.2f}ms {times[1]*1e3:8.2f}ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,5 +1,6 @@
 import glob
 import setuptools
+from setuptools.command.build_py import build_py
 
 import os, imp
 version = imp.load_source(
@@ -7,6 +8,26 @@ version = imp.load_source(
     os.path.join(os.path.dirname(__file__), 'slurmjobs/__version__.py')).__version__
 
 
+class build_py_with_templates(build_py):
+    '''Precompile the built-in job templates into Python modules (see slurmjobs/precompile.py).'''
+    def run(self):
+        super().run()
+        import sys
+        sys.path.insert(0, self.build_lib)
+        try:
+            # this needs jinja2 and the package's dependencies (e.g. pathtrees) to import slurmjobs.core
+            from slurmjobs import precompile
+            target = os.path.join(self.build_lib, 'slurmjobs', '_compiled_templates')
+            precompile.compile_templates(
+                compiled_dir=target, 
+                template_dir=os.path.join(self.build_lib, 'slurmjobs', 'templates'))
+            print('precompiled templates to', target)
+        except ImportError as e:
+            self.warn(f'Skipping template precompilation ({e}). The templates will be loaded from source.')
+        finally:
+            sys.path.remove(self.build_lib)
+
+
 setuptools.setup(name='slurmjobs',
                  version=version,
                  description='Generate slurm jobs in batches.',
@@ -18,6 +39,7 @@ setuptools.setup(name='slurmjobs',
                  package_data={'slurmjobs': ['templates/*.j2']},
                  scripts=glob.glob('scripts/**/*.sh'),
                  packages=setuptools.find_packages(),
+                 cmdclass={'build_py': build_py_with_templates},
                  install_requires=['pathtrees', 'Jinja2'],
                  license=open('README.md').readline().strip(),
                  extras_require={
@@ -1,12 +1,58 @@
+'''Submodules are imported the first time one of their attributes is used, so that
+e.g. a job that only uses ``slurmjobs.receipt`` or ``slurmjobs.runtime`` doesn't
+have to load Jinja and the job templates.
+'''
 from .__version__ import __version__
-from . import args
-from .grid import *
-from .core import *
-from . import util
-from .receipt import *
 
+TYPE_CHECKING = False  # avoid importing typing
 
-# cute little alias
-Sing = Singularity
+_SUBMODULES = {'args', 'core', 'grid', 'params', 'receipt', 'runtime', 'util'}
 
-get_cli = args.Argument.get
\ No newline at end of file
+# {name: (submodule, attribute)}
+_ATTRIBUTES = {
+    # grid
+    **{k: ('grid', k) for k in [
+        'BaseGrid', 'Grid', 'LiteralGrid', 'GridItem', 'GridItemBundle', 'GridChain',
+        'GridCombo', 'GridOmission', 'GridFilter', 'prod', 'unique', 'peek']},
+    # core
+    **{k: ('core', k) for k in ['Jobs', 'Shell', 'Slurm', 'SBatch', 'Singularity', 'write_pipeline', 'env', 'loader']},
+    # receipt
+    **{k: ('receipt', k) for k in [
+        'Receipt', 'use_receipt', 'ReceiptStore', 'FileReceiptStore', 'SQLiteReceiptStore',
+        'STORES', 'get_store', 'migrate_receipts', 'StructuralHasher', 'Lease', 'ResultCache',
+        'Step', 'run_steps', 'receipt_stats', 'ReceiptCLI']},
+    'Argument': ('args', 'Argument'),
+    # cute little alias
+    'Sing': ('core', 'Singularity'),
+    'get_cli': ('args', 'Argument.get'),
+}
+
+__all__ = ['__version__', *sorted(_SUBMODULES), *_ATTRIBUTES]
+
+
+def __getattr__(name):
+    import importlib
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if name in _ATTRIBUTES:
+        module, attr = _ATTRIBUTES[name]
+        value = importlib.import_module(f'.{module}', __name__)
+        for a in attr.split('.'):
+            value = getattr(value, a)
+        globals()[name] = value  # only look it up once
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+if TYPE_CHECKING:
+    from . import args, core, grid, params, receipt, runtime, util
+    from .grid import *
+    from .core import Jobs, Shell, Slurm, SBatch, Singularity, write_pipeline, env, loader
+    from .receipt import *
+    from .args import Argument
+    Sing = Singularity
+    get_cli = Argument.get
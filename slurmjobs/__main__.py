@@ -5,16 +5,23 @@ $ # this will generate slurm sbatch files
 $ python -m slurmjobs slurm --cmd='python train.py' generate "{kernel_size: [2,3,5], lr: [1e-4, 1e-3]}"
 $ # this will generate shell files that run commands in the background using nohup
 $ python -m slurmjobs sh --cmd='python train.py' generate "{kernel_size: [2,3,5], lr: [1e-4, 1e-3]}"
+$ # this will import a directory of receipt files into the receipt database
+$ python -m slurmjobs receipts --root=./receipts migrate
+$ # this will wait for a submitted batch to finish, printing its jobs' state changes
+$ python -m slurmjobs watch jobs/train
 
 NOTE: Python Fire requires that class __init__ args use keyword notation (--cmd=MY_CMD)
 
 Fire User Guide: https://github.com/google/python-fire/blob/master/docs/guide.md
 '''
-from slurmjobs import *
+from slurmjobs import Shell, Slurm, ReceiptCLI
+from slurmjobs.status import watch_batch
 
 if __name__ == '__main__':
     import fire
     fire.Fire({
         'sh': Shell,
         'slurm': Slurm,
+        'receipts': ReceiptCLI,
+        'watch': watch_batch,
     })
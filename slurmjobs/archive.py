@@ -0,0 +1,93 @@
+'''Job archives
+
+For very large batches, writing one script file per job can run into inode quotas
+(and makes the batch directory slow to list). Instead, all of the job scripts can be
+written into a single archive file with an offset index (like params tables, see
+``slurmjobs.runtime.ParamTable``).
+
+.. code-block:: python
+
+    jobs = slurmjobs.Slurm('python train.py', archive=True)
+    run_script, job_ids = jobs.generate(...)
+
+The run script pipes each job's script to ``sbatch`` on stdin:
+
+.. code-block:: bash
+
+    tail -c +1 "jobs/train/jobs.archive" | head -c 1234 | sbatch
+
+To look at a job's script:
+
+.. code-block:: python
+
+    print(slurmjobs.archive.read_job('jobs/train/jobs.archive', 'train,lr-0.001'))
+'''
+import contextlib
+from .writer import JobWriter
+from .runtime import index_path, pack_index, ParamTable
+
+
+def ids_path(path):
+    '''The path of the job ID list for an archive.'''
+    return f'{path}.ids'
+
+
+class JobArchive:
+    '''Write job scripts into a single offset-indexed file.
+
+    Arguments:
+        path (str): The archive path.
+        writer (JobWriter): The batch's writer. The archive is written to a temporary
+            file and renamed into place when it's closed.
+    '''
+    def __init__(self, path, writer=None):
+        self.path = str(path)
+        self.writer = writer or JobWriter()
+        self._stack = contextlib.ExitStack()
+        self.file = self._stack.enter_context(self.writer.open(self.path, 'wb'))
+        self.offsets = [0]
+        self.job_ids = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def add(self, job_id, script) -> int:
+        '''Add a job script. Returns its index in the archive.'''
+        self.offsets.append(self.offsets[-1] + self.file.write(script.encode()))
+        self.job_ids.append(job_id)
+        return len(self.job_ids) - 1
+
+    @property
+    def entries(self) -> list:
+        '''Each job's ``job_id``, ``start`` byte offset, and ``length``.'''
+        return [
+            {'job_id': job_id, 'start': start, 'length': end - start}
+            for job_id, start, end in zip(self.job_ids, self.offsets, self.offsets[1:])]
+
+    def close(self):
+        if not self.file.closed:
+            self._stack.close()
+            self.writer.write(index_path(self.path), pack_index(self.offsets))
+            self.writer.write(ids_path(self.path), ''.join(f'{job_id}\n' for job_id in self.job_ids))
+
+
+def job_ids(path) -> list:
+    '''Get the job IDs in an archive.'''
+    with open(ids_path(path), 'r') as f:
+        return f.read().splitlines()
+
+
+def read_job(path, job) -> str:
+    '''Read a job's script from an archive.
+
+    Arguments:
+        path (str): The archive path.
+        job (int, str): The job's index or job ID.
+    '''
+    if isinstance(job, str):
+        job = job_ids(path).index(job)
+    with ParamTable(path) as table:
+        return table.get_bytes(job).decode()
@@ -1,5 +1,7 @@
 '''Argument Formatters
 '''
+import shlex
+import collections
 from . import util
 from . import grid
 
@@ -13,9 +15,58 @@ class Argument:
      * ``format_value`` (which is called in ``format_arg``) to format python values as a string.
        This is often some form of quoted repr or json formatting.
 
-    
+    Formatted values are memoized (see ``cache_size``) because the same values tend to 
+    repeat across every job in a sweep. Only simple hashable values are cached (strings, 
+    numbers, bools, None, and tuples/frozensets of them) and the cache is keyed by type, 
+    so ``1``, ``1.0``, and ``True`` are all formatted separately.
     '''
     prefix = suffix = ''
+    # the max number of formatted values to remember. Set to 0 to disable caching.
+    cache_size = 4096
+    # maps names to formatter classes (or "module:Class" import strings)
+    _registry: dict = {}
+
+    def __init_subclass__(cls, name=None, aliases=(), **kw):
+        '''Register subclasses by name. By default, the name is the lowercase class name
+        without the ``Argument`` suffix (e.g. ``FireArgument`` => ``'fire'``). Classes starting 
+        with an underscore are not registered unless they're given an explicit name.
+
+        .. code-block:: python
+
+            class MyArgument(FireArgument, name='mine', aliases=('my',)):
+                kw_fmt = '--{key} {value}'
+
+            assert isinstance(Argument.get('my'), MyArgument)
+        '''
+        super().__init_subclass__(**kw)
+        if name is None:
+            if cls.__name__.startswith('_'):
+                return
+            name = util.stripstr(cls.__name__.lower(), suffix='argument')
+        Argument.register(name, *aliases, formatter=cls)
+
+    @classmethod
+    def register(cls, name, *aliases, formatter=None):
+        '''Register an argument formatter under a name (and any aliases).
+
+        The formatter can be a class or an import string (``'mypkg.cli:MyArgument'``) which
+        will only be imported the first time it's looked up. If no formatter is given, 
+        this returns a class decorator.
+
+        .. code-block:: python
+
+            # register lazily, without importing the plugin
+            Argument.register('mine', 'my', formatter='mypkg.cli:MyArgument')
+
+            # or as a decorator
+            @Argument.register('mine', 'my')
+            class MyArgument(FireArgument): ...
+        '''
+        if formatter is None:
+            return lambda formatter: cls.register(name, *aliases, formatter=formatter)
+        for n in (name,) + aliases:
+            Argument._registry[n.lower()] = formatter
+        return formatter
 
     @classmethod
     def get(cls, key='fire', *a, **kw) -> 'Argument':
@@ -24,7 +75,13 @@ class Argument:
             return key
         if isinstance(key, type) and issubclass(key, cls):
             return key(*a, **kw)
-        return util.subclass_lookup(cls, suffix='argument')[key.lower()](*a, **kw)
+        name = key.lower()
+        formatter = Argument._registry.get(name)
+        if isinstance(formatter, str):
+            formatter = Argument._registry[name] = util.import_string(formatter)
+        if formatter is None or not issubclass(formatter, cls):
+            raise KeyError(f"Unknown argument formatter {key!r}. Available: {sorted(Argument._registry)}")
+        return formatter(*a, **kw)
 
     def _format_args(self, *a, **kw):
         '''This prepares all arguments and returns them as positional and keyword arguments.
@@ -37,6 +94,18 @@ class Argument:
         kw = {k: self.format_arg(k, v) for k, v in kw.items()}
         return a, kw
 
+    def _join_args(self, a, kw, indent=None):
+        '''Join formatted positional and keyword arguments into a single string.'''
+        items = (
+            [self.prefix]*bool(self.prefix) + 
+            a + [x for xs in kw.values() if xs for x in xs] + 
+            [self.suffix]*bool(self.suffix))
+
+        indent = '\\\n' + ' '*indent if indent is not None else ''
+        return ' '.join((
+            f'{indent}{" ".join(x) if isinstance(x, list) else x}' 
+            for x in items))
+
     def __call__(self, *a, indent=None, **kw):
         '''Format arguments as a string.
         
@@ -52,15 +121,47 @@ class Argument:
                 to a bash command.
         '''
         a2, kw2 = self._format_args(*a, **kw)
-        items = (
-            [self.prefix]*bool(self.prefix) + 
-            a2 + [x for xs in kw2.values() if xs for x in xs] + 
-            [self.suffix]*bool(self.suffix))
+        return self._join_args(a2, kw2, indent)
 
-        indent = '\\\n' + ' '*indent if indent is not None else ''
-        return ' '.join((
-            f'{indent}{" ".join(x) if isinstance(x, list) else x}' 
-            for x in items))
+    def argv(self, *a, **kw):
+        '''Format arguments as a list of (unquoted) command-line tokens, like ``sys.argv[1:]``.
+        Takes the same arguments as ``__call__``.
+        '''
+        return shlex.split(self(*a, **kw))
+
+    def format_batch(self, items, *a, indent=None, **kw):
+        '''Format the command-line arguments for many items (e.g. a whole grid) at once.
+
+        Each item's keys are keyword arguments and a grid item's ``positional`` values 
+        are positional arguments, so this gives the same strings as::
+
+            [self(*getattr(item, 'positional', ()), *a, indent=indent, **{**item, **kw}) for item in items]
+
+        except that the arguments shared by all items (``*a`` and ``**kw``) are only 
+        formatted once. Note that a plain dict is formatted as keyword arguments here,
+        while ``self(item)`` would format it as a single (json) value.
+
+        Arguments:
+            items (iterable): The argument dicts (or grid items, e.g. a ``Grid``) to format.
+            *a: Positional arguments added after each item's positional arguments.
+            indent (int): The indentation. See ``__call__``.
+            **kw: Keyword arguments shared by all items.
+
+        Returns:
+            list[str]: One formatted argument string per item, in order (the strings 
+                that ``__call__`` would return), not the items themselves.
+        '''
+        shared_a = [self.format_arg(v) for v in a]
+        shared_kw = {k: self.format_arg(k, v) for k, v in kw.items()}
+        out = []
+        for item in items:
+            a2 = [self.format_arg(v) for v in getattr(item, 'positional', ())] + shared_a
+            kw2 = {
+                k: shared_kw[k] if k in shared_kw else self.format_arg(k, v)
+                for k, v in item.items()}
+            kw2.update((k, v) for k, v in shared_kw.items() if k not in kw2)
+            out.append(self._join_args(a2, kw2, indent))
+        return out
 
     def format_arg(self, k, v=...):
         '''Format a key-value pair for the command-line.
@@ -72,12 +173,33 @@ class Argument:
             k: The key (or value, for positional arguments).
             v: The value. If it's a positional argument, it will be ``v=...``
         '''
-        return [self.format_value(k) if v is ... else self.format_value(v)]
+        return [self.format_value_cached(k) if v is ... else self.format_value_cached(v)]
 
     def format_value(self, v):
         '''Format a value for the command-line.'''
         return util.shlex_repr(v)
 
+    def format_value_cached(self, v):
+        '''Format a value for the command-line, reusing the result if we've 
+        already formatted this value. Unhashable values are formatted every time.'''
+        if not self.cache_size:
+            return self.format_value(v)
+        try:
+            key = util.typed_key(v)
+        except TypeError:
+            return self.format_value(v)
+
+        cache = self.__dict__.get('_value_cache')
+        if cache is None:
+            cache = self._value_cache = collections.OrderedDict()
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = cache[key] = self.format_value(v)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return value
+
 
 
 class FireArgument(Argument):
@@ -92,8 +214,8 @@ class FireArgument(Argument):
 
     def format_arg(self, k, v=...):
         if v is ...:
-            return [self.format_value(k)]
-        return [self.kw_fmt.format(key=k, value=self.format_value(v))]
+            return [self.format_value_cached(k)]
+        return [self.kw_fmt.format(key=k, value=self.format_value_cached(v))]
 
 
 
@@ -119,7 +241,7 @@ class ArgparseArgument(Argument):
         # this will all be joined to gether as strings. The extra
         # list on the outside means that it will appear on the same line
         # when indentation is requested
-        vs = [self.format_value(x) for x in v]
+        vs = [self.format_value_cached(x) for x in v]
         return [ [key] + vs ]
 
     def format_key(self, k):
@@ -160,9 +282,9 @@ class HydraArgument(FireArgument):
 
     def format_arg(self, k, v=...):
         if v is ...:
-            return [self.format_value(k)]
+            return [self.format_value_cached(k)]
         kw_fmt = (
             self.kw_fmt
             if any(k.startswith(pfx) for pfx in self.available_prefixes if pfx)
             else self.kw_fmt_prefixed)
-        return [kw_fmt.format(key=k, value=self.format_value(v))]
+        return [kw_fmt.format(key=k, value=self.format_value_cached(v))]
@@ -16,22 +16,63 @@ off the bat).
 
 '''
 import os
+import json
 import time
 import pprint
-import jinja2
+import logging
+import hashlib
+import functools
 import pathtrees
 from .grid import *
 from . import util
+from . import params as params_
 from .args import Argument
+from .render import BatchRenderer
+from .writer import JobWriter
 
-loader = jinja2.ChoiceLoader([
-    jinja2.PackageLoader('slurmjobs', 'templates')
-])
-env = jinja2.Environment(loader=loader)
-env.filters['prettyjson'] = util.prettyjson
-env.filters['prefixlines'] = util.prefixlines
-env.filters['pprint'] = pprint.pformat
-env.filters['comment'] = lambda x, ns=1, ch='#', nc=1: util.prefixlines(x, ch*nc+' '*ns)
+log = logging.getLogger(__name__)
+
+def create_env(compiled=True):
+    '''Create the Jinja environment used to render the job templates.
+
+    Arguments:
+        compiled (bool): Load the built-in templates from their precompiled modules, if they're 
+            up to date. See :mod:`slurmjobs.precompile`.
+    '''
+    import jinja2
+    from . import precompile
+    loader = jinja2.ChoiceLoader(
+        precompile.get_loaders() if compiled else 
+        [jinja2.PackageLoader('slurmjobs', 'templates')])
+    env = jinja2.Environment(loader=loader)
+    env.filters['prettyjson'] = util.prettyjson
+    env.filters['prefixlines'] = util.prefixlines
+    env.filters['pprint'] = pprint.pformat
+    env.filters['comment'] = lambda x, ns=1, ch='#', nc=1: util.prefixlines(x, ch*nc+' '*ns)
+    return env
+
+
+@functools.lru_cache(None)
+def get_env():
+    '''Get the Jinja environment used to render the job templates. This is 
+    created the first time it's needed so that importing slurmjobs doesn't load Jinja.'''
+    return create_env()
+
+
+@functools.lru_cache(64)
+def get_template(source):
+    '''Compile a template string (e.g. ``Jobs.template``). Templates are 
+    cached so that each one is only compiled once per process.'''
+    return get_env().from_string(source)
+
+
+def __getattr__(name):
+    # core.env and core.loader used to be created at import time
+    if name == 'env':
+        return get_env()
+    if name == 'loader':
+        return get_env().loader
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 class Jobs:
@@ -77,6 +118,31 @@ class Jobs:
         abbreviate_length (int): The length to abbreviate keys in the job ID.
         float_precision (int): The number of decimals to limit float values in the job ID.
 
+        params_file (bool, str): Write each job's arguments to a sidecar params file instead of
+            inlining them in the job script. Use ``True`` or ``'file'`` for one json file per job, 
+            or ``'table'`` for a single table with one row per job. Your script should call 
+            ``slurmjobs.runtime.expand_argv()`` before parsing its arguments. See ``slurmjobs.params``.
+        npy_threshold (int): If set, numpy arrays with at least this many elements are written to 
+            ``.npy`` files (``paths.array``) and only their path is passed to the job. Load them using 
+            ``slurmjobs.runtime.load_array``.
+        split_render (bool): Render the parts of the job template that are the same for every job
+            once per batch, and only render the job-specific blocks for each job. See ``slurmjobs.render``.
+        prelude (bool): Write the environment setup (modules, conda, singularity, etc.) once to 
+            ``paths.prelude`` (``common.sh``) and have each job script source it and only run its command.
+            This means you can patch the environment of a whole batch by editing one file.
+        archive (bool): Write all of the job scripts into a single offset-indexed file (``paths.archive``)
+            instead of one file per job. The run script pipes each job's script to ``sbatch``. 
+            In this mode, ``generate`` returns the job IDs instead of the job paths. See ``slurmjobs.archive``.
+        fanout (int): Spread the job scripts, logs, and params files across this many levels of
+            subdirectories based on a hash of the job ID (e.g. ``ab/cd/{job_id}.sbatch`` for ``fanout=2``).
+            This keeps directories small for very large batches. Use ``jobs.job_paths(job_id)`` to find a job's files.
+        fsync (bool): fsync the generated files once, after the whole batch has been written. Files are always
+            written to a temporary name and renamed into place. The time spent in each phase of generation
+            is stored in ``jobs.timings``.
+        keep_backups (int): The number of backups of the batch directory to keep. Older ones are removed.
+        max_backup_age (float): Remove backups of the batch directory older than this (in seconds).
+        cleanup (str): How to remove old batch directories: ``'thread'`` (in a background thread),
+            ``'process'`` (in a detached process), or False (wait for them to be removed).
 
 
     '''
@@ -108,10 +174,32 @@ class Jobs:
     abbreviate_length = None
     float_precision = None
 
+    params_file = None
+    npy_threshold = None
+    split_render = False
+    prelude = False
+    archive = False
+    fanout = 0
+    fanout_width = 2  # hex characters per directory level
+    # the command-line arguments are formatted this many jobs at a time, with this indentation
+    format_chunk_size = 1000
+    cli_indent = 4
+    # the paths that are spread across subdirectories when using fanout
+    fanout_keys = ('job', 'output', 'params')
+    fsync = False
+    # backups of the batch directory to keep (the most recent), and the max age of a backup in seconds
+    keep_backups = None
+    max_backup_age = None
+    # how to delete old batch directories: 'thread', 'process', or False (wait)
+    cleanup = 'thread'
+    # how the prelude's command block runs the job's command (passed to it as a single string)
+    prelude_command = 'eval "$1"'
+
     def __init__(self, command, name=None, cli=None, 
                  root_dir=None, backup=True, job_id=True, 
-                 template=None, run_template=None,
-                 **options):
+                 template=None, run_template=None, params_file=None, npy_threshold=None,
+                 split_render=None, prelude=None, archive=None, fanout=None, fsync=None, 
+                 keep_backups=None, max_backup_age=None, cleanup=None, **options):
         self.template = template or self.template
         self.run_template = run_template or self.run_template
 
@@ -134,17 +222,107 @@ class Jobs:
         self.name = name or util.command_to_name(command)
         self.cli = Argument.get(self.cli if cli is None else cli)
         self.job_id_arg = self.job_id_arg if job_id is True else job_id or None
+        self.params_file = self.params_file if params_file is None else params_file
+        self.npy_threshold = self.npy_threshold if npy_threshold is None else npy_threshold
+        self.split_render = self.split_render if split_render is None else split_render
+        self.prelude = self.prelude if prelude is None else prelude
+        self.archive = self.archive if archive is None else archive
+        self.fanout = self.fanout if fanout is None else fanout
+        self.fsync = self.fsync if fsync is None else fsync
+        self.keep_backups = self.keep_backups if keep_backups is None else keep_backups
+        self.max_backup_age = self.max_backup_age if max_backup_age is None else max_backup_age
+        self.cleanup = self.cleanup if cleanup is None else cleanup
+        self.timings = {}
+        self.job_ids = None  # set by generate()
 
         # paths
         self.root_dir = root_dir or self.root_dir
         self.paths = self.get_paths()
-        if 'batch_dir' in self.paths and len(self.paths.batch_dir.glob('*')):
-            if backup:
-                pathtrees.backup(self.paths.batch_dir)
+        self.backup = backup
+        self._prepared = False
+        self._generated_ids = None  # (time generated, job IDs), see generated_job_ids
+
+    def prepare(self):
+        '''Get the batch directory ready for generating jobs. If it already has files in it, 
+        it is backed up (or deleted if ``backup=False``) and old backups are pruned 
+        (see ``keep_backups`` and ``max_backup_age``). This only happens once, the first 
+        time that jobs are generated.'''
+        if self._prepared or 'batch_dir' not in self.paths:
+            return
+        batch_dir = str(self.paths.batch_dir)
+        if len(self.paths.batch_dir.glob('*')):
+            if self.backup:
+                util.backup(batch_dir)
             else:
-                import shutil
-                assert os.path.abspath(str(self.paths.batch_dir)) != '/', "Ummmmm..... what do you think you're doing... rm -rf / ???"
-                shutil.rmtree(str(self.paths.batch_dir))
+                assert os.path.abspath(batch_dir) != '/', "Ummmmm..... what do you think you're doing... rm -rf / ???"
+                util.remove_dirs([batch_dir], background=self.cleanup)
+        if self.keep_backups is not None or self.max_backup_age is not None:
+            removed = util.prune_backups(
+                batch_dir, keep=self.keep_backups, max_age=self.max_backup_age, background=self.cleanup)
+            if removed:
+                log.info('Removing %d old backups of %s', len(removed), batch_dir)
+        self._prepared = True
+
+    def fanout_dirs(self, job_id) -> dict:
+        '''Get the fanout subdirectories for a job (e.g. ``{'fanout_0': 'ab', 'fanout_1': 'cd'}``).
+        These come from the md5 of the job ID, so they can also be computed in bash with ``md5sum``.'''
+        if not self.fanout:
+            return {}
+        h = hashlib.md5(job_id.encode()).hexdigest()
+        w = self.fanout_width
+        return {f'fanout_{i}': h[i*w:(i+1)*w] for i in range(self.fanout)}
+
+    def fanout_tree(self, tree) -> dict:
+        '''Add the fanout subdirectories to the job paths in a path tree.'''
+        if not self.fanout:
+            return tree
+        subdir = '/'.join(f'{{fanout_{i}}}' for i in range(self.fanout))
+        return {
+            os.path.join(os.path.dirname(k), subdir, os.path.basename(k)) if v in self.fanout_keys else k: v
+            for k, v in tree.items()
+        }
+
+    def job_paths(self, job_id) -> pathtrees.Paths:
+        '''Get the paths for a job.'''
+        return self.paths.specify(job_id=job_id, **self.fanout_dirs(job_id))
+
+    def job_dependencies(self, job_id, args, index) -> list:
+        '''Get the jobs (in other batches) that a job needs to wait for. See ``Slurm.after``.'''
+        return []
+
+    def batch_settings(self) -> dict:
+        '''The settings that change where a batch's files are (stored in ``paths.settings`` when generating).'''
+        return {'fanout': self.fanout, 'fanout_width': self.fanout_width, 'archive': bool(self.archive)}
+
+    def generated_job_ids(self) -> list:
+        '''Get the IDs of the jobs that have been generated in the batch directory.
+        The listing is cached until the batch is generated again (``paths.time_generated`` changes).'''
+        generated = None
+        if 'time_generated' in self.paths.paths:
+            try:
+                with open(self.paths.time_generated.format(), 'r') as f:
+                    generated = f.read()
+            except FileNotFoundError:
+                pass
+        if generated is not None and self._generated_ids is not None and self._generated_ids[0] == generated:
+            return list(self._generated_ids[1])
+
+        if self.archive and os.path.isfile(self.paths.archive.format()):
+            from . import archive as archive_
+            ids = archive_.job_ids(self.paths.archive.format())
+        else:
+            ids = [self.paths.job.parse(p)['job_id'] for p in sorted(self.paths.job.glob())]
+        if generated is not None:
+            self._generated_ids = generated, ids
+        return list(ids)
+
+    def job_logs(self, job_id) -> list:
+        '''Find the log files for a job (there can be one per submission).'''
+        import glob
+        if 'output' not in self.paths.paths:
+            return []
+        pattern = self.job_paths(job_id).output.format()
+        return sorted(glob.glob(glob.escape(pattern).replace('%j', '*')))
 
     def format_id_key(self, k):
         '''Format a key in the job ID so it looks nicer. Override this to 
@@ -242,89 +420,267 @@ class Jobs:
 
                 str: The path to the run script.
 
-                list[str]: The list of paths for each job file.
+                list[str]: The list of paths for each job file (or the job IDs if ``archive`` is set).
         '''
         # generate jobs
         # kw = dict(kw, **(kwargs_ or {})) # for taken keys.
         grid = Grid.as_grid(grid_)
+        self.prepare()
+
+        job_paths, job_ids = [], []
+        writer = self.get_writer()
+        params = self.get_params_writer(writer=writer)
+        arrays = self.get_array_store(writer=writer)
+        if self.prelude:
+            self.generate_prelude(_grid=grid, _writer=writer)
+        render = self.get_renderer()
+        archive = self.get_archive(writer=writer)
+        dependencies = []
+        try:
+            for chunk in self._iter_job_chunks(grid, a, kw, ignore_job_id_keys):
+                for job_id, d in chunk:
+                    dependencies.append(self.job_dependencies(job_id, d, len(dependencies)))
+                # format the command lines for the whole chunk at once (unless they go in params files)
+                cli_args = [None] * len(chunk)
+                if params is None:
+                    with writer.timed('args'):
+                        cli_args = self.format_cli_args([self._prepare_args(job_id, d, arrays) for job_id, d in chunk])
+                for (job_id, d), cli_args_ in zip(chunk, cli_args):
+                    job_ids.append(job_id)
+                    job_paths.append(self.generate_job(
+                        job_id, _grid=grid, _args=d, _params=params, _arrays=arrays, 
+                        _render=render, _archive=archive, _writer=writer, _cli_args=cli_args_))
+        finally:
+            if params is not None:
+                params.close()
+            if archive is not None:
+                archive.close()
+
+        # generate run file
+        run_script = self.generate_run_script(
+            job_paths, _grid=grid, _writer=writer, archive=archive, job_ids=job_ids, dependencies=dependencies)
+
+        # store the current timestamp, and how to find the jobs (see status.watch_batch)
+        if 'time_generated' in self.paths.paths:
+            writer.write(self.paths.time_generated, str(time.time()))
+        if 'settings' in self.paths.paths:
+            writer.write(self.paths.settings, json.dumps(self.batch_settings()))
+
+        writer.close()
+        self.job_ids = job_ids
+        self.timings = dict(writer.timings)
+        log.debug('Generated %d jobs for %s: %s', len(job_paths), self.name, ', '.join(
+            f'{k}={v:.3f}s' for k, v in self.timings.items()))
+        return run_script, job_paths
+
+    def render(self, grid_=None, *a, ignore_job_id_keys=None, **kw):
+        '''Render the job scripts without writing anything to disk. This is useful 
+        for previewing/testing a sweep or for submitting the scripts some other way
+        (e.g. piping them to ``sbatch``).
+
+        .. code-block:: python
+
+            for job_id, script, args in jobs.render(grid):
+                print(script)
+
+        Since nothing is written, the arguments are always inlined in the job script
+        (``params_file``, ``npy_threshold``, ``prelude``, and ``archive`` are ignored).
 
+        Arguments:
+            grid_ (Grid, list): The parameter grid.
+            *a: Positional arguments to add to the command.
+            **kw: Additional keyword arguments to pass to the command.
+
+        Yields:
+            tuple: ``(job_id, script, args)`` for each job.
+        '''
+        grid = Grid.as_grid(grid_)
+        render = BatchRenderer(get_env(), self.template) if self.split_render else None
+        for chunk in self._iter_job_chunks(grid, a, kw, ignore_job_id_keys):
+            for job_id, d in chunk:
+                self._prepare_args(job_id, d)
+            for (job_id, d), cli_args in zip(chunk, self.format_cli_args([d for _, d in chunk])):
+                yield job_id, self.render_job(job_id, d, _grid=grid, _render=render, cli_args=cli_args), d
+
+    def _iter_jobs(self, grid, a=(), kw=None, ignore_job_id_keys=None):
+        '''Iterate over the job IDs and arguments for a grid.'''
         used = set()
-        job_paths = []
         for d in grid:
             d.positional += a
-            d.update(kw)
+            d.update(kw or {})
             job_id = self.format_job_id(
                 d, d.grid_keys, name=self.name, 
                 ignore_keys=ignore_job_id_keys)
             if job_id in used:
                 raise RuntimeError(f"Duplicate job ID: {job_id}")
-            job_paths.append(self.generate_job(job_id, _grid=grid, _args=d))
-
-        # generate run file
-        run_script = self.generate_run_script(job_paths, _grid=grid)
-
-        # store the current timestamp
-        if 'time_generated' in self.paths.paths:
-            self.paths.time_generated.write_text(str(time.time()))
+            yield job_id, d
+
+    def _iter_job_chunks(self, grid, a=(), kw=None, ignore_job_id_keys=None):
+        '''Iterate over the job IDs and arguments in lists of ``format_chunk_size`` jobs.'''
+        import itertools
+        it = self._iter_jobs(grid, a, kw, ignore_job_id_keys)
+        while True:
+            chunk = list(itertools.islice(it, self.format_chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _prepare_args(self, job_id, args, _arrays=None):
+        '''Add the job ID argument and write large arrays to file (in place).'''
+        if self.job_id_arg:
+            args[self.job_id_arg] = job_id
+        if _arrays is not None:
+            _arrays.replace(args)
+        return args
+
+    def format_cli_args(self, items) -> list:
+        '''Format the command-line arguments for many jobs at once (see ``Argument.format_batch``).
+        This should match how the ``command`` block of the job template formats ``args``.'''
+        return self.cli.format_batch(items, indent=self.cli_indent)
+
+    def render_job(self, job_id, args, params_args=None, paths=None, _grid=None, _render=None, cli_args=None) -> str:
+        '''Render a job script.'''
+        return (_render or get_template(self.template).render)(
+            job_id=job_id,
+            command=self.command,
+            paths=paths or self.job_paths(job_id),
+            args=args,
+            cli=self.cli,
+            grid=_grid,
+            params_args=params_args,
+            cli_args=cli_args,
+            **self.options,
+        ).lstrip()
+
+    def generate_job(self, job_id, *a, _args=None, _grid=None, _params=None, _arrays=None, _render=None, _archive=None, _writer=None, _cli_args=None, **params):
+        '''Generate a single slurm job file. Like ``generate()``, the first job generated
+        by this object backs up (or clears) the existing batch (see ``prepare``).'''
+        self.prepare()
+        if _writer is None:
+            with self.get_writer() as _writer:
+                return self.generate_job(
+                    job_id, *a, _args=_args, _grid=_grid, _params=_params, _arrays=_arrays, 
+                    _render=_render, _archive=_archive, _writer=_writer, _cli_args=_cli_args, **params)
 
-        return run_script, job_paths
-    
-    def generate_job(self, job_id, *a, _args=None, _grid=None, **params):
-        '''Generate a single slurm job file'''
         # build command
-        paths = self.paths.specify(job_id=job_id)
-        if self.job_id_arg:
-            params[self.job_id_arg] = job_id
-        
+        paths = self.job_paths(job_id)
         args = _args
         if args is None:
             args = GridItem()
         args.update(params)
         args.positional += a
 
+        with _writer.timed('args'):
+            # add the job ID and write large arrays to file (generate() already did this for a batch)
+            if _cli_args is None:
+                self._prepare_args(job_id, args, _arrays=_arrays or self.get_array_store(writer=_writer))
+
+            # write the arguments to a params file
+            params_args = None
+            if _params is not None:
+                params_args = _params.add(job_id, args, paths)
+            elif self.params_file:
+                # add to the batch's params (don't replace the other jobs' params)
+                with self.get_params_writer(append=True, writer=_writer) as _params:
+                    params_args = _params.add(job_id, args, paths)
+
         # generate job file
-        paths.job.parent.mkdir(parents=True, exist_ok=True)
-        with open(paths.job, "w") as f:
-            f.write(env.from_string(self.template).render(
-                job_id=job_id,
-                command=self.command,
-                paths=paths,
-                args=args,
-                cli=self.cli,
-                grid=_grid,
-                **self.options,
-            ).lstrip())
+        with _writer.timed('render'):
+            content = self.render_job(job_id, args, params_args, paths, _grid=_grid, _render=_render, cli_args=_cli_args)
 
         if 'output' in paths.paths:
-            paths.output.parent.mkdir(parents=True, exist_ok=True)
+            _writer.mkdir(paths.output.parent)
+
+        if _archive is not None:
+            with _writer.timed('write'):
+                _archive.add(job_id, content)
+            return job_id
 
-        return paths.job.format()
+        return _writer.write(paths.job, content)
 
-    def generate_run_script(self, _job_paths, _grid=None, **kw):
+    def generate_run_script(self, _job_paths, _grid=None, _writer=None, **kw):
         '''Generate a job run script that will submit all jobs.'''
         # Generate run script
         file_path = self.paths.run
-        with open(file_path, "w") as f:
-            f.write(env.from_string(self.run_template).render(
-                name=self.name,
-                command=self.command,
-                job_paths=_job_paths,
-                paths=self.paths,
-                cli=self.cli,
-                grid=_grid,
-                **self.options, **kw))
-        util.make_executable(file_path)
+        with self._writing(_writer) as writer:
+            with writer.timed('render'):
+                content = get_template(self.run_template).render(
+                    name=self.name,
+                    command=self.command,
+                    job_paths=_job_paths,
+                    paths=self.paths,
+                    cli=self.cli,
+                    grid=_grid,
+                    **self.options, **kw)
+            writer.write(file_path, content, executable=True)
         return file_path
 
+    def get_writer(self) -> JobWriter:
+        '''Get the writer used to write the job files.'''
+        return JobWriter(fsync=self.fsync)
+
+    def _writing(self, writer=None):
+        '''Use an existing writer (without closing it), or a new one.'''
+        import contextlib
+        return contextlib.nullcontext(writer) if writer is not None else self.get_writer()
+
+    def get_archive(self, writer=None) -> 'archive_.JobArchive|None':
+        '''Get the archive to write job scripts to (if ``archive`` is set).'''
+        if not self.archive:
+            return None
+        from . import archive as archive_
+        return archive_.JobArchive(self.paths.archive.format(), writer=writer)
+
+    def get_params_writer(self, append=False, writer=None) -> 'params_.ParamsWriter|None':
+        '''Get the writer for job params files (if ``params_file`` is enabled).'''
+        return params_.get_writer(self.params_file, self.paths, self.cli, append=append, writer=writer)
+
+    def generate_prelude(self, _grid=None, _writer=None):
+        '''Generate the environment setup script that is shared by the jobs (see ``prelude``).'''
+        from .render import PreludeRenderer
+        with self._writing(_writer) as writer:
+            with writer.timed('render'):
+                content = PreludeRenderer(get_env(), self.template).prelude(
+                    self.prelude_command,
+                    command=self.command,
+                    cli=self.cli,
+                    grid=_grid,
+                    **self.options,
+                )
+            return writer.write(self.paths.prelude, content)
+
+    def get_renderer(self):
+        '''Get the function used to render each job in a batch (if ``prelude`` or ``split_render`` is set).'''
+        if self.prelude:
+            from .render import PreludeRenderer
+            return functools.partial(
+                PreludeRenderer(get_env(), self.template), 
+                os.path.abspath(self.paths.prelude.format()))
+        if self.split_render:
+            return BatchRenderer(get_env(), self.template)
+        return None
+
+    def get_array_store(self, writer=None) -> 'params_.ArrayStore|None':
+        '''Get the store for numpy array arguments (if ``npy_threshold`` is set).'''
+        if self.npy_threshold is None:
+            return None
+        return params_.ArrayStore(self.paths.array, self.npy_threshold, writer=writer)
+
     def get_paths(self, **kw) -> pathtrees.Paths:
-        paths = pathtrees.tree(self.root_dir, {'{name}': {
+        paths = pathtrees.tree(self.root_dir, {'{name}': self.fanout_tree({
             '': 'batch_dir',
             '{job_id}.job.sh': 'job',
             'run.sh': 'run',
+            'common.sh': 'prelude',
+            'jobs.archive': 'archive',
             # optional
             'output/{job_id}.log': 'output',
+            'params/{job_id}.json': 'params',
+            'params.jsonl': 'params_table',
+            'arrays/{array_hash}.npy': 'array',
             'time_generated': 'time_generated',
-        }}).update(name=self.name, **kw)
+            'settings.json': 'settings',
+        })}).update(name=self.name, **kw)
         return paths  # type: ignore
 
 
@@ -376,7 +732,10 @@ class Slurm(Jobs):
         ...
 
         {# shell_code_body #}
-    
+
+    Arguments:
+        sacct_command (str, list): The command used to look up job states in ``jobs.status()``.
+        sbatch_command (str, list): The command used to submit jobs in ``jobs.resubmit()``.
     '''
     # make sbatch args more isomorphic
     # while also providing helpers for setting cpus to the number of gpus by default (for example)
@@ -396,7 +755,13 @@ class Slurm(Jobs):
         # nodes=None,
         modules=None,  # no need for modules with singularity
         bashrc=False,  # disable bashrc by default
+        dependency=None,  # e.g. 'afterok:1234'. See also Slurm.after()
     )
+    # the command used to get job states (see jobs.status())
+    sacct_command = 'sacct'
+    sbatch_command = 'sbatch'
+    # slurm's MaxArraySize defaults to 1001 (task IDs 0-1000)
+    max_array_size = 1000
     template = '''{% extends 'job.sbatch.j2' %}
     '''
     run_template = '''{% extends 'run.sbatch.j2' %}
@@ -415,10 +780,13 @@ class Slurm(Jobs):
         'anaconda3': ['anaconda3/2020.07'],
     }
 
-    def __init__(self, *a, sbatch=None, modules=None, n_gpus=None, n_cpus=None, nv=None, **kw):
-        modules = util.flatten(
-            self.module_presets.get(m, m) for m in (modules or ()))
+    def __init__(self, *a, sbatch=None, modules=None, n_gpus=None, n_cpus=None, nv=None, sacct_command=None, sbatch_command=None, **kw):
+        modules = list(util.flatten(
+            self.module_presets.get(m, m) for m in (modules or ())))
         super().__init__(*a, modules=modules, sbatch=sbatch, **kw)
+        self.sacct_command = sacct_command or self.sacct_command
+        self.sbatch_command = sbatch_command or self.sbatch_command
+        self.dependencies = []
 
         # handle n_cpus n_gpus
         sbat: dict = self.options['sbatch']
@@ -439,15 +807,285 @@ class Slurm(Jobs):
         self.options['nv'] = bool(n_gpus or sbat.get('gres')) if nv is None else nv
 
     def get_paths(self, **kw):
-        paths = pathtrees.tree(self.root_dir, {'{name}': {
+        paths = pathtrees.tree(self.root_dir, {'{name}': self.fanout_tree({
             '': 'batch_dir',
             '{job_id}.sbatch': 'job',
             'run.sh': 'run',
+            'common.sh': 'prelude',
+            'jobs.archive': 'archive',
             'slurm/slurm_%j__{job_id}.log': 'output',
+            'params/{job_id}.json': 'params',
+            'params.jsonl': 'params_table',
+            'arrays/{array_hash}.npy': 'array',
             'time_generated': 'time_generated',
-        }}).update(name=self.name, **kw)
+            'settings.json': 'settings',
+            'submissions.tsv': 'submissions',
+            'status.sqlite': 'status_db',
+            'resubmit/{resubmit_id}.sbatch': 'resubmit',
+        })}).update(name=self.name, **kw)
         return paths
 
+    dependency_types = ('after', 'afterany', 'afterok', 'afternotok', 'aftercorr')
+
+    def after(self, upstream, type='afterok', match=None) -> 'Slurm':
+        '''Make this batch's jobs wait for the jobs of another batch (a pipeline stage).
+        The slurm job IDs are filled in when the run script submits the jobs, using the 
+        upstream batch's submission records, so the upstream batch has to be submitted 
+        first (see :func:`write_pipeline`).
+
+        .. code-block:: python
+
+            prep = slurmjobs.Slurm('python preprocess.py')
+            train = slurmjobs.Slurm('python train.py').after(prep, 'aftercorr')
+            evaluate = slurmjobs.Slurm('python evaluate.py').after(train, 'afterany')
+            ...
+            slurmjobs.write_pipeline('submit_all.sh', prep, train, evaluate)
+
+        Arguments:
+            upstream (Slurm): The batch to wait for.
+            type (str): The dependency type: ``afterok`` (the jobs completed successfully), 
+                ``afterany`` (they finished), ``afternotok`` (they failed), or ``aftercorr`` 
+                (each job waits for the upstream job at the same position in its batch to 
+                complete successfully).
+            match (callable): ``match(job_id, args) -> list`` returns the upstream job IDs 
+                that a job depends on. By default, each job depends on every upstream job 
+                (or the corresponding one for ``aftercorr``).
+        '''
+        if type not in self.dependency_types:
+            raise ValueError(f'Unknown dependency type {type!r}. Expected one of {self.dependency_types}.')
+        self.dependencies.append((upstream, type, match))
+        return self
+
+    def job_dependencies(self, job_id, args, index) -> list:
+        deps = []
+        files = [b['submissions'] for b in self.upstream_batches(count=False)]
+        for upstream, type, match in self.dependencies:
+            if match is not None:
+                ids = match(job_id, args)
+                ids = [ids] if isinstance(ids, str) else list(ids)
+                if not ids:
+                    continue
+            elif type == 'aftercorr':
+                if upstream.job_ids is None:  # generated in another process
+                    upstream.job_ids = upstream.generated_job_ids()
+                if index >= len(upstream.job_ids):
+                    raise ValueError(
+                        f'{job_id} has no corresponding job in {upstream.name} ({len(upstream.job_ids)} jobs).')
+                ids = [upstream.job_ids[index]]
+            else:
+                ids = None  # all of them
+            deps.append({
+                # the jobs are separate (not an array) so aftercorr is afterok on the matching job
+                'type': 'afterok' if type == 'aftercorr' else type,
+                'submissions': upstream.paths.submissions.format(),
+                'upstream': files.index(upstream.paths.submissions.format()),  # see upstream_batches
+                'job_ids': ids,
+            })
+        return deps
+
+    def upstream_batches(self, count=True) -> list:
+        '''The batches that this batch's jobs depend on. The run script reads each one's 
+        submission records once, and only adds a dependency on all of a batch's jobs 
+        (``n_jobs``) once all of them have been submitted.'''
+        batches = {}
+        for upstream, _, _ in self.dependencies:
+            path = upstream.paths.submissions.format()
+            if path in batches:
+                continue
+            batches[path] = {'submissions': path}
+            if count:
+                if upstream.job_ids is None:  # generated in another process
+                    upstream.job_ids = upstream.generated_job_ids()
+                batches[path]['n_jobs'] = len(upstream.job_ids)
+        return list(batches.values())
+
+    def generate_run_script(self, _job_paths, _grid=None, _writer=None, **kw):
+        kw.setdefault('upstreams', self.upstream_batches())
+        return super().generate_run_script(_job_paths, _grid=_grid, _writer=_writer, **kw)
+
+    def get_status_cache(self) -> 'status_.StatusCache':
+        '''Get the local cache of job states.'''
+        from . import status as status_
+        return status_.StatusCache(self.paths.status_db.format(), sacct=self.sacct_command)
+
+    def status(self, refresh=True) -> dict:
+        '''Get the state of each job in the batch, using the slurm job IDs recorded when
+        the run script submitted them. All of the batch's unfinished jobs are checked 
+        using one ``sacct`` call (per few thousand jobs) and the results are cached (see ``slurmjobs.status``).
+
+        Arguments:
+            refresh (bool): Whether to poll sacct. If False, only the cached states are returned.
+
+        Returns:
+            dict: ``{job_id: {'slurm_id', 'state', 'exit_code', 'elapsed', 'max_rss'}}``. 
+            Jobs that haven't been submitted have a state of None. Jobs that sacct 
+            doesn't know about yet have a state of ``'SUBMITTED'``.
+        '''
+        from . import status as status_
+        subs = status_.read_submissions(self.paths.submissions.format())
+        ids = [s['slurm_id'] for s in subs.values()]
+        cache = self.get_status_cache()
+        try:
+            if refresh and ids:
+                since = min((s['submitted'] for s in subs.values() if s['submitted']), default=None)
+                states = cache.refresh(ids, since=since)
+            else:
+                states = cache.get(ids)
+        finally:
+            cache.close()
+
+        empty = {'slurm_id': None, 'state': None, 'exit_code': None, 'elapsed': None, 'max_rss': None}
+        result = {job_id: dict(empty) for job_id in self.generated_job_ids()}
+        for job_id, sub in subs.items():
+            result[job_id] = states.get(sub['slurm_id']) or dict(empty, slurm_id=sub['slurm_id'], state='SUBMITTED')
+        return result
+
+    def watch(self, interval=30, max_interval=600, **kw) -> dict:
+        '''Wait for the batch to finish, calling callbacks when jobs change state. The whole batch is
+        checked with one ``sacct`` call (per few thousand jobs) per poll, backing off when nothing changes.
+
+        .. code-block:: python
+
+            jobs.watch(
+                on_fail=lambda job_id, s: print(job_id, 'failed with', s['state']),
+                on_finish=lambda statuses: postprocess())
+
+        See ``slurmjobs.status.watch`` for the arguments.
+        '''
+        from . import status as status_
+        return status_.watch(self.status, interval=interval, max_interval=max_interval, **kw)
+
+    # the resubmit resource increases for each state: {state: {sbatch_option: factor}}
+    resubmit_bump = {'OUT_OF_MEMORY': {'mem': 2}, 'TIMEOUT': {'time': 2}}
+    # sbatch options that are specific to each job (and aren't used for a resubmitted array)
+    job_sbatch_options = ('job-name', 'output', 'error', 'array', 'dependency')
+
+    def resubmit(self, states=('FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL'), missing=False, done=None, 
+                 bump=False, array=True, dry_run=False) -> dict:
+        '''Resubmit the jobs in a batch that failed (see ``status()``).
+
+        .. code-block:: python
+
+            jobs.resubmit(bump=True)  # double the memory/time for OOM/TIMEOUT jobs
+
+        Arguments:
+            states (tuple): Resubmit jobs in these states.
+            missing (bool): Also submit jobs that were never submitted.
+            done (callable): ``done(job_id) -> bool``. Checks whether a job's outputs exist 
+                (e.g. its receipt). Finished jobs where this returns False are also resubmitted, 
+                whatever their state.
+            bump (bool, dict): Increase the resources of jobs that ran out of memory or time. If True, 
+                uses ``resubmit_bump``. Otherwise, it's a dict like ``{state: {sbatch_option: factor}}``.
+            array (bool): Submit the jobs as job arrays (one per distinct set of resources, split
+                into arrays of at most ``max_array_size`` tasks), otherwise each job is submitted separately.
+            dry_run (bool): Just return the jobs that would be resubmitted. 
+
+        Returns:
+            dict: ``{job_id: slurm_id}`` (or ``{job_id: state}`` for a dry run).
+        '''
+        from . import status as status_
+        bump = self.resubmit_bump if bump is True else bump or {}
+        selected = {}
+        for job_id, s in self.status().items():
+            state = s['state']
+            if (state in states or state is None and missing or 
+                    done is not None and state in status_.FINISHED and not done(job_id)):
+                selected[job_id] = state
+        if dry_run or not selected:
+            return selected
+
+        # group the jobs by their (bumped) resources
+        groups = {}
+        for job_id, state in selected.items():
+            script = self.read_job(job_id)
+            options = {
+                k: v for k, v in status_.sbatch_options(script).items() 
+                if k not in self.job_sbatch_options}
+            options = status_.bump_options(options, bump.get(state) or {})
+            groups.setdefault(tuple(options.items()), []).append(job_id)
+
+        submitted = {}
+        for options, job_ids in groups.items():
+            options = [f'--{k}={v}' if v is not None else f'--{k}' for k, v in options]
+            if array:
+                for i in range(0, len(job_ids), self.max_array_size):
+                    chunk = job_ids[i:i + self.max_array_size]
+                    slurm_id = _sbatch([*options, self.generate_resubmit_array(chunk)], self.sbatch_command)
+                    new = {job_id: f'{slurm_id}_{j}' for j, job_id in enumerate(chunk)}
+                    status_.write_submissions(self.paths.submissions.format(), new)
+                    submitted.update(new)
+            else:
+                for job_id in job_ids:
+                    new = {job_id: _sbatch([*options, self._job_script_path(job_id)], self.sbatch_command)}
+                    status_.write_submissions(self.paths.submissions.format(), new)
+                    submitted.update(new)
+        log.info('Resubmitted %d jobs from %s', len(submitted), self.name)
+        return submitted
+
+    def read_job(self, job_id) -> str:
+        '''Read a generated job script.'''
+        if self.archive:
+            from . import archive as archive_
+            return archive_.read_job(self.paths.archive.format(), job_id)
+        return self.job_paths(job_id).job.read_text()
+
+    def _job_script_path(self, job_id) -> str:
+        '''Get the path to a job's script, extracting it from the archive if needed.'''
+        if not self.archive:
+            return self.job_paths(job_id).job.format()
+        with self.get_writer() as writer:
+            return writer.write(self.paths.resubmit.specify(resubmit_id=job_id).format(), self.read_job(job_id))
+
+    def generate_resubmit_array(self, job_ids) -> str:
+        '''Write a job array script that runs each of these job scripts as a task. Each task writes to 
+        its job's usual log file (with ``%j`` as ``{array_job_id}_{task_id}``).'''
+        import shlex
+        scripts = [shlex.quote(self._job_script_path(job_id)) for job_id in job_ids]
+        logs = [shlex.quote(self.job_paths(job_id).output.format()) for job_id in job_ids]
+        content = (
+            '#!/bin/bash\n'
+            f'#SBATCH --job-name={self.name}-resubmit\n'
+            f'#SBATCH --array=0-{len(job_ids) - 1}\n'
+            '#SBATCH --output=/dev/null\n\n'
+            'scripts=(\n' + ''.join(f'    {p}\n' for p in scripts) + ')\n'
+            'logs=(\n' + ''.join(f'    {p}\n' for p in logs) + ')\n'
+            'i=$SLURM_ARRAY_TASK_ID\n'
+            'log="${logs[$i]//%j/${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}}"\n'
+            'mkdir -p "$(dirname "$log")"\n'
+            'exec bash "${scripts[$i]}" > "$log" 2>&1\n')
+        name = f'array-{hashlib.md5(",".join(job_ids).encode()).hexdigest()[:8]}-{int(time.time())}'
+        with self.get_writer() as writer:
+            return writer.write(self.paths.resubmit.specify(resubmit_id=name).format(), content, executable=True)
+
+def write_pipeline(path, *stages) -> str:
+    '''Write a script that submits several batches in order, so that each batch's 
+    dependencies (see ``Slurm.after``) are submitted before it.
+
+    Arguments:
+        path (str): The script path.
+        *stages (Slurm): The batches. They need to have been generated.
+
+    Returns:
+        str: The script path.
+    '''
+    for i, stage in enumerate(stages):
+        for upstream, _, _ in getattr(stage, 'dependencies', ()):
+            if upstream in stages[i:]:
+                raise ValueError(f'{stage.name} depends on {upstream.name}, which comes after it in the pipeline.')
+    content = '#!/bin/bash\n# submit each stage of the pipeline in order\nset -e\n' + ''.join(
+        f'bash "{stage.paths.run}"\n' for stage in stages)
+    with JobWriter() as writer:
+        return writer.write(path, content, executable=True)
+
+
+def _sbatch(args, sbatch='sbatch') -> str:
+    '''Submit a job and return its slurm job ID.'''
+    import shlex
+    import subprocess
+    cmd = shlex.split(sbatch) if isinstance(sbatch, str) else list(sbatch)
+    out = subprocess.run([*cmd, '--parsable', *args], check=True, capture_output=True, text=True).stdout
+    return out.strip().split(';')[0]
+
 # alias
 SBatch = Slurm
 
@@ -493,6 +1131,9 @@ class Singularity(Slurm):
     )
     template = '''{% extends 'job.singularity.j2' %}
     '''
+    # the command is pasted into the heredoc that runs inside the container
+    prelude_command = '$1'
+
     def __init__(self, command, overlay, sif, *a, **kw):
         assert overlay, 'You must specify an overlay file'
         assert sif, 'You must specify a sif file'
@@ -0,0 +1,221 @@
+'''Parameter files
+
+Instead of inlining every argument into the job script (which can get
+really big with e.g. a chunk of thousands of file paths, and can go over
+the shell's ``ARG_MAX``), you can write each job's arguments to a
+sidecar params file and have the job script only pass the file path.
+
+.. code-block:: python
+
+    jobs = slurmjobs.Slurm('python train.py', params_file=True)
+    jobs.generate([('*', chunked_files)])
+
+    # the job command becomes:
+    #     python train.py --params-file=jobs/train/params/train,....json
+
+Then, in your script, expand the params file back into the command-line
+arguments before your CLI library parses them:
+
+.. code-block:: python
+
+    import slurmjobs.runtime
+
+    if __name__ == '__main__':
+        slurmjobs.runtime.expand_argv()
+        fire.Fire(main)
+
+This works for any argument format (Fire, argparse, Sacred, Hydra) because
+the arguments are formatted once, at generation time, using the job's ``cli``.
+
+Similarly, large numpy arrays can be written once to ``.npy`` files next to the
+batch (instead of being converted to a giant json list in every job script).
+
+.. code-block:: python
+
+    jobs = slurmjobs.Slurm('python train.py', npy_threshold=1000)
+    jobs.generate(weights=np.random.rand(10000))
+
+    # and in your script
+    weights = slurmjobs.runtime.load_array(weights)
+'''
+import os
+import sys
+import json
+import shlex
+import hashlib
+import contextlib
+from . import util
+from .writer import JobWriter
+from .runtime import PARAMS_FILE_ARG, PARAMS_INDEX_ARG, index_path, pack_index
+
+
+def json_default(obj):
+    '''A ``json.dump(default=...)`` that can handle numpy values.'''
+    value = util.json_safe_numpy(obj)
+    if value is obj:
+        raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+    return value
+
+
+class ParamsWriter:
+    '''The base class for writing job arguments outside of the job script.
+
+    Arguments:
+        paths (pathtrees.Paths): The job paths.
+        cli (slurmjobs.args.Argument): The argument formatter.
+        append (bool): Add to the params that were already written for the batch
+            (e.g. when generating a single job) instead of starting over.
+        writer (JobWriter): The batch's writer (so the params files are written atomically
+            and fsynced with the rest of the batch).
+    '''
+    def __init__(self, paths, cli, append=False, writer=None):
+        self.paths = paths
+        self.cli = cli
+        self.append = append
+        self.writer = writer or JobWriter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def record(self, job_id, args):
+        '''Build the params record that is written for a job.'''
+        return {
+            'job_id': job_id,
+            'argv': self.cli.argv(args),
+            'args': list(getattr(args, 'positional', ())),
+            'kwargs': dict(args),
+        }
+
+    def add(self, job_id, args, paths=None):
+        '''Write the arguments for a job and return the arguments to put in the job script.
+        
+        Arguments:
+            job_id (str): The job ID.
+            args (GridItem): The job arguments.
+            paths (pathtrees.Paths): The job's paths (with the job ID already specified).
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''Finish writing.'''
+
+
+class ParamsFiles(ParamsWriter):
+    '''Write each job's arguments to its own json file (``paths.params``).'''
+    def add(self, job_id, args, paths=None):
+        path = (paths or self.paths.specify(job_id=job_id)).params.format()
+        with self.writer.open(path) as f:
+            json.dump(self.record(job_id, args), f, default=json_default)
+        return shlex.quote(f'{PARAMS_FILE_ARG}={path}')
+
+
+class ParamsTable(ParamsWriter):
+    '''Write all job arguments to a single table (``paths.params_table``) with one
+    json row per job. Jobs are told which row to read using ``--params-index``.
+
+    An offset index is written alongside the table so that each job can read its 
+    row directly. See ``slurmjobs.runtime.ParamTable``.
+    '''
+    def __init__(self, paths, cli, append=False, writer=None):
+        super().__init__(paths, cli, append, writer)
+        self.path = self.paths.params_table.format()
+        self.offsets = self._read_offsets() if append else [0]
+        self._stack = contextlib.ExitStack()
+        self.file = self._stack.enter_context(self.writer.open(self.path, 'ab' if append else 'wb'))
+
+    def add(self, job_id, args, paths=None):
+        row = json.dumps(self.record(job_id, args), default=json_default) + '\n'
+        self.offsets.append(self.offsets[-1] + self.file.write(row.encode()))
+        i = len(self.offsets) - 2
+        return f'{shlex.quote(f"{PARAMS_FILE_ARG}={self.path}")} {PARAMS_INDEX_ARG}={i}'
+
+    def _read_offsets(self):
+        '''Get the row offsets of the existing table (so we can add to it).'''
+        offsets = [0]
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    offsets.append(offsets[-1] + len(line))
+        return offsets
+
+    def close(self):
+        if not self.file.closed:
+            self._stack.close()
+            self.writer.write(index_path(self.path), pack_index(self.offsets))
+
+
+class ArrayStore:
+    '''Write numpy arrays to content-addressed ``.npy`` files and replace them with their path.
+    Identical arrays are only written once.
+
+    Arguments:
+        path (pathtrees.Path): The array path. Should contain ``{array_hash}``.
+        threshold (int): Only arrays with at least this many elements are written to file.
+        writer (JobWriter): The batch's writer.
+    '''
+    def __init__(self, path, threshold=0, writer=None):
+        self.path = path
+        self.threshold = threshold or 0
+        self.writer = writer or JobWriter()
+        self.written = {}
+        # skip re-hashing the same array object (e.g. a constant passed to every job)
+        self._seen = {}
+
+    def store(self, arr) -> str:
+        '''Write an array to file (if it hasn't been already) and return its path.'''
+        import numpy as np
+        if id(arr) in self._seen:
+            return self._seen[id(arr)][1]
+        original, arr = arr, np.ascontiguousarray(arr)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{arr.dtype.str}{arr.shape}'.encode())
+        h.update(arr.tobytes())
+        key = h.hexdigest()
+        if key not in self.written:
+            path = self.path.format(array_hash=key)
+            if not os.path.isfile(path):
+                with self.writer.open(path, 'wb') as f:
+                    np.save(f, arr, allow_pickle=False)
+            self.written[key] = path
+        # keep a reference to the array so its id can't be reused
+        self._seen[id(original)] = original, self.written[key]
+        return self.written[key]
+
+    def replace(self, args):
+        '''Replace large arrays in a grid item (in place) with their file paths.'''
+        if 'numpy' not in sys.modules:  # there can't be any arrays
+            return args
+        for k, v in args.items():
+            args[k] = self._replace(v)
+        args.positional = tuple(self._replace(v) for v in args.positional)
+        return args
+
+    def _replace(self, v):
+        import numpy as np
+        if isinstance(v, np.ndarray):
+            if v.size >= self.threshold and v.dtype != object:
+                return self.store(v)
+            return v
+        if isinstance(v, dict):
+            return {k: self._replace(x) for k, x in v.items()}
+        if isinstance(v, (list, tuple)):
+            return type(v)(self._replace(x) for x in v)
+        return v
+
+
+WRITERS = {'file': ParamsFiles, 'table': ParamsTable}
+
+def get_writer(kind, paths, cli, append=False, writer=None) -> 'ParamsWriter|None':
+    '''Get a params writer by name. ``True`` means ``'file'`` and a falsey value means
+    that arguments are inlined into the job script (returns None). See :class:`ParamsWriter`
+    for ``append`` and ``writer``.'''
+    if not kind:
+        return None
+    if kind is True:
+        kind = 'file'
+    if kind not in WRITERS:
+        raise ValueError(f'Unknown params_file mode {kind!r}. Expected one of {set(WRITERS)}')
+    return WRITERS[kind](paths, cli, append=append, writer=writer)
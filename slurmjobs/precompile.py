@@ -0,0 +1,95 @@
+'''Precompiled templates
+
+The built-in templates (``slurmjobs/templates/*.j2``) can be compiled ahead of time
+into Python modules so that generating jobs doesn't have to parse and compile them
+(and their ``extends`` chains) every time a new process starts.
+
+This happens automatically when building/installing the package (see ``setup.py``),
+or you can run it manually:
+
+.. code-block:: bash
+
+    python -m slurmjobs.precompile
+
+The compiled templates are only used if they were compiled from the current template
+sources using the installed Jinja version (see the manifest). Otherwise, the templates
+are loaded from source like before.
+'''
+import os
+import json
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+COMPILED_DIR = os.path.join(os.path.dirname(__file__), '_compiled_templates')
+MANIFEST = 'manifest.json'
+
+
+def template_hashes(template_dir=TEMPLATE_DIR) -> dict:
+    '''Get the sha256 of each template source.'''
+    hashes = {}
+    for name in sorted(os.listdir(template_dir)):
+        if name.endswith('.j2'):
+            with open(os.path.join(template_dir, name), 'rb') as f:
+                hashes[name] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def get_manifest(template_dir=TEMPLATE_DIR) -> dict:
+    '''The manifest that compiled templates need to match to be used.'''
+    import jinja2
+    return {'jinja2': jinja2.__version__, 'templates': template_hashes(template_dir)}
+
+
+def is_current(compiled_dir=COMPILED_DIR, template_dir=TEMPLATE_DIR) -> bool:
+    '''Check if the compiled templates match the template sources and Jinja version.'''
+    try:
+        with open(os.path.join(compiled_dir, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        return manifest == get_manifest(template_dir)
+    except (OSError, ValueError):
+        return False
+
+
+def compile_templates(env=None, compiled_dir=COMPILED_DIR, template_dir=TEMPLATE_DIR) -> str:
+    '''Compile the built-in templates into Python modules.
+
+    Arguments:
+        env (jinja2.Environment): The environment to compile with. Defaults to the job environment.
+        compiled_dir (str): Where to write the compiled templates.
+        template_dir (str): The template sources.
+
+    Returns:
+        str: The compiled template directory.
+    '''
+    import jinja2
+    if env is None:
+        from .core import create_env
+        env = create_env(compiled=False)
+    env = env.overlay(loader=jinja2.FileSystemLoader(template_dir))
+    os.makedirs(compiled_dir, exist_ok=True)
+    names = sorted(template_hashes(template_dir))
+    env.compile_templates(
+        compiled_dir, zip=None, filter_func=lambda name: name in names,
+        log_function=log.debug, ignore_errors=False)
+    with open(os.path.join(compiled_dir, MANIFEST), 'w') as f:
+        json.dump(get_manifest(template_dir), f, indent=2, sort_keys=True)
+    return compiled_dir
+
+
+def get_loaders(compiled_dir=COMPILED_DIR, template_dir=TEMPLATE_DIR) -> list:
+    '''Get the template loaders, using the compiled templates first if they're current.'''
+    import jinja2
+    loaders = [jinja2.FileSystemLoader(template_dir)] if template_dir != TEMPLATE_DIR else [
+        jinja2.PackageLoader('slurmjobs', 'templates')]
+    if is_current(compiled_dir, template_dir):
+        loaders.insert(0, jinja2.ModuleLoader(compiled_dir))
+    elif os.path.isdir(compiled_dir):
+        log.debug('Compiled templates in %s are out of date. Loading templates from source.', compiled_dir)
+    return loaders
+
+
+if __name__ == '__main__':
+    print('compiled templates to', compile_templates())
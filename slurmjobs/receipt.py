@@ -1,11 +1,788 @@
 from __future__ import annotations
 import os
+import re
+import sys
 import time
+import tempfile
+import uuid
+import socket
+import struct
+import pickle
 import hashlib
 import functools
-import pprint
+import threading
+import sqlite3
 import json
-from typing import Callable
+import logging
+from typing import Callable, Iterable
+
+log = logging.getLogger(__name__)
+
+
+def _dumps_meta(meta):
+    try:
+        return json.dumps(meta)
+    except Exception as e:
+        return json.dumps({
+            'error': type(e).__name__,
+            'description': str(e),
+            'data': str(meta)
+        })
+
+
+def _loads_meta(s, id=None):
+    try:
+        return json.loads(s) if s else {}
+    except json.decoder.JSONDecodeError as e:
+        log.error('Could not parse receipt metadata for %s: %s (%r)', id, e, s)
+    return {}
+
+
+def _name_from_id(id):
+    '''Guess the receipt name from its ID (the name followed by a hash).'''
+    m = re.match(r'^(.*?)([0-9a-f]{32})$', id)
+    return m.group(1) if m else id
+
+
+_ADDRESS_RE = re.compile(r' at 0x[0-9a-fA-F]+')
+
+class StructuralHasher:
+    '''A stable hash of python objects. Unlike hashing ``str(obj)``, this:
+
+     * walks dicts (regardless of key order), lists, tuples, and sets
+     * hashes numpy arrays, bytes, and other buffers directly (without building a repr)
+     * distinguishes between types (``1``, ``1.0``, ``'1'``, and ``True`` all hash differently)
+     * lets objects define their own hashable state using ``__receipt_hash__``
+
+    .. code-block:: python
+
+        class Model:
+            def __receipt_hash__(self):
+                # return anything hashable by this class
+                return {'config': self.config}
+
+        StructuralHasher.hexdigest({'model': Model(), 'x': np.zeros(1000)})
+
+    Objects without a custom ``repr`` are hashed by their attributes (``__dict__`` and 
+    ``__slots__``), and other objects that can't be walked fall back to their ``repr`` 
+    (with any memory addresses removed). Objects that contain themselves (e.g. a list 
+    that contains itself) hash a reference back to the containing object.
+    '''
+    digest_size = 16
+
+    def __init__(self):
+        self.h = hashlib.blake2b(digest_size=self.digest_size)
+        # {id(obj): depth} for the containers that we're in the middle of hashing
+        self._stack = {}
+
+    @classmethod
+    def hexdigest(cls, *objs) -> str:
+        '''Hash objects and return the hex digest.'''
+        hasher = cls()
+        for obj in objs:
+            hasher.update(obj)
+        return hasher.h.hexdigest()
+
+    def _tag(self, tag, data=b''):
+        # a type tag + length prefix so that adjacent values can't run together
+        self.h.update(struct.pack('<cQ', tag, len(data)))
+        self.h.update(data)
+
+    def update(self, obj):
+        '''Add an object to the hash.'''
+        t = type(obj)
+        if obj is None:
+            self._tag(b'N')
+        elif t is bool:
+            self._tag(b'B', b'1' if obj else b'0')
+        elif t is int:
+            self._tag(b'I', str(obj).encode())
+        elif t is float:
+            self._tag(b'F', struct.pack('<d', obj))
+        elif t is str:
+            self._tag(b'S', obj.encode('utf-8', 'surrogatepass'))
+        elif t in (bytes, bytearray, memoryview):
+            self._tag(b'Y', bytes(obj) if t is memoryview else obj)
+        elif id(obj) in self._stack:
+            # a reference back to an object that we're already hashing
+            self._tag(b'@', str(self._stack[id(obj)]).encode())
+        else:
+            self._stack[id(obj)] = len(self._stack)
+            try:
+                self._update_object(obj)
+            finally:
+                del self._stack[id(obj)]
+
+    def _update_object(self, obj):
+        t = type(obj)
+        if hasattr(t, '__receipt_hash__'):
+            self._tag(b'H', t.__qualname__.encode())
+            self.update(obj.__receipt_hash__())
+        elif isinstance(obj, dict):
+            # order-independent: sort the items by the hash of their key
+            items = sorted(((self.hexdigest(k), v) for k, v in obj.items()), key=lambda kv: kv[0])
+            self._tag(b'D', str(len(items)).encode())
+            for k, v in items:
+                self.h.update(k.encode())
+                self.update(v)
+        elif isinstance(obj, (list, tuple)):
+            self._tag(b'L' if isinstance(obj, list) else b'T', str(len(obj)).encode())
+            if not self._update_homogeneous(obj):
+                for x in obj:
+                    self.update(x)
+        elif isinstance(obj, (set, frozenset)):
+            self._tag(b'E', ''.join(sorted(self.hexdigest(x) for x in obj)).encode())
+        elif isinstance(obj, os.PathLike):
+            self._tag(b'P', os.fspath(obj).encode())
+        elif not self._update_special(obj):
+            self._update_fallback(obj)
+
+    def _update_homogeneous(self, xs):
+        '''Hash a long sequence of ints, floats, or strings in one go, rather than item by item.'''
+        if len(xs) < 16:
+            return False
+        types = set(map(type, xs))
+        if len(types) != 1:
+            return False
+        t = types.pop()
+        if t is int:
+            self._tag(b'i', ','.join(map(str, xs)).encode())
+        elif t is float:
+            self._tag(b'f', struct.pack(f'<{len(xs)}d', *xs))
+        elif t is str:
+            self._tag(b's', json.dumps(xs).encode())
+        else:
+            return False
+        return True
+
+    def _update_special(self, obj):
+        '''Handle objects from optional libraries (numpy, pandas). 
+        Modules are only checked if they've already been imported.'''
+        if 'numpy' in sys.modules:
+            import numpy as np
+            if isinstance(obj, np.ndarray):
+                if obj.dtype == object:
+                    self._tag(b'O', str(obj.shape).encode())
+                    for x in obj.ravel():
+                        self.update(x)
+                else:
+                    obj = np.ascontiguousarray(obj)
+                    self._tag(b'A', f'{obj.dtype.str}{obj.shape}'.encode())
+                    self.h.update(obj.view(np.uint8).reshape(-1) if obj.size else b'')
+                return True
+            if isinstance(obj, np.generic):
+                self.update(obj.item())
+                return True
+        if 'pandas' in sys.modules:
+            import pandas as pd
+            if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+                self._tag(b'X', type(obj).__name__.encode())
+                if isinstance(obj, pd.DataFrame):
+                    self.update(list(map(str, obj.columns)))
+                self.update(pd.util.hash_pandas_object(obj, index=True).values)
+                return True
+        return False
+
+    def _update_fallback(self, obj):
+        t = type(obj)
+        name = f'{t.__module__}.{t.__qualname__}'.encode()
+        # objects without a custom repr would just give us their memory address, so use their attributes
+        if t.__repr__ is object.__repr__:
+            slots = _slot_names(t)
+            if not hasattr(obj, '__dict__') and slots is None:
+                raise TypeError(
+                    f"Can't hash a {t.__qualname__} object: it has no attributes or repr to hash. "
+                    "Define __receipt_hash__ to say what should be hashed.")
+            self._tag(b'V', name)
+            self.update(dict(getattr(obj, '__dict__', {}), **{
+                f'__slot__{k}': getattr(obj, k, _UNSET) for k in slots or ()}))
+            return
+        self._tag(b'R', name)
+        self.update(_ADDRESS_RE.sub('', repr(obj)))
+
+
+class _Unset:
+    '''The value hashed for a slot that hasn't been assigned.'''
+    def __receipt_hash__(self):
+        return None
+
+_UNSET = _Unset()
+
+
+def _slot_names(cls):
+    '''Get the ``__slots__`` of a class and its bases (None if none of them define any).'''
+    names = None
+    for c in reversed(cls.__mro__):
+        slots = c.__dict__.get('__slots__')
+        if slots is None:
+            continue
+        names = names or []
+        for n in [slots] if isinstance(slots, str) else slots:
+            if n in ('__dict__', '__weakref__'):
+                continue
+            if n.startswith('__') and not n.endswith('__'):  # private names are mangled
+                n = f'_{c.__name__.lstrip("_")}{n}'
+            names.append(n)
+    return names
+
+
+class ReceiptStore:
+    '''The base class for receipt storage backends.
+
+    Arguments:
+        root (str): The receipt directory.
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.root)
+
+    def location(self, id) -> str:
+        '''A string describing where a receipt is stored.'''
+        raise NotImplementedError
+
+    def exists(self, id) -> bool:
+        '''Check if a receipt exists.'''
+        return bool(self.bulk_exists([id]))
+
+    def bulk_exists(self, ids: Iterable[str]) -> set:
+        '''Return the subset of receipt IDs that exist.'''
+        raise NotImplementedError
+
+    def read(self, id) -> dict|None:
+        '''Get a receipt's metadata. Returns None if it doesn't exist.'''
+        return self.bulk_read([id]).get(id)
+
+    def bulk_read(self, ids: Iterable[str]) -> dict:
+        '''Get the metadata for many receipts, as a dict of ``{id: meta}``. 
+        Missing receipts are omitted.'''
+        raise NotImplementedError
+
+    def write(self, id, meta, name=None):
+        '''Write a receipt.'''
+        self.bulk_write([(id, meta, name)])
+
+    def bulk_write(self, items: Iterable[tuple]):
+        '''Write many receipts from ``(id, meta, name)`` tuples.'''
+        raise NotImplementedError
+
+    def remove(self, id):
+        '''Delete a receipt, if it exists.'''
+        raise NotImplementedError
+
+    def items(self) -> Iterable[tuple]:
+        '''Iterate over all receipts as ``(id, name, meta)`` tuples.'''
+        raise NotImplementedError
+
+    # leases
+
+    def claim(self, id, owner, ttl) -> bool:
+        '''Try to take the lease on computing a receipt. This succeeds if nobody
+        holds the lease or if the current lease hasn't been renewed in ``ttl`` seconds.'''
+        raise NotImplementedError
+
+    def renew(self, id, owner, ttl) -> bool:
+        '''Extend a lease that we hold. Returns False if we no longer hold it.'''
+        raise NotImplementedError
+
+    def release(self, id, owner):
+        '''Give up a lease that we hold.'''
+        raise NotImplementedError
+
+
+class FileReceiptStore(ReceiptStore):
+    '''Store each receipt as its own json file in the receipt directory.'''
+    def location(self, id):
+        return os.path.join(self.root, id)
+
+    def exists(self, id):
+        return os.path.isfile(self.location(id))
+
+    def bulk_exists(self, ids):
+        ids = set(ids)
+        if not os.path.isdir(self.root):
+            return set()
+        with os.scandir(self.root) as it:
+            return {e.name for e in it if e.name in ids and e.is_file()}
+
+    def read(self, id):
+        fname = self.location(id)
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                return _loads_meta(f.read(), fname)
+        return None
+
+    def bulk_read(self, ids):
+        return {id: self.read(id) for id in self.bulk_exists(ids)}
+
+    def bulk_write(self, items):
+        os.makedirs(self.root, exist_ok=True)
+        for id, meta, name in items:
+            # write then rename so that nobody ever sees a partial receipt
+            fname = self.location(id)
+            tmp = os.path.join(self.root, f'.{id}.{uuid.uuid4().hex[:8]}.tmp')
+            with open(tmp, 'w') as f:
+                f.write(_dumps_meta(meta))
+            os.replace(tmp, fname)
+
+    def remove(self, id):
+        if self.exists(id):
+            os.remove(self.location(id))
+
+    def items(self):
+        if not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as it:
+            for e in it:
+                if e.is_file() and self._is_receipt(e.name):
+                    yield e.name, _name_from_id(e.name), self.read(e.name)
+
+    def _is_receipt(self, name):
+        '''Skip dotfiles (temp files and leases) and the files of the other stores that can
+        share this directory (e.g. ``receipts.sqlite`` and its ``-wal``/``-shm`` files).'''
+        if name.startswith('.'):
+            return False
+        for cls in STORES.values():
+            filename = getattr(cls, 'filename', None)
+            if filename and (name == filename or name.startswith(f'{filename}-')):
+                return False
+        return True
+
+    def _lease_file(self, id):
+        return os.path.join(self.root, f'.{id}.lease')
+
+    def _lease_owner(self, fname):
+        try:
+            with open(fname, 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def claim(self, id, owner, ttl):
+        os.makedirs(self.root, exist_ok=True)
+        fname = self._lease_file(id)
+        for _ in range(2):
+            try:
+                fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # the lease is held - check if it's gone stale (the heartbeat updates the mtime)
+                try:
+                    st = os.stat(fname)
+                except FileNotFoundError:
+                    continue
+                if time.time() - st.st_mtime <= ttl or not self._break_lease(fname, st):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(owner)
+            return True
+        return False
+
+    def _break_lease(self, fname, st):
+        '''Remove a stale lease. Several processes can see the same stale lease, so only the one
+        that creates the takeover file for this particular lease (its inode and mtime) removes it.
+        Otherwise, a slow process could remove the new lease that another process just took.'''
+        takeover = f'{fname}.{st.st_ino}-{st.st_mtime_ns}.takeover'
+        try:
+            os.close(os.open(takeover, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        try:
+            # make sure it's still the same lease (it wasn't renewed or replaced since we looked)
+            cur = os.stat(fname)
+            if (cur.st_ino, cur.st_mtime_ns) != (st.st_ino, st.st_mtime_ns):
+                return False
+            os.remove(fname)
+            return True
+        except FileNotFoundError:
+            return True
+        finally:
+            os.remove(takeover)
+
+    def renew(self, id, owner, ttl):
+        fname = self._lease_file(id)
+        if self._lease_owner(fname) != owner:
+            return False
+        os.utime(fname)
+        return True
+
+    def release(self, id, owner):
+        fname = self._lease_file(id)
+        if self._lease_owner(fname) == owner:
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+
+
+class SQLiteReceiptStore(ReceiptStore):
+    '''Store all receipts in a single SQLite database (``{root}/receipts.sqlite``).
+
+    This uses a lot fewer inodes than one file per receipt and lets you check
+    the status of many receipts with a single query.
+
+    By default, the database uses write-ahead logging (``journal_mode = 'WAL'``), which
+    allows readers and a writer to work concurrently. WAL needs shared memory between
+    processes so it doesn't work across hosts on a network filesystem. If your receipts
+    are shared between nodes, set ``SQLiteReceiptStore.journal_mode = 'DELETE'``.
+    '''
+    filename = 'receipts.sqlite'
+    journal_mode = 'WAL'
+    timeout = 60
+    # sqlite has a limit on the number of query parameters
+    chunk_size = 900
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.path = os.path.join(root, self.filename)
+        self._local = threading.local()
+
+    def location(self, id):
+        return f'{self.path}#{id}'
+
+    def connect(self, create=True) -> sqlite3.Connection|None:
+        '''Get the database connection for this thread/process. If ``create=False``
+        and the database doesn't exist yet, this returns None.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        if not create and not os.path.isfile(self.path):
+            return None
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        if self.journal_mode:
+            conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS receipts '
+                '(id TEXT PRIMARY KEY, name TEXT, time REAL, meta TEXT)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases '
+                '(id TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _query_chunks(self, query, ids):
+        conn = self.connect(create=False)
+        if conn is None:
+            return
+        ids = list(ids)
+        for i in range(0, len(ids), self.chunk_size):
+            chunk = ids[i:i + self.chunk_size]
+            yield from conn.execute(query.format(', '.join('?' * len(chunk))), chunk)
+
+    def bulk_exists(self, ids):
+        return {id for id, in self._query_chunks('SELECT id FROM receipts WHERE id IN ({})', ids)}
+
+    def bulk_read(self, ids):
+        return {
+            id: _loads_meta(meta, id) for id, meta in 
+            self._query_chunks('SELECT id, meta FROM receipts WHERE id IN ({})', ids)}
+
+    def bulk_write(self, items):
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO receipts (id, name, time, meta) VALUES (?, ?, ?, ?)', 
+                ((id, name, time.time(), _dumps_meta(meta)) for id, meta, name in items))
+
+    def remove(self, id):
+        conn = self.connect(create=False)
+        if conn is not None:
+            with conn:
+                conn.execute('DELETE FROM receipts WHERE id = ?', (id,))
+
+    def items(self):
+        conn = self.connect(create=False)
+        if conn is None:
+            return
+        for id, name, meta in conn.execute('SELECT id, name, meta FROM receipts'):
+            yield id, name, _loads_meta(meta, id)
+
+    def claim(self, id, owner, ttl):
+        conn = self.connect()
+        now = time.time()
+        with conn:  # writes are serialized, so this is atomic
+            conn.execute('DELETE FROM leases WHERE id = ? AND expires < ?', (id, now))
+            cur = conn.execute(
+                'INSERT OR IGNORE INTO leases (id, owner, expires) VALUES (?, ?, ?)', 
+                (id, owner, now + ttl))
+            return cur.rowcount == 1
+
+    def renew(self, id, owner, ttl):
+        conn = self.connect()
+        with conn:
+            cur = conn.execute(
+                'UPDATE leases SET expires = ? WHERE id = ? AND owner = ?', 
+                (time.time() + ttl, id, owner))
+            return cur.rowcount == 1
+
+    def release(self, id, owner):
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM leases WHERE id = ? AND owner = ?', (id, owner))
+
+
+STORES = {'sqlite': SQLiteReceiptStore, 'file': FileReceiptStore}
+_STORE_CACHE = {}
+
+def get_store(store='file', root=None) -> ReceiptStore:
+    '''Get a receipt store by name (or class). Stores are reused for the same type and directory.'''
+    if isinstance(store, ReceiptStore):
+        return store
+    cls = STORES[store] if isinstance(store, str) else store
+    root = root or Receipt.ROOT_DIR
+    key = cls, os.path.abspath(root)
+    if key not in _STORE_CACHE:
+        _STORE_CACHE[key] = cls(root)
+    return _STORE_CACHE[key]
+
+
+def migrate_receipts(src, dest=None, store='sqlite', remove=False) -> int:
+    '''Import a directory of receipt files (the ``'file'`` store) into another store.
+
+    Arguments:
+        src (str): The receipt directory to import.
+        dest (str): The destination receipt directory. Defaults to ``src``.
+        store (str): The destination store type.
+        remove (bool): Delete the receipt files once they're imported.
+
+    Returns:
+        int: The number of receipts imported.
+    '''
+    source = FileReceiptStore(src)
+    target = get_store(store, dest or src)
+    if isinstance(target, FileReceiptStore) and os.path.abspath(target.root) == os.path.abspath(source.root):
+        raise ValueError(f"Can't migrate the receipt files in {src} into themselves. Pick another store or directory.")
+    items = [(id, meta, name) for id, name, meta in source.items()]
+    target.bulk_write(items)
+    if remove:
+        for id, _, _ in items:
+            source.remove(id)
+    return len(items)
+
+
+class Lease:
+    '''A claim on computing a receipt, so that when many processes (e.g. array tasks) run 
+    the same receipted step, only one of them computes it. While the lease is held, a background 
+    thread renews it every ``heartbeat`` seconds. If the process is killed, the lease stops 
+    being renewed and expires after ``ttl`` seconds so someone else can claim it.
+
+    .. code-block:: python
+
+        with Lease(receipt.store, receipt.id) as lease:
+            if lease.acquired:
+                do_something()
+                receipt.make()
+
+    Arguments:
+        store (ReceiptStore): The receipt store.
+        id (str): The receipt ID.
+        ttl (float): How long until an un-renewed lease expires.
+        heartbeat (float): How often to renew the lease. Defaults to ``ttl / 4``.
+    '''
+    def __init__(self, store, id, ttl=60, heartbeat=None):
+        self.store = store
+        self.id = id
+        self.ttl = ttl
+        self.heartbeat = heartbeat or ttl / 4
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.acquired = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return '<Lease {} acquired={} owner={}>'.format(self.id, self.acquired, self.owner)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *a):
+        self.release()
+
+    def acquire(self) -> bool:
+        '''Try to claim the lease. Returns whether we got it.'''
+        if not self.acquired and self.store.claim(self.id, self.owner, self.ttl):
+            self.acquired = True
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._renew_loop, daemon=True)
+            self._thread.start()
+        return self.acquired
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.heartbeat):
+            if not self.store.renew(self.id, self.owner, self.ttl):
+                break
+
+    def release(self):
+        '''Give up the lease.'''
+        if self.acquired:
+            self._stop.set()
+            self._thread.join()
+            self.store.release(self.id, self.owner)
+            self.acquired = False
+
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'K': 1e3, 'KB': 1e3, 'M': 1e6, 'MB': 1e6, 'G': 1e9, 'GB': 1e9, 'T': 1e12, 'TB': 1e12}
+_TIME_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60*60, 'd': 24*60*60, 'w': 7*24*60*60}
+
+def _parse_unit(x, units):
+    '''Parse a value with units, e.g. ``'10GB'`` or ``'7d'``.'''
+    if x is None or isinstance(x, (int, float)):
+        return x
+    m = re.match(r'^\s*([\d.]+)\s*([a-zA-Z]*)\s*$', str(x))
+    if not m or m.group(2) not in units:
+        raise ValueError(f'Could not parse {x!r}. Valid units: {list(units)}')
+    return float(m.group(1)) * units[m.group(2)]
+
+
+class ResultCache:
+    '''Persist function return values so that receipted functions can return them 
+    when they're skipped. Numpy arrays are saved as ``.npy`` (and loaded using mmap). 
+    Everything else is pickled.
+
+    Arguments:
+        root (str): The directory to store results in.
+        max_bytes (int, str): The max total size of the cache (e.g. ``'10GB'``). When this 
+            is exceeded, the least recently used results are removed.
+        ttl (float, str): Remove results that haven't been used in this many seconds (e.g. ``'7d'``).
+
+    Scanning the cache directory is slow for big caches, so :meth:`save` only runs 
+    :meth:`gc` when the size written since the last scan takes the cache over ``max_bytes``, 
+    or once every ``gc_interval`` seconds (to catch expired results and other processes' writes).
+    '''
+    exts = ('.npy', '.pkl')
+    gc_interval = 60
+    # when a save takes the cache over max_bytes, evict down to this fraction of it (so the next 
+    # few saves don't need another scan)
+    gc_fraction = 0.8
+
+    def __init__(self, root, max_bytes=None, ttl=None):
+        self.root = root
+        self.max_bytes = _parse_unit(max_bytes, _SIZE_UNITS)
+        self.ttl = _parse_unit(ttl, _TIME_UNITS)
+        # the cache size as of the last gc (plus what we've written since), and when that was
+        self._total = None
+        self._last_gc = 0
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.root)
+
+    def _find(self, id):
+        for ext in self.exts:
+            fname = os.path.join(self.root, id + ext)
+            if os.path.isfile(fname):
+                return fname
+        return None
+
+    def has(self, id) -> bool:
+        '''Check if a result is stored.'''
+        return self._find(id) is not None
+
+    def save(self, id, value) -> str:
+        '''Store a result.'''
+        os.makedirs(self.root, exist_ok=True)
+        np = sys.modules.get('numpy')
+        is_array = np is not None and isinstance(value, np.ndarray) and value.dtype != object
+        fname = os.path.join(self.root, id + ('.npy' if is_array else '.pkl'))
+        # a unique temp file, so that threads saving the same result don't write to the same file
+        fd, tmp = tempfile.mkstemp(prefix=f'.{id}.', suffix='.tmp', dir=self.root)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if is_array:
+                    np.save(f, value, allow_pickle=False)
+                else:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.replace(tmp, fname)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        # remove a result of the other type
+        for ext in self.exts:
+            other = os.path.join(self.root, id + ext)
+            if other != fname and os.path.isfile(other):
+                os.remove(other)
+        if self._total is not None:
+            self._total += size
+        if self._needs_gc():
+            self.gc(keep=[fname], max_bytes=self.max_bytes and self.max_bytes * self.gc_fraction)
+        return fname
+
+    def _needs_gc(self) -> bool:
+        if self.max_bytes is None and self.ttl is None:
+            return False
+        return (
+            self._total is None or time.time() - self._last_gc > self.gc_interval or
+            (self.max_bytes is not None and self._total > self.max_bytes))
+
+    def load(self, id):
+        '''Load a result. Raises a KeyError if it doesn't exist.'''
+        fname = self._find(id)
+        try:
+            if fname is None:
+                raise FileNotFoundError
+            if fname.endswith('.npy'):
+                import numpy as np
+                value = np.load(fname, mmap_mode='r')
+            else:
+                with open(fname, 'rb') as f:
+                    value = pickle.load(f)
+        except FileNotFoundError:  # it may have been evicted
+            raise KeyError(id)
+        # mark it as recently used
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+        return value
+
+    def remove(self, id):
+        '''Delete a result, if it exists.'''
+        for ext in self.exts:
+            fname = os.path.join(self.root, id + ext)
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def gc(self, max_bytes=None, ttl=None, keep=(), dry_run=False) -> list:
+        '''Evict results that are older than ``ttl`` seconds and then the least recently 
+        used results until the cache is under ``max_bytes``.
+
+        Returns:
+            list: The removed files.
+        '''
+        max_bytes = _parse_unit(max_bytes, _SIZE_UNITS) if max_bytes is not None else self.max_bytes
+        ttl = _parse_unit(ttl, _TIME_UNITS) if ttl is not None else self.ttl
+        if not os.path.isdir(self.root):
+            return []
+        with os.scandir(self.root) as it:
+            entries = [
+                (e.stat().st_mtime, e.stat().st_size, e.path) for e in it 
+                if e.is_file() and e.name.endswith(self.exts)]
+        entries.sort()  # oldest first
+
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for mtime, size, fname in entries:
+            expired = ttl is not None and now - mtime > ttl
+            too_big = max_bytes is not None and total > max_bytes
+            if not (expired or too_big) or fname in keep:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(fname)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed.append(fname)
+        if not dry_run:
+            self._total, self._last_gc = total, now
+        return removed
 
 
 class Receipt:
@@ -13,17 +790,19 @@ class Receipt:
     it was successfully ran. This is useful if a long script fails in the middle and 
     you want to re-run it, but you don't need to re-run the first part. 
 
-    This will cache the function execution history using the string representation 
-    of the function's arguments. This works well as 99% of things have some sort of 
-    string representation, however, if you have a string representation that doesn't
-    stay consistent, like an object that prints out its ID, then the receipt won't work.
+    This will cache the function execution history using a structural hash of the 
+    function's arguments (see :class:`StructuralHasher`). Containers are walked, and 
+    numpy arrays and bytes are hashed directly. Objects that it doesn't know how to walk 
+    fall back to their string representation, so if you have a string representation that 
+    doesn't stay consistent, then the receipt won't work.
 
     To resolve this, you can either:
 
+     * define a ``__receipt_hash__(self)`` method on your object that returns something invariant 
+       (e.g. a dict of its config).
      * subclass this method and override ``Receipt.hash_args(*a, **kw)`` to return something invariant
        for your
      * Provide your own ``receipt_id`` to the function call.
-     * submit a PR for a better hash function!
     
     .. code-block:: python
 
@@ -39,17 +818,33 @@ class Receipt:
 
         else:
             """Oh good it ran completely last time so we can skip it and move to the next one."""
+
+    Receipts are saved using a :class:`ReceiptStore`. By default, this is one file per 
+    receipt in ``ROOT_DIR`` (``STORE = 'file'``), which is safe to share between nodes on 
+    a network filesystem. To use a single SQLite database instead (fewer inodes and faster
+    bulk lookups, but see :class:`SQLiteReceiptStore` about network filesystems), set 
+    ``STORE = 'sqlite'`` and import your existing receipt files using :func:`migrate_receipts` 
+    or ``python -m slurmjobs receipts migrate``.
+
+    Receipts made before ``1.2.0`` used a different argument hash (:meth:`legacy_hash_args`).
+    If ``LEGACY_FALLBACK`` is set and a receipt doesn't exist, the receipt with the old 
+    hash is looked up and copied to the new ID, so existing receipts keep working.
     '''
     ROOT_DIR = './receipts'
+    STORE = 'file'
     TEST = False
-    def __init__(self, name: str|Callable='', *a, receipt_id=None, __dir__=None, **kw):
+    LEGACY_FALLBACK = True
+    def __init__(self, name: str|Callable='', *a, receipt_id=None, __dir__=None, __store__=None, **kw):
         if callable(name):
             name = getattr(name, '__qualname__') or getattr(name, '__name__')
         assert name or a or kw, 'you must pass some identifiable information to be used for a hash.'
         self.name = name
         self.id = '{}{}'.format(name or '', receipt_id or self.hash_args(*a, **kw))
+        # for looking up receipts made with the old hash (see LEGACY_FALLBACK)
+        self._legacy_args = (a, kw) if receipt_id is None and self._use_legacy_fallback() else None
         self.ROOT_DIR = __dir__ or self.ROOT_DIR
-        self.fname = os.path.join(self.ROOT_DIR, self.id)
+        self.store = get_store(__store__ or self.STORE, self.ROOT_DIR)
+        self.fname = self.store.location(self.id)
 
     def __str__(self):
         return '<Receipt exists={} file={}>'.format(
@@ -57,42 +852,119 @@ class Receipt:
 
     def hash_args(self, *a, **kw):
         '''Take the function arguments and return a hash string for them.'''
+        return StructuralHasher.hexdigest(a, kw)
+
+    def legacy_hash_args(self, *a, **kw):
+        '''The ``str()``-based md5 hash used before ``1.2.0``. To keep using receipts 
+        made with older versions, use: ``Receipt.hash_args = Receipt.legacy_hash_args``.'''
         return hashlib.md5((
             str(a) + str(sorted(kw.items()))
         ).encode()).hexdigest()
 
+    @classmethod
+    def _use_legacy_fallback(cls):
+        return cls.LEGACY_FALLBACK and getattr(cls.hash_args, '__func__', cls.hash_args) is not Receipt.legacy_hash_args
+
     @property
     def exists(self):
-        return os.path.isfile(self.fname)
+        return self.store.exists(self.id) or self._adopt_legacy()
+
+    def _adopt_legacy(self) -> bool:
+        '''Copy a receipt made with :meth:`legacy_hash_args` to this receipt's ID (if there is one).'''
+        if self._legacy_args is None:
+            return False
+        a, kw = self._legacy_args
+        meta = self.store.read('{}{}'.format(self.name or '', self.legacy_hash_args(*a, **kw)))
+        if meta is None:
+            return False
+        log.debug('Using the receipt from before 1.2.0 for %s. receipt=%s', self.name, self.fname)
+        self.store.write(self.id, meta, name=self.name)
+        return True
 
     def make(self, **meta):
-        os.makedirs(self.ROOT_DIR, exist_ok=True)
-        with open(self.fname, 'w') as f:
-            os.utime(self.fname)
-            try:
-                json.dump(meta, f)
-            except Exception as e:
-                json.dump({
-                    'error': type(e).__name__,
-                    'description': str(e),
-                    'data': str(meta)
-                }, f)
+        self.store.write(self.id, meta, name=self.name)
 
     def clear(self):
-        if self.exists:
-            os.remove(self.fname)
+        self.store.remove(self.id)
 
     @property
     def meta(self) -> dict:
-        if os.path.isfile(self.fname):
-            with open(self.fname, 'r') as f:
-                s = f.read()
-                try:
-                    return json.loads(s) if s else {}
-                except json.decoder.JSONDecodeError as e:
-                    print('error:', e, s)
-        return {}
+        return self.store.read(self.id) or {}
 
+    def lease(self, ttl=60, heartbeat=None) -> Lease:
+        '''Get a :class:`Lease` for computing this receipt.'''
+        return Lease(self.store, self.id, ttl=ttl, heartbeat=heartbeat)
+
+    @classmethod
+    def bulk_status(cls, items, name: str|Callable='', __dir__=None, __store__=None) -> list:
+        '''Check which of many function calls already have receipts using a single 
+        query (or directory scan) instead of checking each receipt one at a time.
+
+        .. code-block:: python
+
+            status = Receipt.bulk_status(slurmjobs.Grid(...), train)
+            todo = [s['item'] for s in status if not s['done']]
+
+        Arguments:
+            items (list): The function arguments. Each item is either a dict of keyword arguments
+                (its ``.positional`` attribute is used for positional arguments, like with a ``GridItem``), 
+                or an ``(args, kwargs)`` tuple. A ``receipt_id`` keyword is used as the receipt ID.
+            name (str, callable): The receipt name (or the function).
+            __dir__ (str): The receipt directory. Defaults to ``ROOT_DIR``.
+            __store__ (str): The receipt store type. Defaults to ``STORE``.
+
+        Returns:
+            list: A dict for each item with the ``item``, its receipt ``id``, whether it's ``done``,
+            and its receipt ``meta`` (e.g. ``duration_secs``).
+        '''
+        if callable(name):
+            name = getattr(name, '__qualname__') or getattr(name, '__name__')
+        store = get_store(__store__ or cls.STORE, __dir__ or cls.ROOT_DIR)
+        r = cls.__new__(cls)
+        items = list(items)
+        ids, legacy = [], {}
+        for item in items:
+            a, kw = _item_args(item)
+            receipt_id = kw.pop('receipt_id', None)
+            ids.append('{}{}'.format(name or '', receipt_id or r.hash_args(*a, **kw)))
+            if receipt_id is None and cls._use_legacy_fallback():
+                legacy[ids[-1]] = a, kw
+        metas = store.bulk_read(ids)
+        # copy any receipts made with the old hash to their new IDs (see LEGACY_FALLBACK)
+        legacy = {id: '{}{}'.format(name or '', r.legacy_hash_args(*a, **kw)) for id, (a, kw) in legacy.items() if id not in metas}
+        if legacy:
+            old = store.bulk_read(legacy.values())
+            found = [(id, old[legacy_id], name) for id, legacy_id in legacy.items() if legacy_id in old]
+            if found:
+                store.bulk_write(found)
+                metas.update((id, meta) for id, meta, _ in found)
+        return [
+            {'item': item, 'id': id, 'done': id in metas, 'meta': metas.get(id) or {}}
+            for item, id in zip(items, ids)]
+
+
+def _item_args(item) -> tuple:
+    '''Get ``(args, kwargs)`` from an item passed to :meth:`Receipt.bulk_status`.'''
+    if isinstance(item, dict):
+        return tuple(getattr(item, 'positional', ())), dict(item)
+    if isinstance(item, tuple) and len(item) == 2 and isinstance(item[1], dict):
+        return tuple(item[0]), dict(item[1])
+    raise TypeError('Expected a dict of kwargs or an (args, kwargs) tuple. Got {!r}'.format(item))
+
+
+
+def _pformat(x):
+    import pprint
+    return pprint.pformat(x)
+
+
+class _LazyFormat:
+    '''Only format a log argument if the message is actually emitted.'''
+    def __init__(self, func, *a):
+        self.func, self.a = func, a
+
+    def __str__(self):
+        return self.func(*self.a)
 
 
 def _fallbacks(*xs):
@@ -101,7 +973,8 @@ def _fallbacks(*xs):
             return x
 
 
-def use_receipt(func, receipt_dir=None, test=None):
+def use_receipt(func, receipt_dir=None, test=None, store=None, cache_result=False, max_cache_bytes=None, cache_ttl=None, 
+                lease=False, lease_ttl=60, wait=True, poll_interval=5):
     '''Use a receipt for a function call, which lets us skip a result if the function completed successfully
     the last run. This is just a wrapper around ``Receipt`` that handles the receipt checking/making logic for you.
 
@@ -114,69 +987,371 @@ def use_receipt(func, receipt_dir=None, test=None):
         custom_receipt_id = ...
         use_receipt(my_step2_function)(**step2_kwargs, receipt_id=custom_receipt_id)
 
-        # do step 3
-        use_receipt(my_step3_function)(**step3_kwargs)
+        # do step 3. This saves the return value so that it's returned even when the step is skipped.
+        features = use_receipt(my_step3_function, cache_result=True)(**step3_kwargs)
+
+        # check which calls still need to run
+        todo = use_receipt(my_step1_function).pending([step1_kwargs, ...])
+
+    Arguments:
+        func (callable): The function to wrap.
+        receipt_dir (str): The receipt directory. Defaults to ``Receipt.ROOT_DIR``.
+        test (bool): Do a dry run.
+        store (str): The receipt store type. See :class:`ReceiptStore`.
+        cache_result (bool): Save the function's return value (in ``{receipt_dir}/results``) 
+            and return it when the function is skipped. If the result was evicted, the function is re-run.
+        max_cache_bytes (int, str): The max size of the result cache (e.g. ``'10GB'``). 
+            Least recently used results are evicted first. See :class:`ResultCache`.
+        cache_ttl (float, str): Evict results that haven't been used in this long (e.g. ``'7d'``).
+        lease (bool): Claim a :class:`Lease` before running the function so that, when many processes 
+            (e.g. array tasks sharing a receipt dir) run the same step, only one of them computes it.
+        lease_ttl (float): How many seconds until the lease of a killed process expires.
+        wait (bool): If another process holds the lease, wait for it to finish (or for its lease to expire). 
+            Otherwise, move on and return None.
+        poll_interval (float): How often to check if the other process finished.
     '''
-    @functools.wraps(func)
-    def inner(*a, overwrite_=False, test=None, receipt_dir_=None, **kw):
+    def _run(a, kw, overwrite_, test, receipt_dir_):
+        '''The receipt logic. This is a generator so that it can be shared between sync and async 
+        functions. It yields ``('sleep', seconds)`` and ``('call', None)``, and the caller sends back 
+        the function's return value (or throws its exception).'''
         test = _fallbacks(test, inner.TEST, Receipt.TEST)
         receipt_dir_ = _fallbacks(receipt_dir_, inner.ROOT_DIR, Receipt.ROOT_DIR)
-        r = Receipt(func, *a, __dir__=receipt_dir_, **kw)
+        r = Receipt(func, *a, __dir__=receipt_dir_, __store__=inner.STORE, **kw)
+        results = ResultCache(
+            os.path.join(receipt_dir_, 'results'), max_cache_bytes, cache_ttl
+        ) if cache_result else None
         name = r.name
         if test:
-            print('''
-------------------------
--- Test Run --
-
-Function: {}
-Receipt: {}
-*args:
-{}
-**kwargs:
-{}
-------------------------
-            '''.format(name, r, pprint.pformat(a), pprint.pformat(kw)))
+            # a warning, so that it's shown even if logging isn't configured (unlike a silent skip)
+            log.warning(
+                'Test run of %s. receipt=%s\n*args:\n%s\n**kwargs:\n%s', 
+                name, r.fname, _LazyFormat(_pformat, a), _LazyFormat(_pformat, kw))
             return
-        if overwrite_ or not r.exists:
+        def skip():
+            '''Check if we can skip the function. Returns (skipped, result).'''
+            if not r.exists:
+                return False, None
+            if results is None:
+                log.info('Receipt exists for %s. Skipping. receipt=%s', name, r.fname)
+                return True, None
+            try:
+                result = results.load(r.id)
+            except KeyError:  # the result was evicted, so we need to recompute it
+                return False, None
+            log.info('Receipt exists for %s. Loaded result from cache. receipt=%s', name, r.fname)
+            return True, result
+
+        if not overwrite_:
+            skipped, result = skip()
+            if skipped:
+                return result
+
+        # make sure that only one process computes this receipt at a time
+        lease_ = r.lease(lease_ttl) if lease else None
+        if lease_ is not None:
+            while not lease_.acquire():
+                if not wait:
+                    log.info('Receipt for %s is being computed by another process. Moving on. receipt=%s', name, r.fname)
+                    return None
+                yield 'sleep', poll_interval
+                if not overwrite_:
+                    skipped, result = skip()
+                    if skipped:
+                        return result
+            # someone may have finished right before we got the lease
+            if not overwrite_:
+                skipped, result = skip()
+                if skipped:
+                    lease_.release()
+                    return result
+
+        try:
             start_time = time.time()
             try:
-                result = func(*a, **kw)
+                result = yield 'call', None
+                if results is not None:
+                    results.save(r.id, result)
             except BaseException as e:
                 r.clear()
-                print('''
-------------------------
--- Error during receipted function {}. --
-Receipt: {}
-Error: ({}) {}
-
-No receipt is written.
-------------------------
-                '''.format(name, r, type(e).__name__, e))
+                log.error(
+                    'Error during receipted function %s. No receipt is written. receipt=%s error=(%s) %s', 
+                    name, r.fname, type(e).__name__, e)
                 raise
-            r.make(duration_secs=time.time() - start_time, time=time.time())
+            duration = time.time() - start_time
+            r.make(duration_secs=duration, time=time.time())
+        finally:
+            if lease_ is not None:
+                lease_.release()
 
-            print('''
-------------------------
--- Receipt written for {} --
-Receipt: {}
+        log.info('Receipt written for %s. Took %.3g seconds. receipt=%s', name, duration, r.fname)
+        return result
 
-Took: {} seconds.
-------------------------
-            '''.format(name, r, (r.meta or {}).get('duration_secs')))
-            return result
-        else:
-            print('''
-------------------------
--- Receipt exists for {} --
-Receipt: {}
-
-Skipping.
-------------------------
-            '''.format(name, r, (r.meta or {}).get('duration_secs')))
-    inner.TEST, inner.ROOT_DIR = test, receipt_dir
+    import inspect
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def inner(*a, overwrite_=False, test=None, receipt_dir_=None, **kw):
+            import asyncio
+            steps = _run(a, kw, overwrite_, test, receipt_dir_)
+            value = error = None
+            while True:
+                try:
+                    kind, x = steps.throw(error) if error is not None else steps.send(value)
+                except StopIteration as e:
+                    return e.value
+                value = error = None
+                if kind == 'sleep':
+                    await asyncio.sleep(x)
+                    continue
+                try:
+                    value = await func(*a, **kw)
+                except BaseException as e:
+                    error = e
+    else:
+        @functools.wraps(func)
+        def inner(*a, overwrite_=False, test=None, receipt_dir_=None, **kw):
+            steps = _run(a, kw, overwrite_, test, receipt_dir_)
+            value = error = None
+            while True:
+                try:
+                    kind, x = steps.throw(error) if error is not None else steps.send(value)
+                except StopIteration as e:
+                    return e.value
+                value = error = None
+                if kind == 'sleep':
+                    time.sleep(x)
+                    continue
+                try:
+                    value = func(*a, **kw)
+                except BaseException as e:
+                    error = e
+
+    def status(items, receipt_dir_=None) -> list:
+        '''Check which calls (dicts of kwargs or ``(args, kwargs)`` tuples) have receipts. 
+        See :meth:`Receipt.bulk_status`.'''
+        return Receipt.bulk_status(
+            items, func, _fallbacks(receipt_dir_, inner.ROOT_DIR, Receipt.ROOT_DIR), inner.STORE)
+
+    def pending(items, receipt_dir_=None) -> list:
+        '''Get the items that don't have a receipt yet (i.e. still need to run).'''
+        return [s['item'] for s in status(items, receipt_dir_) if not s['done']]
+
+    inner.TEST, inner.ROOT_DIR, inner.STORE = test, receipt_dir, store
+    inner.status, inner.pending = status, pending
     return inner
 
 
+class Step:
+    '''A receipted function call to run with :func:`run_steps`.
+
+    Arguments:
+        func (callable): The function to call. It can be a regular or an ``async`` function.
+            If it isn't already wrapped with :func:`use_receipt`, it will be.
+        *a: Positional arguments for the function.
+        after (Step, list): Steps that need to finish before this one starts.
+        **kw: Keyword arguments for the function.
+    '''
+    def __init__(self, func, *a, after=(), **kw):
+        self.func = func
+        self.a = a
+        self.kw = kw
+        self.after = [after] if isinstance(after, Step) else list(after)
+
+    def __repr__(self):
+        return '<Step {}>'.format(getattr(self.func, '__qualname__', self.func))
+
+    def __call__(self):
+        import inspect
+        if inspect.iscoroutinefunction(self.func):
+            import asyncio
+            return asyncio.run(self.func(*self.a, **self.kw))
+        return self.func(*self.a, **self.kw)
+
+
+def run_steps(steps, max_workers=4, **kw) -> list:
+    '''Run receipted steps concurrently using a thread pool. Steps start once all of 
+    the steps they depend on have finished and steps with existing receipts are skipped.
+    This is meant for independent, I/O bound steps (downloads, conversions, etc.).
+
+    .. code-block:: python
+
+        downloads = [Step(download, url) for url in urls]
+        merged = Step(merge, after=downloads)
+        run_steps(downloads + [merged], max_workers=8, receipt_dir='./receipts')
+
+    If a step fails, the steps that depend on it are not run. The other steps keep 
+    running and the first error is raised once they're done.
+
+    Arguments:
+        steps (list): The :class:`Step` objects (or functions without arguments) to run.
+            Dependencies that aren't in the list are added automatically.
+        max_workers (int): The number of steps to run at the same time.
+        **kw: Arguments for :func:`use_receipt`, used when wrapping the step functions.
+
+    Returns:
+        list: The return value of each step in ``steps`` (None for skipped steps without a cached result).
+    '''
+    import concurrent.futures
+    steps = [s if isinstance(s, Step) else Step(s) for s in steps]
+    n = len(steps)
+    # add any missing dependencies
+    i = 0
+    while i < len(steps):
+        steps.extend(d for d in steps[i].after if d not in steps)
+        i += 1
+
+    wrapped = {}
+    for step in steps:
+        if not hasattr(step.func, 'pending'):  # not receipted yet
+            if step.func not in wrapped:
+                wrapped[step.func] = use_receipt(step.func, **kw)
+            step.func = wrapped[step.func]
+
+    results = {}
+    errors = {}
+    waiting = list(steps)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        running = {}
+        while waiting or running:
+            for step in list(waiting):
+                failed = [d for d in step.after if d in errors]
+                if failed:
+                    waiting.remove(step)
+                    errors[step] = None
+                    log.warning('Skipping %s because %s failed.', step, failed[0])
+                elif all(d in results for d in step.after):
+                    waiting.remove(step)
+                    running[pool.submit(step)] = step
+            if not running:
+                if waiting:
+                    raise ValueError('Steps have circular dependencies: {}'.format(waiting))
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                step = running.pop(fut)
+                try:
+                    results[step] = fut.result()
+                except Exception as e:
+                    errors[step] = e
+
+    for e in errors.values():
+        if e is not None:
+            raise e
+    return [results.get(step) for step in steps[:n]]
+
+
+def _percentile(xs, q):
+    '''Get a percentile (0-100) of a sorted list, interpolating between values.'''
+    if not xs:
+        return None
+    i = (len(xs) - 1) * q / 100
+    lo = int(i)
+    hi = min(lo + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (i - lo)
+
+
+def receipt_stats(root=None, store=None, remaining=None, names=None) -> dict:
+    '''Aggregate the durations stored in receipts, grouped by receipt name.
+
+    .. code-block:: python
+
+        stats = receipt_stats('./receipts', remaining={'train': 300})
+        print(stats['train']['p95'], stats['train']['eta_secs'])
+
+    Arguments:
+        root (str): The receipt directory. Defaults to ``Receipt.ROOT_DIR``.
+        store (str): The receipt store type. Defaults to ``Receipt.STORE``.
+        remaining (int, dict): The number of items left to run, used to estimate the time remaining. 
+            Either a dict of ``{name: n_remaining}`` or a number used for every name.
+        names (list): Only include these receipt names.
+
+    Returns:
+        dict: For each receipt name: the ``count``, the ``p50``, ``p95``, ``max``, and ``total`` duration in 
+        seconds, the ``throughput`` (receipts per second, from the first start to the last finish), 
+        and if ``remaining`` is given, the estimated ``eta_secs``.
+    '''
+    names = {names} if isinstance(names, str) else set(names) if names else None
+    groups = {}
+    for _, name, meta in get_store(store or Receipt.STORE, root or Receipt.ROOT_DIR).items():
+        if names is None or name in names:
+            groups.setdefault(name, []).append(meta or {})
+
+    stats = {}
+    for name, metas in sorted(groups.items()):
+        durations = sorted(m['duration_secs'] for m in metas if m.get('duration_secs') is not None)
+        ends = [m['time'] for m in metas if m.get('time') is not None]
+        starts = [m['time'] - (m.get('duration_secs') or 0) for m in metas if m.get('time') is not None]
+        window = max(ends) - min(starts) if ends else 0
+        throughput = len(ends) / window if window > 0 else None
+        stats[name] = d = {
+            'count': len(metas),
+            'p50': _percentile(durations, 50),
+            'p95': _percentile(durations, 95),
+            'max': durations[-1] if durations else None,
+            'total': sum(durations),
+            'throughput': throughput,
+        }
+        if remaining is not None:
+            n = remaining.get(name, 0) if isinstance(remaining, dict) else remaining
+            d['remaining'] = n
+            d['eta_secs'] = n / throughput if throughput else None
+    return stats
+
+
+def _fmt_secs(x):
+    if x is None:
+        return '-'
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if x >= size:
+            return '{:.1f}{}'.format(x / size, unit)
+    return '{:.2f}s'.format(x)
+
+
+class ReceiptCLI:
+    '''Manage receipts from the command line.
+
+    .. code-block:: bash
+
+        # import a directory of receipt files into the receipt database
+        python -m slurmjobs receipts --root=./receipts migrate
+
+        # evict cached results (see use_receipt(cache_result=True))
+        python -m slurmjobs receipts gc --max_bytes=10GB --ttl=7d
+
+        # durations, throughput, and the estimated time to finish 500 more
+        python -m slurmjobs receipts stats --name=train --remaining=500
+    '''
+    def __init__(self, root=None, store=None):
+        self.root = root or Receipt.ROOT_DIR
+        self.store = store or Receipt.STORE
+
+    def migrate(self, src=None, remove=False):
+        '''Import receipt files from ``src`` (defaults to ``root``) into the receipt store 
+        (the SQLite database, unless ``--store`` is given).'''
+        store = self.store if self.store != 'file' or src else 'sqlite'
+        n = migrate_receipts(src or self.root, self.root, store=store, remove=remove)
+        print(f'imported {n} receipts into {get_store(store, self.root)}')
+
+    def gc(self, max_bytes=None, ttl=None, dry_run=False):
+        '''Evict cached results older than ``ttl`` (e.g. ``7d``) and then the least recently 
+        used results until the cache is smaller than ``max_bytes`` (e.g. ``10GB``).'''
+        cache = ResultCache(os.path.join(self.root, 'results'))
+        removed = cache.gc(max_bytes=max_bytes, ttl=ttl, dry_run=dry_run)
+        print(f'{"would remove" if dry_run else "removed"} {len(removed)} cached results from {cache.root}')
+
+    def stats(self, name=None, remaining=None):
+        '''Show the receipt count, p50/p95/max duration, and throughput for each receipt name. 
+        Pass ``remaining`` (the number of items left) to estimate the time remaining.'''
+        stats = receipt_stats(self.root, self.store, remaining=remaining, names=name)
+        cols = ['count', 'p50', 'p95', 'max', 'per hour'] + (['remaining', 'eta'] if remaining is not None else [])
+        rows = [[name, str(d['count']), _fmt_secs(d['p50']), _fmt_secs(d['p95']), _fmt_secs(d['max']), 
+                 '{:.1f}'.format(d['throughput'] * 3600) if d['throughput'] else '-'] + 
+                ([str(d['remaining']), _fmt_secs(d['eta_secs'])] if remaining is not None else [])
+                for name, d in stats.items()]
+        widths = [max(len(str(x)) for x in col) for col in zip(['name'] + cols, *rows)]
+        for row in [['name'] + cols] + rows:
+            print('  '.join(x.ljust(w) if i == 0 else x.rjust(w) for i, (x, w) in enumerate(zip(row, widths))))
+
+
 # so that setting attributes will set receipt instead
 class _DeprecatedSetAttr:
     def __init__(self, func):
@@ -187,7 +1362,6 @@ class _DeprecatedSetAttr:
         return self.func(*a, **kw)
 
     def __setattr__(self, k, v):
-        print(k, v, k not in self.__dict__)
         if k not in self.__dict__:
             setattr(Receipt, k, v)
             return
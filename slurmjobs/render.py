@@ -0,0 +1,221 @@
+'''Two-phase template rendering
+
+Most of a job script is the same for every job in a batch (the sbatch resource lines,
+module loads, singularity flags, conda activation, etc.). Only a few blocks actually
+use the job's variables (``job_id``, ``args``, ``paths``, ``params_args``, ``cli_args``).
+
+:class:`BatchRenderer` finds those blocks by looking at the template's syntax tree
+(following its ``extends`` chain), renders the rest of the template once per batch,
+and then only renders the job-specific blocks for each job.
+
+.. code-block:: python
+
+    jobs = slurmjobs.Slurm('python train.py', split_render=True)
+
+The first job is also rendered normally and compared against the split rendering.
+If they don't match (e.g. because of a custom template that does something that we
+can't split), it falls back to rendering the full template for every job.
+'''
+import re
+import shlex
+import logging
+
+log = logging.getLogger(__name__)
+
+VARYING = ('job_id', 'args', 'paths', 'params_args', 'cli_args')
+
+_MARKER = '\x00slurmjobs-block:{}\x00'
+_MARKER_RE = re.compile('\x00slurmjobs-block:([^\x00]*)\x00')
+
+
+def _get_source(env, name):
+    '''Get a template's source, skipping loaders without source access (e.g. precompiled templates).'''
+    import jinja2
+    loaders = getattr(env.loader, 'loaders', [env.loader])
+    for loader in loaders:
+        if not loader.has_source_access:
+            continue
+        try:
+            return loader.get_source(env, name)[0]
+        except jinja2.TemplateNotFound:
+            pass
+    raise jinja2.TemplateNotFound(name)
+
+
+def template_chain(env, source) -> list:
+    '''Parse a template and each template that it extends. Returns a list of ``(name, ast)``
+    (the name is None for the initial template), or None if the parent template can't 
+    be determined without rendering.'''
+    from jinja2 import nodes
+    chain = []
+    name = None
+    while source is not None:
+        ast = env.parse(source)
+        chain.append((name, ast))
+        source = None
+        for ext in ast.find_all(nodes.Extends):
+            if not isinstance(ext.template, nodes.Const):
+                return None
+            name = ext.template.value
+            source = _get_source(env, name)
+    return chain
+
+
+def _names(node) -> set:
+    '''Get the variable names used in a node, not including nested blocks.'''
+    from jinja2 import nodes
+    names = set()
+    for child in node.iter_child_nodes():
+        if isinstance(child, nodes.Block):
+            continue
+        if isinstance(child, nodes.Name):
+            names.add(child.name)
+        names.update(_names(child))
+    return names
+
+
+def varying_blocks(env, source, varying=VARYING, chain=None) -> set:
+    '''Get the names of the blocks that use any of the ``varying`` variables.
+    Returns None if something outside of a block uses them.'''
+    from jinja2 import nodes
+    chain = chain or template_chain(env, source)
+    if chain is None:
+        return None
+    varying = set(varying)
+    blocks = set()
+    for _, ast in chain:
+        if _names(ast) & varying:
+            return None
+        for block in ast.find_all(nodes.Block):
+            if _names(block) & varying:
+                blocks.add(block.name)
+    return blocks
+
+
+class BatchRenderer:
+    '''Render a template for many jobs where most of the template doesn't change between jobs.
+
+    Arguments:
+        env (jinja2.Environment): The environment.
+        source (str): The template source.
+        varying (list): The variables that change between jobs.
+    '''
+    def __init__(self, env, source, varying=VARYING):
+        self.template = env.from_string(source)
+        self.varying = set(varying)
+        chain = template_chain(env, source)
+        self.blocks = varying_blocks(env, source, varying, chain)
+        self.parents = [env.get_template(name) for name, _ in chain[1:]] if self.blocks is not None else []
+        self.segments = None
+
+    def __call__(self, **variables) -> str:
+        if self.blocks is None:
+            return self.template.render(**variables)
+        if self.segments is None:
+            # render the batch-invariant parts and check that it works for the first job
+            self.segments = self.prepare(**{
+                k: v for k, v in variables.items() if k not in self.varying})
+            full = self.template.render(**variables)
+            if self.render(**variables) != full:
+                log.debug('Split rendering did not match the full template. Rendering the full template for each job.')
+                self.blocks = None
+            return full
+        return self.render(**variables)
+
+    def prepare(self, **variables) -> list:
+        '''Render the template without the job-specific blocks. Returns a list alternating
+        between rendered text and the names of the blocks to render for each job.'''
+        ctx = self.template.new_context(variables)
+        # the parent templates' blocks are added after these when rendering
+        for name in self.blocks:
+            ctx.blocks[name] = [lambda context, name=name: iter([_MARKER.format(name)])]
+        return _MARKER_RE.split(''.join(self.template.root_render_func(ctx)))
+
+    def render(self, **variables) -> str:
+        '''Render a job, using the prepared segments.'''
+        ctx = self.template.new_context(variables)
+        for parent in self.parents:
+            for name, block in parent.blocks.items():
+                ctx.blocks.setdefault(name, []).append(block)
+        return ''.join(
+            s if i % 2 == 0 else ''.join(ctx.blocks[s][0](ctx))
+            for i, s in enumerate(self.segments))
+
+
+class _JobVariable:
+    '''A placeholder for a job-specific variable that raises an error if it's used.'''
+    def __init__(self, name):
+        self._name = name
+
+    def _error(self, *a, **kw):
+        raise ValueError(
+            f'The template uses {self._name!r} outside of the header and command blocks, '
+            'so its environment setup can\'t be shared between jobs.')
+
+    __str__ = __bool__ = __iter__ = __len__ = __call__ = __getitem__ = _error
+
+    def __getattr__(self, name):
+        self._error()
+
+
+class PreludeRenderer:
+    '''Split a job template into a prelude that's shared by every job in a batch 
+    (e.g. ``common.sh``) and a short job script that sources it.
+
+    The prelude defines a function containing the template's ``body`` block (changing 
+    directories, loading modules, activating conda, entering the singularity container, 
+    etc.) where the ``command`` block runs the command that's passed to it. Each job script 
+    is the ``header`` block followed by its rendered ``command`` block as a single quoted string,
+    so that commands with environment variables, ``&&``, pipes or redirects still run entirely 
+    inside the function (and container):
+
+    .. code-block:: bash
+
+        . path/to/common.sh
+        slurmjobs_run 'FOO=1 python train.py --a=1 > out.txt'
+
+    Arguments:
+        env (jinja2.Environment): The environment.
+        source (str): The template source.
+        function (str): The name of the shell function.
+    '''
+    def __init__(self, env, source, function='slurmjobs_run'):
+        self.template = env.from_string(source)
+        chain = template_chain(env, source)
+        if chain is None:
+            raise ValueError("Can't use a prelude with a template that has a dynamic parent template.")
+        self.parents = [env.get_template(name) for name, _ in chain[1:]]
+        self.function = function
+        missing = {'header', 'body', 'command'} - set(self._context({}).blocks)
+        if missing:
+            raise ValueError(f"Can't use a prelude with a template without the {missing} blocks.")
+
+    def _context(self, variables, **blocks):
+        ctx = self.template.new_context(variables)
+        for parent in self.parents:
+            for name, block in parent.blocks.items():
+                ctx.blocks.setdefault(name, []).append(block)
+        for name, text in blocks.items():
+            ctx.blocks[name] = [lambda context, text=text: iter([text])]
+        return ctx
+
+    def prelude(self, run='eval "$1"', **variables) -> str:
+        '''Render the prelude.
+
+        Arguments:
+            run (str): What to put in the ``command`` block. This should run the command passed
+                to the function as its first argument (``eval "$1"``). If the body passes the command 
+                into a heredoc (e.g. for singularity) it can be pasted in as is (``$1``).
+            **variables: The batch variables. The job variables are not allowed.
+        '''
+        variables.update({k: _JobVariable(k) for k in VARYING})
+        ctx = self._context(variables, command=run + '\n')
+        body = ''.join(ctx.blocks['body'][0](ctx))
+        return f'# shared by the jobs in this batch\n{self.function}() {{\n{body.strip()}\n}}\n'
+
+    def __call__(self, prelude_path, **variables) -> str:
+        '''Render a job script that sources the prelude.'''
+        ctx = self._context(variables)
+        command = ''.join(ctx.blocks['command'][0](ctx)).strip()
+        ctx = self._context(variables, body=f'. {shlex.quote(str(prelude_path))}\n{self.function} {shlex.quote(command)}\n')
+        return ''.join(self.template.root_render_func(ctx))
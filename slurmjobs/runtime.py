@@ -0,0 +1,215 @@
+'''Job-side helpers
+
+These are meant to be used inside of your job script so they only depend on
+the standard library.
+
+.. code-block:: python
+
+    import slurmjobs.runtime
+
+    if __name__ == '__main__':
+        # replaces --params-file=... with the job's arguments
+        slurmjobs.runtime.expand_argv()
+        fire.Fire(main)
+
+Params tables (``Jobs(params_file='table')``) are written with an offset index
+(``params.jsonl.idx``) so that a job can look up its row with a seek and a 
+single row decode, instead of parsing the whole table. If no row index is passed,
+the job's ``SLURM_ARRAY_TASK_ID`` is used.
+
+.. code-block:: python
+
+    # get the params for this array task
+    args, kwargs = slurmjobs.runtime.get_params(path='jobs/train/params.jsonl')
+
+'''
+import os
+import sys
+import json
+import mmap
+import struct
+
+
+PARAMS_FILE_ARG = '--params-file'
+PARAMS_INDEX_ARG = '--params-index'
+INDEX_ENV_VARS = ['SLURM_ARRAY_TASK_ID']
+
+# the offset index is a flat array of (n_rows + 1) little-endian uint64 byte offsets
+INDEX_FORMAT = '<Q'
+INDEX_ITEM_SIZE = struct.calcsize(INDEX_FORMAT)
+
+
+def index_path(path):
+    '''The path of the offset index for a params table.'''
+    return f'{path}.idx'
+
+
+def pack_index(offsets) -> bytes:
+    '''Get the contents of the offset index for a table. ``offsets`` should contain 
+    the start of each row followed by the end of the last row.'''
+    return struct.pack(f'<{len(offsets)}Q', *offsets)
+
+
+def write_index(path, offsets):
+    '''Write the offset index for a table. See :func:`pack_index`.'''
+    with open(index_path(path), 'wb') as f:
+        f.write(pack_index(offsets))
+
+
+def _mmap(f):
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ParamTable:
+    '''Random access to the rows of a params table using its offset index.
+
+    .. code-block:: python
+
+        with ParamTable('jobs/train/params.jsonl') as table:
+            print(len(table), table[5]['kwargs'])
+
+    Arguments:
+        path (str): The params table.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f, open(index_path(path), 'rb') as fi:
+            # mmap can't map empty files
+            self.data = _mmap(f) if os.fstat(f.fileno()).st_size else b''
+            self.index = _mmap(fi) if os.fstat(fi.fileno()).st_size else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def close(self):
+        for m in (self.data, self.index):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+    def __len__(self):
+        return max(len(self.index) // INDEX_ITEM_SIZE - 1, 0)
+
+    def get_bytes(self, i) -> bytes:
+        '''Get the raw bytes of a row.'''
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f'No row {i} in {self.path} ({len(self)} rows)')
+        start, end = struct.unpack_from('<2Q', self.index, i * INDEX_ITEM_SIZE)
+        return self.data[start:end]
+
+    def __getitem__(self, i) -> dict:
+        return json.loads(self.get_bytes(i))
+
+
+def get_index(index=None):
+    '''Get the row index for this job. Either the explicit index or ``SLURM_ARRAY_TASK_ID``.'''
+    if index is not None:
+        return int(index)
+    for k in INDEX_ENV_VARS:
+        if os.getenv(k):
+            return int(os.environ[k])
+    return None
+
+
+def load_params(path, index=None) -> dict:
+    '''Load the params record for a job.
+
+    Arguments:
+        path (str): The params file (or params table).
+        index (int): The row to read from a params table. By default, this uses 
+            ``SLURM_ARRAY_TASK_ID``. This is ignored for single job params files.
+
+    Returns:
+        dict: with ``job_id``, ``argv`` (the formatted command-line arguments),
+        ``args`` (positional arguments), and ``kwargs`` (keyword arguments).
+    '''
+    if os.path.isfile(index_path(path)):
+        index = get_index(index)
+        if index is None:
+            raise ValueError(
+                f'{path} is a params table, but no row index was given '
+                f'(using {PARAMS_INDEX_ARG} or {INDEX_ENV_VARS}).')
+        with ParamTable(path) as table:
+            return table[index]
+
+    with open(path, 'r') as f:
+        if index is None:
+            return json.load(f)
+        # a table without an offset index
+        for i, line in enumerate(f):
+            if i == int(index):
+                return json.loads(line)
+    raise IndexError(f'No row {index} in {path}')
+
+
+def _pop_flag(argv, name):
+    '''Remove a flag (``--name=value`` or ``--name value``) from argv. Returns (position, value).'''
+    for i, x in enumerate(argv):
+        if x == name and i + 1 < len(argv):
+            value = argv[i + 1]
+            del argv[i:i + 2]
+            return i, value
+        if x.startswith(name + '='):
+            del argv[i]
+            return i, x[len(name) + 1:]
+    return None, None
+
+
+def expand_argv(argv=None) -> list:
+    '''Replace ``--params-file`` (and ``--params-index``) with the job's arguments.
+
+    Arguments:
+        argv (list): The arguments to expand. By default, this will
+            modify ``sys.argv`` in place.
+
+    Returns:
+        list: The expanded argv.
+    '''
+    argv = sys.argv if argv is None else argv
+    i, path = _pop_flag(argv, PARAMS_FILE_ARG)
+    if path is None:
+        return argv
+    _, index = _pop_flag(argv, PARAMS_INDEX_ARG)
+    argv[i:i] = load_params(path, index)['argv']
+    return argv
+
+
+def get_params(argv=None, path=None, index=None) -> tuple:
+    '''Get the job's positional and keyword arguments from its params file.
+
+    Arguments:
+        argv (list): The command-line arguments to get ``--params-file`` and 
+            ``--params-index`` from. Defaults to ``sys.argv``.
+        path (str): The params file/table to use instead of ``--params-file``.
+        index (int): The row to use instead of ``--params-index``/``SLURM_ARRAY_TASK_ID``.
+
+    Returns:
+        tuple: ``(args, kwargs)``
+    '''
+    argv = list(sys.argv if argv is None else argv)
+    _, argv_path = _pop_flag(argv, PARAMS_FILE_ARG)
+    _, argv_index = _pop_flag(argv, PARAMS_INDEX_ARG)
+    path = path or argv_path
+    if path is None:
+        raise ValueError(f'No {PARAMS_FILE_ARG} argument was passed.')
+    params = load_params(path, argv_index if index is None else index)
+    return params['args'], params['kwargs']
+
+
+def load_array(value, mmap_mode='r'):
+    '''Load an array argument that was written to a sidecar ``.npy`` file (see ``Jobs(npy_threshold=...)``).
+    Values that aren't ``.npy`` paths (e.g. small arrays that were passed inline) are converted using ``np.asarray``.
+
+    Arguments:
+        value (str, list): The argument value.
+        mmap_mode (str): How to memory-map the file. See ``np.load``.
+    '''
+    import numpy as np
+    if isinstance(value, str) and value.endswith('.npy'):
+        return np.load(value, mmap_mode=mmap_mode)
+    return np.asarray(value)
@@ -0,0 +1,394 @@
+'''Job status
+
+When a batch is submitted using its run script, the slurm job ID of each job is appended
+to ``paths.submissions`` (``{job_id}\\t{slurm_id}\\t{time}``). ``jobs.status()`` looks up
+the state of those jobs using one ``sacct`` call (per few thousand jobs) and caches them in a local SQLite
+database (``paths.status_db``), so that:
+
+ - finished jobs are never queried again
+ - each refresh only asks ``sacct`` about jobs that started since the last poll (``--starttime``)
+
+.. code-block:: python
+
+    jobs = slurmjobs.Slurm('python train.py')
+    for job_id, s in jobs.status().items():
+        print(job_id, s['state'], s['elapsed'], s['max_rss'])
+
+The ``sacct`` command can be changed using ``Slurm(sacct_command=...)`` (e.g. to add ``--clusters``
+or to use a fake script for testing).
+'''
+from __future__ import annotations
+import os
+import json
+import time
+import shlex
+import logging
+import subprocess
+
+log = logging.getLogger(__name__)
+
+SACCT_FORMAT = ('JobID', 'State', 'ExitCode', 'Elapsed', 'MaxRSS')
+# states that a job won't leave
+FINISHED = {
+    'COMPLETED', 'FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'CANCELLED',
+    'BOOT_FAIL', 'DEADLINE', 'PREEMPTED', 'REVOKED'}
+_SIZES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40, 'P': 1 << 50}
+
+
+def read_submissions(path) -> dict:
+    '''Read the submission records of a batch. If a job was submitted more than once, the last
+    submission is used. Returns ``{job_id: {'slurm_id': str, 'submitted': float}}``.'''
+    subs = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) >= 2 and parts[1]:
+                    subs[parts[0]] = {
+                        'slurm_id': parts[1],
+                        'submitted': float(parts[2]) if len(parts) > 2 and parts[2] else None}
+    except FileNotFoundError:
+        pass
+    return subs
+
+
+def parse_size(size) -> int|None:
+    '''Parse a sacct memory size (e.g. ``1234K``) as bytes.'''
+    if not size:
+        return None
+    unit = _SIZES.get(size[-1].upper())
+    return int(float(size[:-1]) * unit) if unit else int(float(size))
+
+
+def parse_elapsed(elapsed) -> int|None:
+    '''Parse a sacct duration (``[D-]HH:MM:SS``) as seconds.'''
+    if not elapsed:
+        return None
+    days, _, hms = elapsed.rpartition('-')
+    secs = 0
+    for x in hms.split(':'):
+        secs = secs * 60 + float(x)
+    return int(secs + int(days or 0) * 86400)
+
+
+def parse_sacct(text) -> dict:
+    '''Parse ``sacct --parsable2 --noheader --format=JobID,State,ExitCode,Elapsed,MaxRSS``.
+
+    The state, exit code and elapsed time come from each job's allocation line and
+    ``max_rss`` is the max over its steps (``123.batch``, ``123.0``, ...).
+
+    Returns:
+        dict: ``{slurm_id: {'state', 'exit_code', 'elapsed', 'max_rss'}}``
+    '''
+    jobs = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        row = dict(zip(SACCT_FORMAT, line.split('|')))
+        slurm_id, _, step = row['JobID'].partition('.')
+        job = jobs.setdefault(slurm_id, {'state': None, 'exit_code': None, 'elapsed': None, 'max_rss': None})
+        rss = parse_size(row.get('MaxRSS'))
+        if rss is not None:
+            job['max_rss'] = max(job['max_rss'] or 0, rss)
+        if not step:
+            state = row.get('State', '').split()  # e.g. "CANCELLED by 1234"
+            code = row.get('ExitCode', '').split(':')[0]
+            job['state'] = state[0] if state else None
+            job['exit_code'] = int(code) if code.isdigit() else None
+            job['elapsed'] = parse_elapsed(row.get('Elapsed'))
+    return jobs
+
+
+def run_sacct(slurm_ids, since=None, sacct='sacct', chunk_size=2000) -> dict:
+    '''Get the state of jobs using as few ``sacct`` calls as possible.
+
+    Arguments:
+        slurm_ids (list): The slurm job IDs.
+        since (float): Only get jobs that were running after this time (``--starttime``).
+        sacct (str, list): The sacct command.
+        chunk_size (int): The max number of job IDs per sacct call. The IDs are passed 
+            as a single ``--jobs`` argument, which the OS limits in length (128KiB on linux).
+    '''
+    cmd = shlex.split(sacct) if isinstance(sacct, str) else list(sacct)
+    cmd += ['--parsable2', '--noheader', f'--format={",".join(SACCT_FORMAT)}']
+    if since:
+        cmd.append(f'--starttime={time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(since))}')
+    slurm_ids = list(slurm_ids)
+    jobs = {}
+    for i in range(0, len(slurm_ids), chunk_size):
+        chunk_cmd = cmd + [f'--jobs={",".join(slurm_ids[i:i + chunk_size])}']
+        log.debug('Running: %s (%d jobs)', chunk_cmd[:-1], len(slurm_ids[i:i + chunk_size]))
+        jobs.update(parse_sacct(subprocess.run(chunk_cmd, check=True, capture_output=True, text=True).stdout))
+    return jobs
+
+
+def write_submissions(path, submitted):
+    '''Append submission records (``{job_id: slurm_id}``).'''
+    now = int(time.time())
+    with open(path, 'a') as f:
+        f.write(''.join(f'{job_id}\t{slurm_id}\t{now}\n' for job_id, slurm_id in submitted.items()))
+
+
+def sbatch_options(script) -> dict:
+    '''Get the ``#SBATCH --key=value`` options from a job script.'''
+    options = {}
+    for line in script.splitlines():
+        line = line.strip()
+        if line.startswith('#SBATCH --'):
+            key, _, value = line[len('#SBATCH --'):].partition('=')
+            options[key] = value or None
+        elif line and not line.startswith('#'):
+            break
+    return options
+
+
+def parse_time(t) -> int:
+    '''Parse a slurm time limit (``MM``, ``MM:SS``, ``HH:MM:SS``, ``D-HH``, ``D-HH:MM``, ``D-HH:MM:SS``) as seconds.'''
+    days, _, rest = t.rpartition('-')
+    parts = [float(x) for x in rest.split(':')]
+    if days:
+        h, m, s = (parts + [0, 0])[:3]
+    else:
+        h, m, s = ([0, 0] + parts)[-3:] if len(parts) == 3 else [0] + (parts + [0])[:2]
+    return int(int(days or 0) * 86400 + h * 3600 + m * 60 + s)
+
+
+def format_time(secs) -> str:
+    '''Format seconds as a slurm time limit (``D-HH:MM:SS``).'''
+    secs = int(secs)
+    return f'{secs // 86400}-{secs % 86400 // 3600:02d}:{secs % 3600 // 60:02d}:{secs % 60:02d}'
+
+
+def scale_time(t, factor) -> str:
+    '''Multiply a slurm time limit.'''
+    return format_time(parse_time(t) * factor)
+
+
+def scale_mem(mem, factor) -> str:
+    '''Multiply a slurm memory amount, keeping its units (e.g. ``16GB * 2 -> 32GB``).'''
+    import re
+    import math
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)(.*)', mem.strip())
+    if not m:
+        raise ValueError(f'Could not parse memory: {mem!r}')
+    return f'{math.ceil(float(m.group(1)) * factor)}{m.group(2)}'
+
+
+SCALERS = {'time': scale_time, 'mem': scale_mem, 'mem-per-cpu': scale_mem, 'mem-per-gpu': scale_mem}
+
+
+def bump_options(options, bump) -> dict:
+    '''Multiply sbatch options, e.g. ``bump_options({'mem': '16GB'}, {'mem': 2}) -> {'mem': '32GB'}``.
+    Options that aren't set are skipped.'''
+    options = dict(options)
+    for key, factor in bump.items():
+        if options.get(key):
+            options[key] = SCALERS[key](options[key], factor)
+        else:
+            log.warning("Can't increase %s because it isn't set in the job script.", key)
+    return options
+
+
+class StatusCache:
+    '''A local SQLite cache of slurm job states.
+
+    Arguments:
+        path (str): The database path.
+        sacct (str, list): The sacct command.
+        overlap (float): How many seconds before the last poll to ask sacct for, to allow
+            for clock differences between this machine and the slurm controller.
+    '''
+    timeout = 60
+    chunk_size = 450
+
+    def __init__(self, path, sacct='sacct', overlap=60):
+        self.path = str(path)
+        self.sacct = sacct
+        self.overlap = overlap
+        self._conn = None
+
+    def connect(self):
+        if self._conn is None:
+            import sqlite3
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS jobs (slurm_id TEXT PRIMARY KEY, base_id TEXT, '
+                    'state TEXT, exit_code INTEGER, elapsed INTEGER, max_rss INTEGER, updated REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS jobs_base_id ON jobs (base_id)')
+                conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @property
+    def last_poll(self) -> float|None:
+        '''When sacct was last polled.'''
+        row = self.connect().execute("SELECT value FROM meta WHERE key = 'last_poll'").fetchone()
+        return float(row[0]) if row else None
+
+    def get(self, slurm_ids) -> dict:
+        '''Get the cached state of jobs (including array tasks, e.g. ``123_4`` for ``123``, or a single task).
+        Returns ``{slurm_id: {'slurm_id', 'state', 'exit_code', 'elapsed', 'max_rss'}}``.'''
+        conn = self.connect()
+        ids = list(slurm_ids)
+        rows = {}
+        for i in range(0, len(ids), self.chunk_size):
+            chunk = ids[i:i + self.chunk_size]
+            for slurm_id, state, code, elapsed, rss in conn.execute(
+                    'SELECT slurm_id, state, exit_code, elapsed, max_rss FROM jobs '
+                    f'WHERE base_id IN ({", ".join("?" * len(chunk))}) OR slurm_id IN ({", ".join("?" * len(chunk))})', 
+                    chunk + chunk):
+                rows[slurm_id] = {
+                    'slurm_id': slurm_id, 'state': state, 'exit_code': code,
+                    'elapsed': elapsed, 'max_rss': rss}
+        return rows
+
+    def update(self, jobs, polled=None):
+        '''Store job states (from :func:`parse_sacct`).'''
+        now = time.time()
+        with self.connect() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                    (slurm_id, slurm_id.split('_')[0], j['state'], j['exit_code'], j['elapsed'], j['max_rss'], now)
+                    for slurm_id, j in jobs.items()])
+            if polled is not None:
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_poll', ?)", (str(polled),))
+
+    def refresh(self, slurm_ids, since=None) -> dict:
+        '''Poll sacct for the jobs that haven't finished yet.
+
+        Arguments:
+            slurm_ids (list): The slurm job IDs.
+            since (float): The earliest time to ask sacct for on the first poll (e.g. when the batch was submitted).
+
+        Returns:
+            dict: The updated states (see :meth:`get`).
+        '''
+        known = self.get(slurm_ids)
+        finished = {}  # array jobs are finished once all of their tasks are
+        for slurm_id, j in known.items():
+            for i in {slurm_id, slurm_id.split('_')[0]}:
+                finished[i] = finished.get(i, True) and j['state'] in FINISHED
+        unfinished = [i for i in dict.fromkeys(slurm_ids) if not finished.get(i)]
+        if not unfinished:
+            return known
+
+        now = time.time()
+        last_poll = self.last_poll
+        if last_poll is not None:
+            since = max(last_poll - self.overlap, since or 0)
+        self.update(run_sacct(unfinished, since, self.sacct), polled=now)
+        return self.get(slurm_ids)
+
+
+def watch(get_status, interval=30, max_interval=600, backoff=2, timeout=None, 
+          on_change=None, on_start=None, on_fail=None, on_complete=None, on_finish=None, 
+          sleep=time.sleep) -> dict:
+    '''Poll the state of a batch until all of its submitted jobs have finished, calling 
+    callbacks when jobs change state.
+
+    The batch is polled once per ``interval`` seconds. Whenever nothing changes, the 
+    interval is multiplied by ``backoff`` (up to ``max_interval``), and it goes back to 
+    ``interval`` after a change. Jobs that have already finished are reported on the first poll.
+
+    Arguments:
+        get_status (callable): Get the batch's states (e.g. ``jobs.status``).
+        interval (float): The initial number of seconds between polls.
+        max_interval (float): The max number of seconds between polls.
+        backoff (float): How much to increase the interval by when nothing changes.
+        timeout (float): Raise a ``TimeoutError`` if the batch hasn't finished after this many seconds.
+        on_change (callable): ``on_change(job_id, old_state, new_state)`` for every change.
+        on_start (callable): ``on_start(job_id, status)`` when a job starts running.
+        on_fail (callable): ``on_fail(job_id, status)`` when a job finishes without completing.
+        on_complete (callable): ``on_complete(job_id, status)`` when a job completes.
+        on_finish (callable): ``on_finish(statuses)`` when all of the submitted jobs have finished.
+
+    Returns:
+        dict: The final states (see ``jobs.status()``).
+    '''
+    previous = {}
+    delay = interval
+    start = time.time()
+    while True:
+        statuses = get_status()
+        changed = False
+        for job_id, s in statuses.items():
+            old, new = (previous.get(job_id) or {}).get('state'), s['state']
+            if old == new:
+                continue
+            changed = True
+            log.debug('%s: %s -> %s', job_id, old, new)
+            if on_change is not None:
+                on_change(job_id, old, new)
+            if new == 'RUNNING' and on_start is not None:
+                on_start(job_id, s)
+            elif new == 'COMPLETED' and on_complete is not None:
+                on_complete(job_id, s)
+            elif new in FINISHED and new != 'COMPLETED' and on_fail is not None:
+                on_fail(job_id, s)
+        previous = statuses
+
+        submitted = [s for s in statuses.values() if s['state'] is not None]
+        if submitted and all(s['state'] in FINISHED for s in submitted):
+            if on_finish is not None:
+                on_finish(statuses)
+            return statuses
+
+        delay = interval if changed else min(delay * backoff, max_interval)
+        if timeout is not None and time.time() + delay - start > timeout:
+            raise TimeoutError(f'The batch did not finish within {timeout} seconds.')
+        sleep(delay)
+
+
+def read_settings(batch_dir) -> dict:
+    '''Read the settings that a batch was generated with (see ``Jobs.batch_settings``).
+    For batches generated before they were stored, the archive is detected from the batch's files.'''
+    try:
+        with open(os.path.join(batch_dir, 'settings.json'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'archive': os.path.isfile(os.path.join(batch_dir, 'jobs.archive'))}
+
+
+def watch_batch(batch_dir, interval=30, max_interval=600, timeout=None, sacct='sacct', fanout=None, archive=None):
+    '''Watch a batch from the command line, printing each job's state changes.
+
+    .. code-block:: bash
+
+        python -m slurmjobs watch jobs/train --interval=60
+
+    The batch's ``fanout`` and ``archive`` settings are read from the batch directory 
+    (``settings.json``, written by ``generate()``).
+
+    Arguments:
+        batch_dir (str): The batch directory (``{root_dir}/{name}``).
+        interval (float): The initial number of seconds between polls.
+        max_interval (float): The max number of seconds between polls.
+        timeout (float): Stop watching after this many seconds.
+        sacct (str): The sacct command.
+        fanout (int): Override the ``fanout`` that the batch was generated with.
+        archive (bool): Override whether the batch was generated with ``archive=True``.
+    '''
+    import collections
+    from .core import Slurm
+    batch_dir = os.path.abspath(batch_dir)
+    settings = read_settings(batch_dir)
+    if fanout is not None:
+        settings['fanout'] = fanout
+    if archive is not None:
+        settings['archive'] = archive
+    jobs = Slurm(
+        None, name=os.path.basename(batch_dir), root_dir=os.path.dirname(batch_dir), 
+        backup=False, sacct_command=sacct, fanout=settings.get('fanout', 0), archive=settings['archive'])
+    jobs.fanout_width = settings.get('fanout_width', jobs.fanout_width)
+    statuses = watch(
+        jobs.status, interval=interval, max_interval=max_interval, timeout=timeout,
+        on_change=lambda job_id, old, new: print(f'{time.strftime("%H:%M:%S")} {job_id}: {old} -> {new}', flush=True))
+    counts = collections.Counter(s['state'] or 'not submitted' for s in statuses.values())
+    print('finished:', ', '.join(f'{n} {state}' for state, n in counts.most_common()))
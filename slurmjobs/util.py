@@ -2,6 +2,7 @@ import os
 import sys
 import json
 import shlex
+import struct
 import types
 import itertools
 import collections
@@ -60,6 +61,137 @@ def maybe_backup(path, prefix='~'):
 
 
 
+def backup(path):
+    '''Move a path out of the way like ``pathtrees.backup`` (e.g. ``train`` -> ``train_01``) and
+    record the backup so that :func:`find_backups` can tell it apart from other directories 
+    that happen to look like one (e.g. a batch called ``train_2024``).
+
+    Returns:
+        str: The backup path (None if the path didn't exist).
+    '''
+    import pathtrees
+    path = os.path.abspath(str(path))
+    if not os.path.exists(path):
+        return None
+    bkp = pathtrees.next_unique(path)
+    os.rename(path, bkp)
+    with open(_backup_record(path), 'a') as f:
+        f.write(os.path.basename(bkp) + '\n')
+    return bkp
+
+
+def _backup_record(path):
+    parent, name = os.path.split(path)
+    return os.path.join(parent, f'.{name}.backups')
+
+
+def _read_backup_record(path):
+    try:
+        with open(_backup_record(path)) as f:
+            return [l.strip() for l in f if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def find_backups(path) -> list:
+    '''Find the backups of a path made by :func:`backup` (e.g. ``train_01``, ``train_02``),
+    oldest first (by modification time).'''
+    import re
+    path = os.path.abspath(str(path))
+    parent, name = os.path.split(path)
+    # the name pathtrees.next_unique gives: {root}_{i:02}{ext}
+    root, ext = os.path.splitext(name)
+    pattern = re.compile(re.escape(root) + r'_(0[1-9]|[1-9]\d+)' + re.escape(ext))
+    found = [os.path.join(parent, f) for f in dict.fromkeys(_read_backup_record(path)) if pattern.fullmatch(f)]
+    found = [p for p in found if os.path.exists(p)]
+    return sorted(found, key=os.path.getmtime)
+
+
+def prune_backups(path, keep=None, max_age=None, background='thread') -> list:
+    '''Remove old backups of a path.
+
+    Arguments:
+        path (str): The original path.
+        keep (int): The number of backups to keep (the most recent). None keeps all of them.
+        max_age (float): Remove backups that haven't been modified in this many seconds.
+        background (str): How to remove the backups. See :func:`remove_dirs`.
+
+    Returns:
+        list: The backups that were removed.
+    '''
+    import time
+    path = os.path.abspath(str(path))
+    backups = find_backups(path)
+    remove = []
+    if keep is not None:
+        remove, backups = backups[:max(len(backups) - keep, 0)], backups[max(len(backups) - keep, 0):]
+    if max_age is not None:
+        now = time.time()
+        remove += [p for p in backups if now - os.path.getmtime(p) > max_age]
+    # and anything left over from an interrupted removal
+    parent, name = os.path.split(path)
+    leftover = [os.path.join(parent, f) for f in os.listdir(parent) if f.startswith(f'.{name}.removing-')] if os.path.isdir(parent) else []
+    remove_dirs(remove + leftover, background=background)
+    if remove:
+        # forget them, so a directory that reuses the name later isn't mistaken for a backup
+        removed = {os.path.basename(p) for p in remove}
+        names = [n for n in _read_backup_record(path) if n not in removed]
+        with open(_backup_record(path), 'w') as f:
+            f.writelines(f'{n}\n' for n in names)
+    return remove
+
+
+def remove_dirs(paths, background='thread'):
+    '''Remove directories. They're first renamed to hidden ``.{name}.removing-*`` directories
+    (which is fast) and then deleted, optionally without waiting for it to finish.
+
+    Arguments:
+        paths (list): The directories to remove.
+        background (str): ``'thread'`` to delete them in a background thread (which will finish before 
+            python exits), ``'process'`` to delete them in a detached process (which can outlive python), 
+            or False to delete them before returning.
+
+    Returns:
+        The thread or process doing the deleting (if any).
+    '''
+    import uuid
+    import shutil
+    trash = []
+    for path in paths:
+        parent, name = os.path.split(os.path.abspath(str(path)))
+        if name.startswith('.') and '.removing-' in name:
+            trash.append(path)
+            continue
+        dest = os.path.join(parent, f'.{name}.removing-{uuid.uuid4().hex[:8]}')
+        try:
+            os.rename(path, dest)
+        except FileNotFoundError:
+            continue
+        except OSError:  # can't rename it, so just delete it now
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        trash.append(dest)
+    if not trash:
+        return None
+
+    if background == 'process':
+        import subprocess
+        return subprocess.Popen(
+            [sys.executable, '-c', 'import sys, shutil\nfor p in sys.argv[1:]: shutil.rmtree(p, ignore_errors=True)', *trash],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, 
+            start_new_session=True)
+    if background:
+        import threading
+        thread = threading.Thread(
+            target=lambda: [shutil.rmtree(p, ignore_errors=True) for p in trash], 
+            name='slurmjobs-remove-dirs')
+        thread.start()
+        return thread
+    for p in trash:
+        shutil.rmtree(p, ignore_errors=True)
+    return None
+
+
 def prettyjson(value):
     '''Pretty-print data using json.'''
     return json.dumps(value, sort_keys=True, indent=4) if value else ''
@@ -185,6 +317,16 @@ def subclass_lookup(cls, prefix='', suffix='', name_override=None):
         if not c.__name__.startswith('_')}
 
 
+def import_string(path):
+    '''Import an object from a string like ``'package.module:attr'`` (or ``'package.module.attr'``).'''
+    import importlib
+    module, _, attr = path.partition(':') if ':' in path else path.rpartition('.')
+    obj = importlib.import_module(module)
+    for a in attr.split('.') if attr else ():
+        obj = getattr(obj, a)
+    return obj
+
+
 def shlex_repr(v):
     '''Prepare a variable for bash. This will serialize the object using json 
     and then quote the variable if it contains any spaces/bash-specific characters.
@@ -197,6 +339,25 @@ def shlex_repr(v):
         v = v[1:-1]
     return shlex.quote(v) # only quote if necessary (has spaces or bash chars)
 
+_ATOMIC_TYPES = (str, int, float, bool, bytes, type(None))
+
+def typed_key(v):
+    '''Get a hashable key for a value that also keeps track of its type, so that
+    values that compare equal (e.g. ``1``, ``1.0``, and ``True``) get different keys.
+    Raises a TypeError for anything that isn't a simple immutable value.
+    '''
+    t = type(v)
+    if t is float:
+        # by bits - -0.0 == 0.0 and nan != nan, but they're formatted differently
+        return t, struct.pack('<d', v)
+    if t in _ATOMIC_TYPES:
+        return t, v
+    if t is tuple:
+        return t, tuple(typed_key(x) for x in v)
+    if t is frozenset:
+        return t, frozenset(typed_key(x) for x in v)
+    raise TypeError(f"Can't make a typed key for {t.__name__}")
+
 def json_safe_numpy(obj):
     if 'numpy' in sys.modules:  # don't need to check if it's not imported
         import numpy as np
@@ -0,0 +1,28 @@
+
+#########################
+#
+# Job Batch: some.thing
+# Params:
+# [
+#   ('kernel_size', [2, 3, 5]),
+#   ('nb_stacks', [1, 2]),
+#   ('lr', [0.0001, 0.001]),
+# ]
+#
+#########################
+
+
+
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-2,nb_stacks-1,lr-0.0001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-2,nb_stacks-1,lr-0.001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-2,nb_stacks-2,lr-0.0001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-2,nb_stacks-2,lr-0.001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-3,nb_stacks-1,lr-0.0001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-3,nb_stacks-1,lr-0.001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-3,nb_stacks-2,lr-0.0001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-3,nb_stacks-2,lr-0.001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-5,nb_stacks-1,lr-0.0001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-5,nb_stacks-1,lr-0.001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-5,nb_stacks-2,lr-0.0001.job.sh"
+. "/root/package/tests/shell/some.thing/some.thing,kernel_size-5,nb_stacks-2,lr-0.001.job.sh"
+
@@ -0,0 +1,41 @@
+#!/bin/bash
+#########################
+#
+# Job: some.thing,kernel_size-3,nb_stacks-1,lr-0.0001
+# Args: 
+# {'job_id': 'some.thing,kernel_size-3,nb_stacks-1,lr-0.0001',
+#  'kernel_size': 3,
+#  'lr': 0.0001,
+#  'nb_stacks': 1,
+#  'receptive_field': 6}
+#
+#########################
+
+
+. ~/.bashrc
+
+
+##### activate conda environment
+    conda deactivate
+    conda activate dfakjsdfhajkh43981hrt4138r91gh4
+
+
+
+
+TMP_SCRIPT="__some.thing,kernel_size-3,nb_stacks-1,lr-0.0001.tmp.sh"
+cat << EOF > $TMP_SCRIPT
+
+python /some/thing.py train \
+    --kernel_size=3 \
+    --nb_stacks=1 \
+    --lr=0.0001 \
+    --receptive_field=6 \
+    --job_id=some.thing,kernel_size-3,nb_stacks-1,lr-0.0001
+
+
+
+rm $TMP_SCRIPT
+EOF
+
+chmod +x "$TMP_SCRIPT"
+. $TMP_SCRIPT
@@ -0,0 +1,45 @@
+
+#########################
+#
+# Job Batch: some.thing-gpu2
+# Params:
+# [
+#   ('kernel_size', [2, 3, 5]),
+#   ('nb_stacks', [1, 2]),
+#   ('lr', [0.0001, 0.001]),
+# ]
+#
+#########################
+
+
+
+# record the slurm job ID for each job (see jobs.status())
+submit() {
+    local job_id="$1" script="$2" slurm_id dep deps=""
+    shift 2
+    for dep in "$@"; do
+        case "$dep" in
+            *: | *::*) echo "Not submitting $job_id: the jobs it depends on ($dep) haven't been submitted." >&2; return 1;;
+        esac
+        deps="${deps:+$deps,}$dep"
+    done
+    slurm_id=$(sbatch --parsable ${deps:+"--dependency=$deps"} ${script:+"$script"}) || return
+    slurm_id="${slurm_id%%;*}"
+    [ -n "$slurm_id" ] || return 0
+    echo "Submitted batch job $slurm_id"
+    printf '%s\t%s\t%s\n' "$job_id" "$slurm_id" "$(date +%s)" >> "/root/package/tests/sing/some.thing-gpu2/submissions.tsv"
+}
+
+submit "some.thing-gpu2,kernel_size-2,nb_stacks-1,lr-0.0001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-2,nb_stacks-1,lr-0.0001.sbatch"
+submit "some.thing-gpu2,kernel_size-2,nb_stacks-1,lr-0.001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-2,nb_stacks-1,lr-0.001.sbatch"
+submit "some.thing-gpu2,kernel_size-2,nb_stacks-2,lr-0.0001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-2,nb_stacks-2,lr-0.0001.sbatch"
+submit "some.thing-gpu2,kernel_size-2,nb_stacks-2,lr-0.001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-2,nb_stacks-2,lr-0.001.sbatch"
+submit "some.thing-gpu2,kernel_size-3,nb_stacks-1,lr-0.0001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-3,nb_stacks-1,lr-0.0001.sbatch"
+submit "some.thing-gpu2,kernel_size-3,nb_stacks-1,lr-0.001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-3,nb_stacks-1,lr-0.001.sbatch"
+submit "some.thing-gpu2,kernel_size-3,nb_stacks-2,lr-0.0001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-3,nb_stacks-2,lr-0.0001.sbatch"
+submit "some.thing-gpu2,kernel_size-3,nb_stacks-2,lr-0.001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-3,nb_stacks-2,lr-0.001.sbatch"
+submit "some.thing-gpu2,kernel_size-5,nb_stacks-1,lr-0.0001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-5,nb_stacks-1,lr-0.0001.sbatch"
+submit "some.thing-gpu2,kernel_size-5,nb_stacks-1,lr-0.001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-5,nb_stacks-1,lr-0.001.sbatch"
+submit "some.thing-gpu2,kernel_size-5,nb_stacks-2,lr-0.0001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-5,nb_stacks-2,lr-0.0001.sbatch"
+submit "some.thing-gpu2,kernel_size-5,nb_stacks-2,lr-0.001" "/root/package/tests/sing/some.thing-gpu2/some.thing-gpu2,kernel_size-5,nb_stacks-2,lr-0.001.sbatch"
+
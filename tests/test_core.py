@@ -211,6 +211,60 @@ def test_arg_format():
 
 
 
+def test_arg_registry(monkeypatch):
+    Args = slurmjobs.args.Argument
+    assert {'fire', 'argparse', 'sacred', 'hydra'} <= set(Args._registry)
+    # don't leak the formatters registered here into other tests
+    monkeypatch.setattr(Args, '_registry', dict(Args._registry))
+
+    class _MyArgument(slurmjobs.args.FireArgument, name='mine', aliases=('MY',)):
+        kw_fmt = '--{key} {value}'
+    assert isinstance(Args.get('mine'), _MyArgument)
+    assert isinstance(Args.get('my'), _MyArgument)
+    assert Args.get('my')(a=5) == '--a 5'
+
+    # lazy registration
+    Args.register('lazy-sacred', formatter='slurmjobs.args:SacredArgument')
+    assert isinstance(Args.get('lazy-sacred'), slurmjobs.args.SacredArgument)
+
+    # only subclasses of the class you're looking up from
+    with pytest.raises(KeyError):
+        slurmjobs.args.FireArgument.get('argparse')
+    with pytest.raises(KeyError):
+        Args.get('not-a-formatter')
+
+
+def test_arg_format_cache():
+    Args = slurmjobs.args.Argument
+    fire = Args.get('fire')
+    # values that compare equal but format differently shouldn't collide
+    assert fire(a=1, b=True, c=1.0, d=(1, True), e=(1, 1)) == "--a=1 --b=true --c=1.0 --d='[1, true]' --e='[1, 1]'"
+    assert fire(a=True, b=1) == '--a=true --b=1'
+    assert fire(lr=-0.0) == '--lr=-0.0' and fire(lr=0.0) == '--lr=0.0'
+    assert fire(lr=(0.0, -0.0)) == "--lr='[0.0, -0.0]'" and fire(lr=(-0.0, 0.0)) == "--lr='[-0.0, 0.0]'"
+
+    # the cache is bounded
+    fire.cache_size = 3
+    fire(*range(10))
+    assert len(fire._value_cache) == 3
+
+    # batch formatting matches formatting one at a time
+    items = list(slurmjobs.Grid([('a', [1, 2]), ('b', ['x', 'y z']), ('*', [['f1', 'f2']])]))
+    for name in ['fire', 'argparse', 'sacred', 'hydra']:
+        cli = Args.get(name)
+        expected = [cli(d, 'extra', indent=4, c=[1, 2], a=5) for d in items]
+        assert cli.format_batch(items, 'extra', indent=4, c=[1, 2], a=5) == expected
+
+    # including plain dicts and nested values
+    items = list(slurmjobs.Grid([('a', [1, {'x': {'y': [1, 2]}}]), ('b', [(1, 2.5), None, 'y z'])])) + [
+        {'a': {'x': 1}, 'c': False}, {'d': True, 'e': -0.0}, {}]
+    for name in ['fire', 'argparse', 'sacred', 'hydra']:
+        cli = Args.get(name)
+        expected = [cli(*getattr(i, 'positional', ()), **i) for i in items]
+        assert cli.format_batch(items) == expected
+        assert cli.format_batch(items, indent=4) == [cli(*getattr(i, 'positional', ()), indent=4, **i) for i in items]
+
+
 # def test_multicmd_arg_format():
 #     Args = slurmjobs.args.Argument
 
@@ -323,3 +377,586 @@ def test_receipts(tmpdir):
     assert os.path.isfile(out_file)
 
     assert set(r.meta) == {'duration_secs', 'time'}
+
+
+def test_precompiled_templates(tmpdir, monkeypatch):
+    import shutil
+    import jinja2
+    from slurmjobs import core, precompile
+    template_dir = os.path.join(tmpdir, 'templates')
+    compiled_dir = os.path.join(tmpdir, 'compiled')
+    shutil.copytree(precompile.TEMPLATE_DIR, template_dir)
+    assert not precompile.is_current(compiled_dir, template_dir)
+    precompile.compile_templates(compiled_dir=compiled_dir, template_dir=template_dir)
+    assert precompile.is_current(compiled_dir, template_dir)
+    loaders = precompile.get_loaders(compiled_dir, template_dir)
+    assert isinstance(loaders[0], jinja2.ModuleLoader)
+
+    # the compiled templates render the same scripts
+    source_env = core.create_env(compiled=False)
+    compiled_env = source_env.overlay(loader=jinja2.ChoiceLoader(loaders[:1]))
+    for cls, kw in [
+            (slurmjobs.Slurm, {}), (slurmjobs.Shell, {}), 
+            (slurmjobs.Singularity, {'overlay': 'overlay.ext3', 'sif': 'cuda.sif'})]:
+        jobs = cls('python train.py', root_dir=os.path.join(tmpdir, 'jobs'), backup=False, **kw)
+        outputs = []
+        for env in [source_env, compiled_env]:
+            monkeypatch.setattr(core, 'get_template', lambda source: env.from_string(source))
+            _, (job_path,) = jobs.generate(a=[1])
+            outputs.append((pathtrees.Path(job_path).read_text(), jobs.paths.run.read_text()))
+        assert outputs[0] == outputs[1]
+
+    # editing a template invalidates them
+    with open(os.path.join(template_dir, 'job.base.j2'), 'a') as f:
+        f.write('\n# edited\n')
+    assert not precompile.is_current(compiled_dir, template_dir)
+    assert not any(isinstance(l, jinja2.ModuleLoader) for l in precompile.get_loaders(compiled_dir, template_dir))
+
+
+@pytest.mark.parametrize("cls,kw", [
+    (slurmjobs.Slurm, {'modules': ['cuda11'], 'conda_env': 'myenv', 'email': 'me@nyu.edu'}), 
+    (slurmjobs.Shell, {'conda_env': 'myenv'}), 
+    (slurmjobs.Singularity, {'overlay': 'overlay.ext3', 'sif': 'cuda.sif'}),
+])
+def test_split_render(tmpdir, cls, kw):
+    from slurmjobs.render import BatchRenderer
+    grid = [('a', [1, 2, 3]), ('b', ['x', 'y z'])]
+    outputs = []
+    for split in [False, True]:
+        jobs = cls('python train.py', root_dir=str(tmpdir), backup=False, split_render=split, **kw)
+        _, job_paths = jobs.generate(grid, c=5)
+        outputs.append([pathtrees.Path(p).read_text() for p in job_paths])
+    assert outputs[0] == outputs[1]
+    assert len(set(outputs[1])) == 6
+
+    renderer = jobs.get_renderer()
+    assert 'header' in renderer.blocks and 'body' not in renderer.blocks
+    renderer(**jobs.options, job_id='x', args={}, paths=jobs.paths, command='a', cli=jobs.cli, params_args=None, grid=None)
+    assert renderer.blocks is not None
+
+    # templates that use job variables outside of blocks aren't split
+    renderer = BatchRenderer(slurmjobs.core.get_env(), '{{ job_id }}{% block a %}{{ x }}{% endblock %}')
+    assert renderer.blocks is None
+    assert renderer(job_id=1, x=2) == '12'
+
+
+@pytest.mark.parametrize("cls,kw", [
+    (slurmjobs.Slurm, {'modules': ['cuda11'], 'conda_env': 'myenv'}), 
+    (slurmjobs.Singularity, {'overlay': 'overlay.ext3', 'sif': 'cuda.sif'}),
+])
+@pytest.mark.parametrize("command,expected", [
+    ("printf '<%s>'", "<--b=y z>"),
+    # env prefixes and compound commands have to run entirely inside the prelude function
+    ("FOO='x y' printenv FOO && echo one > /dev/stderr; printf '<%s>'", "x y\n<--a=1>"),
+    ("echo piped | tr a-z A-Z; printf '<%s>'", "PIPED\n<--a=1>"),
+])
+def test_prelude(tmpdir, cls, kw, command, expected):
+    import subprocess
+    # fake the environment setup commands
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    for cmd, body in [('singularity', 'exec /bin/bash'), ('module', 'echo module "$@"'), ('conda', 'true')]:
+        with open(os.path.join(bindir, cmd), 'w') as f:
+            f.write(f'#!/bin/bash\n{body}\n')
+        os.chmod(os.path.join(bindir, cmd), 0o755)
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ['PATH'])
+
+    grid = [('a', [1, 2]), ('b', ['y z', 'it\'s "quoted"'])]
+    outputs = []
+    for prelude in [False, True]:
+        # (with a space in the batch directory)
+        jobs = cls(command, name='p', root_dir=os.path.join(tmpdir, f'{prelude} jobs'), backup=False, prelude=prelude, **kw)
+        _, job_paths = jobs.generate(grid)
+        outputs.append([
+            subprocess.run(['bash', p], env=env, capture_output=True, text=True, check=True).stdout
+            for p in job_paths])
+        if prelude:
+            common = jobs.paths.prelude.read_text()
+            assert 'module load' in common or 'singularity exec' in common
+            for p in job_paths:
+                content = pathtrees.Path(p).read_text()
+                assert 'module load' not in content and 'singularity exec' not in content
+                assert '#SBATCH --job-name=' in content and f". '{os.path.abspath(jobs.paths.prelude)}'" in content
+    assert outputs[0] == outputs[1]
+    assert expected in outputs[1][0]
+
+    # the shell template's command depends on the job
+    with pytest.raises(ValueError):
+        slurmjobs.Shell('python train.py', root_dir=str(tmpdir), backup=False, prelude=True).generate(a=[1])
+
+
+def test_archive(tmpdir):
+    import subprocess
+    from slurmjobs import archive
+    grid = [('a', [1, 2, 3]), ('b', ['x', 'y z'])]
+    files = slurmjobs.Slurm('python train.py', root_dir=os.path.join(tmpdir, 'files'), backup=False)
+    _, job_paths = files.generate(grid)
+    jobs = slurmjobs.Slurm('python train.py', root_dir=os.path.join(tmpdir, 'archive'), backup=False, archive=True)
+    run_script, job_ids = jobs.generate(grid)
+    expected = [pathtrees.Path(p).read_text().replace(files.root_dir, jobs.root_dir) for p in job_paths]
+
+    assert job_ids == [os.path.basename(p)[:-len('.sbatch')] for p in job_paths]
+    assert not jobs.paths.job.glob()
+    assert archive.job_ids(jobs.paths.archive.format()) == job_ids
+    for i, job_id in enumerate(job_ids):
+        assert archive.read_job(jobs.paths.archive.format(), i) == expected[i]
+        assert archive.read_job(jobs.paths.archive.format(), job_id) == expected[i]
+
+    # the run script pipes each job to sbatch
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    with open(os.path.join(bindir, 'sbatch'), 'w') as f:
+        f.write('#!/bin/bash\ncat >> "$SUBMITTED"\necho "--next--" >> "$SUBMITTED"\n')
+    os.chmod(os.path.join(bindir, 'sbatch'), 0o755)
+    submitted = os.path.join(tmpdir, 'submitted.txt')
+    subprocess.run(['bash', run_script], check=True, env=dict(
+        os.environ, PATH=bindir + os.pathsep + os.environ['PATH'], SUBMITTED=submitted))
+    assert open(submitted).read().split('--next--\n')[:-1] == expected
+
+
+def test_fanout(tmpdir):
+    import hashlib
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir), backup=False, fanout=2, params_file=True)
+    run_script, job_paths = jobs.generate([('a', list(range(20)))])
+    for p in job_paths:
+        job_id = os.path.basename(p)[:-len('.sbatch')]
+        h = hashlib.md5(job_id.encode()).hexdigest()
+        assert p == os.path.join(jobs.paths.batch_dir, h[:2], h[2:4], f'{job_id}.sbatch')
+        assert jobs.job_paths(job_id).job.format() == p
+        assert f'"{p}"' in jobs.paths.run.read_text()
+        assert os.path.isfile(jobs.job_paths(job_id).params.format())
+        # logs go in the same subdirectories
+        log_dir = os.path.join(jobs.paths.batch_dir, 'slurm', h[:2], h[2:4])
+        assert f'--output={log_dir}/slurm_%j__{job_id}.log' in pathtrees.Path(p).read_text()
+        assert os.path.isdir(log_dir)
+
+    assert sorted(jobs.paths.job.glob()) == sorted(job_paths)
+    assert len(jobs.paths.params.glob()) == 20
+    assert not [f for f in os.listdir(jobs.paths.batch_dir) if f.endswith('.sbatch')]
+
+    job_id = 'train,a-3'
+    log_dir = jobs.job_paths(job_id).output.parent
+    for i in [123, 456]:
+        (log_dir / f'slurm_{i}__{job_id}.log').write_text('')
+    assert [os.path.basename(p) for p in jobs.job_logs(job_id)] == [f'slurm_123__{job_id}.log', f'slurm_456__{job_id}.log']
+
+
+@pytest.mark.parametrize("split_render", [False, True])
+def test_render(tmpdir, split_render):
+    root = os.path.join(tmpdir, 'render')
+    jobs = slurmjobs.Slurm('python train.py', root_dir=root, backup=False, split_render=split_render)
+    grid = [('a', [1, 2]), ('b', ['x', 'y z'])]
+    rendered = list(jobs.render(grid, c=5))
+    # nothing is written
+    assert not os.path.exists(root)
+    assert [job_id for job_id, _, _ in rendered] == ['train,a-1,b-x', 'train,a-1,b-yz', 'train,a-2,b-x', 'train,a-2,b-yz']
+    assert rendered[1][2]['b'] == 'y z' and rendered[1][2]['c'] == 5
+
+    _, job_paths = jobs.generate(grid, c=5)
+    assert [script for _, script, _ in rendered] == [pathtrees.Path(p).read_text() for p in job_paths]
+
+    # the command lines are formatted a chunk at a time, the same as rendering each job on its own
+    calls = []
+    format_batch = jobs.cli.format_batch
+    jobs.cli.format_batch = lambda items, **kw: calls.append(len(items)) or format_batch(items, **kw)
+    jobs.format_chunk_size = 3
+    _, job_paths = jobs.generate(grid, c=5)
+    assert calls == [3, 1]
+    assert [script for _, script, _ in rendered] == [pathtrees.Path(p).read_text() for p in job_paths]
+    assert [jobs.render_job(job_id, args) for job_id, _, args in rendered] == [script for _, script, _ in rendered]
+
+
+def test_backup_on_generate(tmpdir):
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir))
+    jobs.generate([('a', [1, 2])])
+    batch_dir = str(jobs.paths.batch_dir)
+
+    # creating the jobs object doesn't touch the existing batch
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir))
+    list(jobs.render([('a', [1, 2])]))
+    assert os.listdir(tmpdir) == [os.path.basename(batch_dir)]
+    # but generating does (only once)
+    jobs.generate([('a', [1, 2])])
+    jobs.generate([('a', [3])])
+    assert sorted(os.listdir(tmpdir)) == ['.train.backups', 'train', 'train_01']
+    assert len(jobs.paths.job.glob()) == 3
+
+    # generating a single job backs up the old batch too
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir))
+    jobs.generate_job('train,a-4', a=4)
+    jobs.generate_job('train,a-5', a=5)
+    assert sorted(os.listdir(tmpdir)) == ['.train.backups', 'train', 'train_01', 'train_02']
+    assert sorted(os.path.basename(p) for p in jobs.paths.job.glob()) == ['train,a-4.sbatch', 'train,a-5.sbatch']
+
+
+def test_writer(tmpdir, monkeypatch):
+    import slurmjobs.writer
+    synced = []
+    monkeypatch.setattr(slurmjobs.writer, '_fsync', synced.append)
+    makedirs, _makedirs, depth = [], os.makedirs, [0]
+    def spy(p, **kw):  # (makedirs calls itself for the parent directories)
+        if not depth[0]:
+            makedirs.append(p)
+        depth[0] += 1
+        try:
+            return _makedirs(p, **kw)
+        finally:
+            depth[0] -= 1
+    monkeypatch.setattr(os, 'makedirs', spy)
+
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir), backup=False, fsync=True)
+    run_script, job_paths = jobs.generate([('a', list(range(10)))])
+    # each directory is only created once
+    assert len(makedirs) == len(set(makedirs))
+    # everything is fsynced at the end, along with the directories
+    assert set(job_paths) | {run_script.format()} <= set(synced)
+    assert str(jobs.paths.batch_dir) in synced
+    assert {'args', 'render', 'mkdir', 'write', 'fsync'} <= set(jobs.timings)
+    # no temp files left behind
+    assert not [f for f in os.listdir(jobs.paths.batch_dir) if '.tmp' in f]
+    assert os.access(run_script, os.X_OK)
+
+
+def test_writer_atomic(tmpdir):
+    from slurmjobs.writer import JobWriter
+    path = os.path.join(tmpdir, 'a', 'job.sh')
+    with JobWriter() as writer:
+        writer.write(path, 'old')
+        with pytest.raises(TypeError):
+            writer.write(path, None)
+    # a failed write leaves the old file
+    assert open(path).read() == 'old'
+    assert os.listdir(os.path.dirname(path)) == ['job.sh']
+
+    # same for files that are streamed
+    with JobWriter() as writer:
+        with pytest.raises(ValueError):
+            with writer.open(path, 'wb') as f:
+                f.write(b'partial')
+                raise ValueError
+    assert open(path).read() == 'old'
+    assert os.listdir(os.path.dirname(path)) == ['job.sh']
+
+
+def test_writer_sidecars(tmpdir, monkeypatch):
+    np = pytest.importorskip('numpy')
+    import slurmjobs.writer
+    synced = []
+    monkeypatch.setattr(slurmjobs.writer, '_fsync', synced.append)
+    makedirs, _makedirs = [], os.makedirs
+    monkeypatch.setattr(os, 'makedirs', lambda p, **kw: (makedirs.append(p), _makedirs(p, **kw))[1])
+
+    # params files, arrays, and archives go through the batch's writer too
+    jobs = slurmjobs.Slurm(
+        'python train.py', root_dir=str(tmpdir), backup=False, fsync=True, 
+        params_file=True, npy_threshold=10, archive=True)
+    jobs.generate([('a', list(range(10)))], w=np.arange(100))
+    archive = jobs.paths.archive.format()
+    expected = set(jobs.paths.params.glob()) | set(jobs.paths.array.glob()) | {
+        archive, f'{archive}.idx', f'{archive}.ids'}
+    assert len(expected) == 10 + 1 + 3
+    assert expected <= set(synced)
+    # each job's directory is only created once
+    assert len(makedirs) == len(set(makedirs))
+    assert not [f for _, _, fs in os.walk(tmpdir) for f in fs if '.tmp' in f]
+
+
+def test_backup_retention(tmpdir):
+    import time
+    # other batches whose names look like backups
+    for sibling in ['train_2024', 'train_05']:
+        slurmjobs.Slurm('python train.py', name=sibling, root_dir=str(tmpdir)).generate([('a', [0])])
+    for i in range(4):
+        slurmjobs.Slurm('python train.py', root_dir=str(tmpdir)).generate([('a', [i])])
+    backups = [os.path.join(tmpdir, f'train_{i:02}') for i in range(1, 4)]
+    for i, p in enumerate(backups):  # oldest first
+        os.utime(p, (time.time() - 1000 + i, time.time() - 1000 + i))
+    assert slurmjobs.util.find_backups(os.path.join(tmpdir, 'train')) == backups
+
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir), keep_backups=2, cleanup=False)
+    jobs.generate([('a', [5])])
+    assert sorted(os.listdir(tmpdir)) == ['.train.backups', 'train', 'train_03', 'train_04', 'train_05', 'train_2024']
+    assert slurmjobs.util.find_backups(jobs.paths.batch_dir)[0] == backups[2]
+
+    # remove old backups in a detached process
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir), max_backup_age=500, cleanup='process')
+    jobs.generate([('a', [6])])
+    for _ in range(50):
+        if sorted(os.listdir(tmpdir)) == ['.train.backups', 'train', 'train_01', 'train_04', 'train_05', 'train_2024']:
+            break
+        time.sleep(0.1)
+    assert sorted(os.listdir(tmpdir)) == ['.train.backups', 'train', 'train_01', 'train_04', 'train_05', 'train_2024']
+
+
+def test_remove_dirs_background(tmpdir):
+    paths = [os.path.join(tmpdir, f'batch{i}') for i in range(3)]
+    for p in paths:
+        os.makedirs(os.path.join(p, 'a', 'b'))
+    thread = slurmjobs.util.remove_dirs(paths + [os.path.join(tmpdir, 'missing')])
+    # they're moved out of the way immediately
+    assert not any(os.path.exists(p) for p in paths)
+    thread.join()
+    assert os.listdir(tmpdir) == []
+
+
+def test_status(tmpdir, monkeypatch):
+    import subprocess
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    with open(os.path.join(bindir, 'sbatch'), 'w') as f:  # prints the next job ID
+        f.write('#!/bin/bash\nn=$(( $(cat "$COUNTER" 2>/dev/null || echo 100) + 1 ))\necho $n > "$COUNTER"\necho "$n;cluster"\n')
+    with open(os.path.join(bindir, 'sacct'), 'w') as f:
+        f.write('#!/bin/bash\necho "$@" >> "$SACCT_CALLS"\ncat "$SACCT_OUT"\n')
+    for f in ['sbatch', 'sacct']:
+        os.chmod(os.path.join(bindir, f), 0o755)
+    calls, out = os.path.join(tmpdir, 'calls.txt'), os.path.join(tmpdir, 'sacct.txt')
+    monkeypatch.setenv('COUNTER', os.path.join(tmpdir, 'counter'))
+    monkeypatch.setenv('SACCT_CALLS', calls)
+    monkeypatch.setenv('SACCT_OUT', out)
+
+    jobs = slurmjobs.Slurm(
+        'python train.py', root_dir=str(tmpdir), backup=False, 
+        sacct_command=os.path.join(bindir, 'sacct'))
+    run_script, job_paths = jobs.generate([('a', [1, 2, 3, 4])])
+    os.remove(job_paths[-1])  # not generated
+    assert list(jobs.status().values()) == [
+        {'slurm_id': None, 'state': None, 'exit_code': None, 'elapsed': None, 'max_rss': None}] * 3
+    assert not os.path.exists(calls)
+
+    output = subprocess.run(['bash', run_script], check=True, capture_output=True, text=True, env=dict(
+        os.environ, PATH=bindir + os.pathsep + os.environ['PATH'])).stdout
+    assert 'Submitted batch job 101' in output
+
+    with open(out, 'w') as f:
+        f.write(
+            '101|COMPLETED|0:0|00:01:05|\n'
+            '101.batch|COMPLETED|0:0|00:01:05|1024K\n'
+            '101.0|COMPLETED|0:0|00:01:00|2M\n'
+            '102|RUNNING|0:0|1-00:00:01|\n')
+    status = jobs.status()
+    assert status['train,a-1'] == {
+        'slurm_id': '101', 'state': 'COMPLETED', 'exit_code': 0, 'elapsed': 65, 'max_rss': 2 << 20}
+    assert status['train,a-2']['state'] == 'RUNNING' and status['train,a-2']['elapsed'] == 86401
+    assert status['train,a-3']['state'] == 'SUBMITTED'
+    assert len(status) == 4  # the deleted job was still submitted
+
+    with open(out, 'w') as f:
+        f.write('102|FAILED|1:0|00:02:00|\n103|CANCELLED by 0|0:15|00:00:00|\n104|OUT_OF_MEMORY|0:125|00:00:10|\n')
+    status = jobs.status()
+    assert [s['state'] for s in status.values()] == ['COMPLETED', 'FAILED', 'CANCELLED', 'OUT_OF_MEMORY']
+    # finished jobs aren't polled again, and everything is cached
+    assert jobs.status() == jobs.status(refresh=False) == status
+    polls = open(calls).read().splitlines()
+    assert len(polls) == 2
+    assert '--jobs=101,102,103,104 ' in polls[0] + ' ' and '--jobs=102,103,104 ' in polls[1] + ' '
+    assert all('--starttime=' in p for p in polls)
+
+
+def test_resubmit(tmpdir, monkeypatch):
+    import subprocess
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    with open(os.path.join(bindir, 'sbatch'), 'w') as f:
+        f.write('#!/bin/bash\necho "$@" >> "$SBATCH_CALLS"\nn=$(( $(cat "$COUNTER" 2>/dev/null || echo 100) + 1 ))\necho $n > "$COUNTER"\necho $n\n')
+    with open(os.path.join(bindir, 'sacct'), 'w') as f:
+        f.write('#!/bin/bash\ncat "$SACCT_OUT"\n')
+    for f in ['sbatch', 'sacct']:
+        os.chmod(os.path.join(bindir, f), 0o755)
+    calls, out = os.path.join(tmpdir, 'calls.txt'), os.path.join(tmpdir, 'sacct.txt')
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('COUNTER', os.path.join(tmpdir, 'counter'))
+    monkeypatch.setenv('SBATCH_CALLS', calls)
+    monkeypatch.setenv('SACCT_OUT', out)
+
+    jobs = slurmjobs.Slurm(
+        'echo hi', name='hi', root_dir=str(tmpdir), backup=False, sbatch={'mem': '16GB', 'time': '1:00:00'})
+    run_script, job_paths = jobs.generate([('a', [1, 2, 3, 4, 5])])
+    subprocess.run(['bash', run_script], check=True, capture_output=True)
+    os.remove(calls)
+    with open(out, 'w') as f:
+        f.write(
+            '101|COMPLETED|0:0|00:01:00|\n102|OUT_OF_MEMORY|0:125|00:01:00|\n103|FAILED|1:0|00:01:00|\n'
+            '104|TIMEOUT|0:0|01:00:00|\n105|FAILED|1:0|00:01:00|\n')
+
+    assert jobs.resubmit(dry_run=True) == {
+        'hi,a-2': 'OUT_OF_MEMORY', 'hi,a-3': 'FAILED', 'hi,a-4': 'TIMEOUT', 'hi,a-5': 'FAILED'}
+    assert jobs.resubmit(states=(), done=lambda job_id: job_id != 'hi,a-1', dry_run=True) == {'hi,a-1': 'COMPLETED'}
+
+    submitted = jobs.resubmit(bump=True)
+    # one array per set of resources
+    assert submitted == {'hi,a-2': '106_0', 'hi,a-3': '107_0', 'hi,a-5': '107_1', 'hi,a-4': '108_0'}
+    sbatch_calls = open(calls).read().splitlines()
+    assert sbatch_calls[0].startswith('--parsable --mem=32GB --time=1:00:00 ')
+    assert sbatch_calls[1].startswith('--parsable --mem=16GB --time=1:00:00 ')
+    assert sbatch_calls[2].startswith('--parsable --mem=16GB --time=0-02:00:00 ')
+    assert {k: s['slurm_id'] for k, s in jobs.status(refresh=False).items()} == {
+        'hi,a-1': '101', **submitted}
+
+    # each task runs its job script and writes to its log
+    wrapper = sbatch_calls[1].split()[-1]
+    subprocess.run(['bash', wrapper], check=True, env=dict(os.environ, SLURM_ARRAY_JOB_ID='107', SLURM_ARRAY_TASK_ID='1'))
+    assert [pathtrees.Path(p).read_text().strip() for p in jobs.job_logs('hi,a-5')] == ['hi --a=5 --job_id=hi,a-5']
+
+    # or submit each job separately
+    with open(out, 'w') as f:
+        f.write('106_0|COMPLETED|0:0|00:01:00|\n107_0|FAILED|1:0|00:01:00|\n107_1|FAILED|1:0|00:01:00|\n108_0|RUNNING|0:0|00:01:00|\n')
+    assert jobs.resubmit(states=('FAILED',), array=False) == {'hi,a-3': '109', 'hi,a-5': '110'}
+    assert open(calls).read().splitlines()[-1] == f'--parsable --mem=16GB --time=1:00:00 {job_paths[4]}'
+
+    # arrays are split to stay under MaxArraySize, using the configured sbatch command
+    with open(out, 'w') as f:
+        f.write('109|FAILED|1:0|00:01:00|\n110|FAILED|1:0|00:01:00|\n')
+    calls2 = os.path.join(tmpdir, 'calls2.txt')
+    jobs.max_array_size = 1
+    jobs.sbatch_command = ['env', f'SBATCH_CALLS={calls2}', 'sbatch']
+    assert jobs.resubmit(states=('FAILED',)) == {'hi,a-3': '111_0', 'hi,a-5': '112_0'}
+    wrappers = [c.split()[-1] for c in open(calls2).read().splitlines()]
+    assert len(set(wrappers)) == 2 and all('--array=0-0' in open(w).read() for w in wrappers)
+
+
+def test_watch(tmpdir, monkeypatch):
+    import sys
+    import subprocess
+    from slurmjobs import status
+    s = lambda state: {'slurm_id': '1', 'state': state, 'exit_code': None, 'elapsed': None, 'max_rss': None}
+    polls = iter([
+        {'a': s('PENDING'), 'b': s('COMPLETED'), 'c': s(None)},
+        {'a': s('PENDING'), 'b': s('COMPLETED'), 'c': s(None)},
+        {'a': s('PENDING'), 'b': s('COMPLETED'), 'c': s(None)},
+        {'a': s('RUNNING'), 'b': s('COMPLETED'), 'c': s(None)},
+        {'a': s('RUNNING'), 'b': s('COMPLETED'), 'c': s(None)},
+        {'a': s('FAILED'), 'b': s('COMPLETED'), 'c': s(None)},
+    ])
+    events, sleeps = [], []
+    final = status.watch(
+        lambda: next(polls), interval=10, max_interval=25, sleep=sleeps.append,
+        on_change=lambda *a: events.append(('change', *a)),
+        on_start=lambda job_id, s: events.append(('start', job_id)),
+        on_fail=lambda job_id, s: events.append(('fail', job_id, s['state'])),
+        on_complete=lambda job_id, s: events.append(('complete', job_id)),
+        on_finish=lambda statuses: events.append(('finish', len(statuses))))
+    assert final['a']['state'] == 'FAILED'
+    # backs off when nothing changes
+    assert sleeps == [10, 20, 25, 10, 20]
+    assert events == [
+        ('change', 'a', None, 'PENDING'), ('change', 'b', None, 'COMPLETED'), ('complete', 'b'),
+        ('change', 'a', 'PENDING', 'RUNNING'), ('start', 'a'),
+        ('change', 'a', 'RUNNING', 'FAILED'), ('fail', 'a', 'FAILED'),
+        ('finish', 3)]
+
+    with pytest.raises(TimeoutError):
+        status.watch(lambda: {'a': s('RUNNING')}, interval=10, timeout=15, sleep=sleeps.append)
+
+    # from the command line
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir), backup=False)
+    jobs.generate([('a', [1, 2])])
+    status.write_submissions(jobs.paths.submissions.format(), {'train,a-1': '101', 'train,a-2': '102'})
+    sacct = os.path.join(tmpdir, 'sacct')
+    with open(sacct, 'w') as f:
+        f.write('#!/bin/bash\necho "101|COMPLETED|0:0|00:01:00|"\necho "102|TIMEOUT|0:0|00:01:00|"\n')
+    os.chmod(sacct, 0o755)
+    out = subprocess.run(
+        [sys.executable, '-m', 'slurmjobs', 'watch', str(jobs.paths.batch_dir), f'--sacct={sacct}'], 
+        check=True, capture_output=True, text=True, 
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(slurmjobs.__file__)))).stdout
+    assert 'train,a-2: None -> TIMEOUT' in out
+    assert out.strip().splitlines()[-1] == 'finished: 1 COMPLETED, 1 TIMEOUT'
+
+    # batches generated with fanout/archive (the settings are stored in the batch directory)
+    for kw in [{'fanout': 2}, {'archive': True}, {'fanout': 1, 'archive': True}]:
+        jobs = slurmjobs.Slurm('python train.py', name='fan', root_dir=str(tmpdir), backup=False, **kw)
+        jobs.generate([('a', [1, 2, 3])])
+        assert status.read_settings(str(jobs.paths.batch_dir)) == jobs.batch_settings()
+        status.write_submissions(jobs.paths.submissions.format(), {'fan,a-1': '101', 'fan,a-2': '102'})
+        out = subprocess.run(
+            [sys.executable, '-m', 'slurmjobs', 'watch', str(jobs.paths.batch_dir), f'--sacct={sacct}'], 
+            check=True, capture_output=True, text=True, 
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(slurmjobs.__file__)))).stdout
+        last = out.strip().splitlines()[-1]
+        assert last.startswith('finished: ')
+        assert set(last[len('finished: '):].split(', ')) == {'1 COMPLETED', '1 TIMEOUT', '1 not submitted'}
+
+
+def test_status_job_ids_cached(tmpdir, monkeypatch):
+    jobs = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir), backup=False, fanout=1)
+    jobs.generate([('a', [1, 2])])
+    globs = []
+    glob = type(jobs.paths.job).glob
+    monkeypatch.setattr(type(jobs.paths.job), 'glob', lambda self, *a, **kw: (globs.append(1), glob(self, *a, **kw))[1])
+
+    # the batch directory is only listed once between polls
+    watcher = slurmjobs.Slurm('python train.py', root_dir=str(tmpdir), backup=False, fanout=1)
+    for _ in range(3):
+        assert set(watcher.status()) == {'train,a-1', 'train,a-2'}
+    assert len(globs) == 1
+    # until it's generated again
+    jobs.generate([('a', [1, 2, 3])])
+    assert set(watcher.status()) == {'train,a-1', 'train,a-2', 'train,a-3'}
+
+def test_pipeline(tmpdir, monkeypatch):
+    import subprocess
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    with open(os.path.join(bindir, 'sbatch'), 'w') as f:
+        f.write('#!/bin/bash\necho "$@" >> "$SBATCH_CALLS"\nn=$(( $(cat "$COUNTER" 2>/dev/null || echo 100) + 1 ))\necho $n > "$COUNTER"\necho $n\n')
+    os.chmod(os.path.join(bindir, 'sbatch'), 0o755)
+    calls = os.path.join(tmpdir, 'calls.txt')
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('COUNTER', os.path.join(tmpdir, 'counter'))
+    monkeypatch.setenv('SBATCH_CALLS', calls)
+
+    root = os.path.join(tmpdir, 'jobs')
+    prep = slurmjobs.Slurm('python prep.py', root_dir=root, backup=False, dependency='singleton')
+    train = slurmjobs.Slurm('python train.py', root_dir=root, backup=False).after(prep, 'aftercorr')
+    evaluate = slurmjobs.Slurm('python evaluate.py', root_dir=root, backup=False).after(train, 'afterany')
+    plot = slurmjobs.Slurm('python plot.py', root_dir=root, backup=False, archive=True).after(
+        train, match=lambda job_id, args: {'x': 'train,a-2', 'y': ['train,a-1', 'train,a-2'], 'z': []}[args['b']])
+    prep.generate([('a', [1, 2])])
+    train.generate([('a', [1, 2])])
+    evaluate.generate()
+    plot.generate([('b', ['x', 'y', 'z'])])
+    with pytest.raises(ValueError):
+        slurmjobs.write_pipeline(os.path.join(tmpdir, 'submit.sh'), train, prep)
+    with pytest.raises(ValueError):
+        slurmjobs.Slurm('python x.py').after(prep, 'afterwards')
+
+    # nothing is submitted if the upstream batch hasn't been
+    r = subprocess.run(['bash', str(evaluate.paths.run)], capture_output=True, text=True)
+    assert "haven't been submitted" in r.stderr and not os.path.exists(calls)
+    # or only some of it was
+    from slurmjobs import status
+    status.write_submissions(train.paths.submissions.format(), {'train,a-1': '99'})
+    r = subprocess.run(['bash', str(evaluate.paths.run)], capture_output=True, text=True)
+    assert "haven't been submitted" in r.stderr and not os.path.exists(calls)
+    os.remove(train.paths.submissions.format())
+    # the upstream submission records are read once, not once per job
+    content = open(plot.paths.run).read()
+    assert content.count('read_submissions submitted_') == 1 and 'awk' not in content
+
+    script = slurmjobs.write_pipeline(os.path.join(tmpdir, 'submit.sh'), prep, train, evaluate, plot)
+    subprocess.run(['bash', script], check=True, capture_output=True)
+    sbatch = [' '.join(w for w in l.split()[1:] if not w.startswith('/')) for l in open(calls).read().splitlines()]
+    assert sbatch == [
+        '--dependency=singleton', '--dependency=singleton',  # prep: 101, 102
+        '--dependency=afterok:101', '--dependency=afterok:102',  # train: 103, 104
+        '--dependency=afterany:103:104',  # evaluate
+        '--dependency=afterok:104', '--dependency=afterok:103:104', '',  # plot
+    ]
+    assert evaluate.status(refresh=False)['evaluate']['slurm_id'] == '105'
+
+
+def test_sacct_chunks(tmpdir):
+    import sys
+    from slurmjobs import status
+    calls = os.path.join(tmpdir, 'calls.txt')
+    sacct = os.path.join(tmpdir, 'sacct.py')
+    with open(sacct, 'w') as f:
+        f.write(
+            'import sys\n'
+            'ids = [a for a in sys.argv if a.startswith("--jobs=")][0][len("--jobs="):].split(",")\n'
+            f'open({calls!r}, "a").write(f"{{len(ids)}}\\n")\n'
+            'print("\\n".join(f"{i}|COMPLETED|0:0|00:00:01|" for i in ids))\n')
+    ids = [str(10_000_000 + i) for i in range(20_000)]
+    jobs = status.run_sacct(ids, sacct=[sys.executable, sacct])
+    assert list(jobs) == ids and all(j['state'] == 'COMPLETED' for j in jobs.values())
+    assert open(calls).read().split() == ['2000'] * 10
@@ -0,0 +1,38 @@
+import os
+import sys
+import subprocess
+import pytest
+
+
+def _loaded_modules(code):
+    '''Run code in a fresh interpreter and get the modules that it imported.'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    out = subprocess.run(
+        [sys.executable, '-c', f'{code}\nimport sys; print(" ".join(sys.modules))'],
+        env=env, capture_output=True, text=True, check=True).stdout
+    return set(out.split())
+
+
+@pytest.mark.parametrize("code", [
+    'import slurmjobs',
+    'import slurmjobs.receipt',
+    'import slurmjobs.runtime',
+    'from slurmjobs import use_receipt, Receipt',
+])
+def test_lazy_imports(code):
+    modules = _loaded_modules(code)
+    for m in ['jinja2', 'pathtrees', 'slurmjobs.core', 'asyncio']:
+        assert m not in modules, f'{code!r} imported {m}'
+
+
+def test_lazy_attributes():
+    import slurmjobs
+    import slurmjobs.core
+    assert slurmjobs.Sing is slurmjobs.Singularity is slurmjobs.core.Singularity
+    assert slurmjobs.get_cli('fire').__class__.__name__ == 'FireArgument'
+    assert set(slurmjobs.__all__) <= set(dir(slurmjobs))
+    assert slurmjobs.core.env is slurmjobs.core.get_env()
+    assert slurmjobs.env is slurmjobs.core.get_env() and slurmjobs.loader is slurmjobs.env.loader
+    with pytest.raises(AttributeError):
+        slurmjobs.not_a_thing
+    assert 'jinja2' in _loaded_modules('import slurmjobs; slurmjobs.core.get_env()')
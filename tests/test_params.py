@@ -0,0 +1,120 @@
+import os
+import json
+import shlex
+import slurmjobs
+import slurmjobs.runtime
+import pathtrees
+import pytest
+
+
+class _Slurm(slurmjobs.Slurm):
+    def format_job_id(self, args, *a, **kw):
+        return super().format_job_id(args, *a, skip_positional=True, **kw)
+
+
+def _job_argv(job_path):
+    '''Get the arguments passed to the command in a job script.'''
+    content = pathtrees.Path(job_path).read_text()
+    command = content[content.index('\npython ') + 1:].split('\n\n')[0]
+    return shlex.split(command.replace('\\\n', ' '))[2:]
+
+
+@pytest.mark.parametrize("cli", ['fire', 'argparse', 'sacred', 'hydra'])
+@pytest.mark.parametrize("mode", ['file', 'table'])
+def test_params_file(tmpdir, cli, mode):
+    files = [f'file {i}.mp4' for i in range(100)]
+    grid = [
+        ('a', [1, 2]),
+        ('b', ['x', 'y z']),
+        (('chunk', '*'), ([0, 1], [files[:50], files[50:]])),
+    ]
+    inline = _Slurm(
+        'python train.py', cli=cli, root_dir=os.path.join(tmpdir, 'inline'), backup=False)
+    jobs = _Slurm(
+        'python train.py', cli=cli, root_dir=os.path.join(tmpdir, 'params'),
+        params_file=mode, backup=False)
+
+    _, inline_paths = inline.generate(grid, c={'x': [1, 2]})
+    _, job_paths = jobs.generate(grid, c={'x': [1, 2]})
+    assert len(job_paths) == len(inline_paths) == 8
+
+    for inline_path, job_path in zip(inline_paths, job_paths):
+        argv = _job_argv(job_path)
+        assert argv[0].startswith('--params-file=')
+        assert 'file 1.mp4' not in pathtrees.Path(job_path).read_text()
+
+        expected = _job_argv(inline_path)
+        assert slurmjobs.runtime.expand_argv(['train.py'] + argv) == ['train.py'] + expected
+
+        args, kwargs = slurmjobs.runtime.get_params(argv)
+        assert kwargs['b'] in ('x', 'y z')
+        assert args == files[:50] or args == files[50:]
+
+    if mode == 'table':
+        assert len(jobs.paths.params_table.read_text().splitlines()) == 8
+    else:
+        assert len(jobs.paths.params.glob()) == 8
+
+
+def test_npy_sidecar(tmpdir):
+    np = pytest.importorskip('numpy')
+    big = np.arange(5000, dtype=float)
+    small = np.arange(3)
+    jobs = slurmjobs.Slurm(
+        'python train.py', root_dir=os.path.join(tmpdir, 'npy'),
+        npy_threshold=100, backup=False)
+    _, job_paths = jobs.generate([
+        ('a', [1, 2]),
+        ('w', [big, big.copy(), big + 1]),
+    ], small=small, const=big)
+
+    # identical arrays are only written once
+    array_files = jobs.paths.array.glob()
+    assert len(array_files) == 2
+
+    content = pathtrees.Path(job_paths[0]).read_text()
+    assert '4999' not in content
+    argv = _job_argv(job_paths[0])
+    kw = dict(x[2:].split('=', 1) for x in argv)
+    assert kw['w'] == kw['const'] and kw['w'] in array_files
+    assert kw['small'] == '[0, 1, 2]'
+
+    w = slurmjobs.runtime.load_array(kw['w'])
+    assert isinstance(w, np.memmap)
+    assert np.array_equal(w, big)
+    assert np.array_equal(slurmjobs.runtime.load_array([0, 1, 2]), small)
+
+
+def test_param_table(tmpdir, monkeypatch):
+    jobs = slurmjobs.Slurm(
+        'python train.py', root_dir=os.path.join(tmpdir, 'table'),
+        params_file='table', backup=False)
+    _, job_paths = jobs.generate([('a', list(range(50))), ('b', ['x', 'y z'])])
+    path = jobs.paths.params_table.format()
+    assert os.path.isfile(slurmjobs.runtime.index_path(path))
+
+    rows = [json.loads(l) for l in open(path)]
+    with slurmjobs.runtime.ParamTable(path) as table:
+        assert len(table) == len(rows) == 100
+        assert [table[i] for i in range(len(table))] == rows
+        assert table[-1] == rows[-1]
+        with pytest.raises(IndexError):
+            table[100]
+
+    # the row index comes from the array task ID
+    with pytest.raises(ValueError):
+        slurmjobs.runtime.get_params([], path=path)
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '7')
+    args, kwargs = slurmjobs.runtime.get_params([], path=path)
+    assert kwargs == rows[7]['kwargs'] == {'a': 3, 'b': 'y z', 'job_id': 'train,a-3,b-yz'}
+    # but an explicit index takes precedence
+    assert slurmjobs.runtime.get_params([f'--params-file={path}', '--params-index=8'])[1] == rows[8]['kwargs']
+    assert slurmjobs.runtime.load_params(path, 9) == rows[9]
+
+    # generating a single job adds it to the batch's table
+    job_path = jobs.generate_job('extra', a=100)
+    with slurmjobs.runtime.ParamTable(path) as table:
+        assert len(table) == 101
+        assert table[9] == rows[9]
+        assert table[100]['kwargs'] == {'a': 100, 'job_id': 'extra'}
+    assert '--params-index=100' in open(job_path).read()
@@ -0,0 +1,427 @@
+import os
+import time
+import asyncio
+import threading
+import concurrent.futures
+import slurmjobs
+from slurmjobs.receipt import Receipt, FileReceiptStore, SQLiteReceiptStore
+import pytest
+
+
+def add(x, y=1):
+    return x + y
+
+
+@pytest.mark.parametrize("store", ['sqlite', 'file'])
+def test_receipt_store(tmpdir, store):
+    r = Receipt(add, 1, y=2, __dir__=tmpdir, __store__=store)
+    assert not r.exists
+    assert r.meta == {}
+    r.make(duration_secs=5)
+    assert r.exists
+    assert r.meta == {'duration_secs': 5}
+    r.clear()
+    assert not r.exists
+
+    # use_receipt with a specific store
+    calls = []
+    def func(x):
+        calls.append(x)
+    f = slurmjobs.use_receipt(func, receipt_dir=str(tmpdir), store=store)
+    f(1); f(1); f(2)
+    assert calls == [1, 2]
+
+    rs = [Receipt(func, x, __dir__=tmpdir, __store__=store) for x in range(4)]
+    assert r.store.bulk_exists([ri.id for ri in rs]) == {rs[1].id, rs[2].id}
+    assert set(r.store.bulk_read([ri.id for ri in rs])) == {rs[1].id, rs[2].id}
+    assert {name for _, name, _ in r.store.items()} == {'test_receipt_store.<locals>.func'}
+
+    if store == 'sqlite':
+        # no per-receipt files
+        assert set(os.listdir(tmpdir)) <= {'receipts.sqlite', 'receipts.sqlite-wal', 'receipts.sqlite-shm'}
+
+
+def test_migrate_receipts(tmpdir):
+    files = [Receipt(add, x, __dir__=tmpdir, __store__='file') for x in range(5)]
+    for r in files:
+        r.make(duration_secs=r.id[-3:])
+    
+    n = slurmjobs.receipt.migrate_receipts(str(tmpdir), remove=True)
+    assert n == 5
+    for r in files:
+        assert not r.exists
+        r2 = Receipt('add', receipt_id=r.id[len('add'):], __dir__=tmpdir, __store__='sqlite')
+        assert r2.id == r.id
+        assert r2.exists
+        assert r2.meta == {'duration_secs': r.id[-3:]}
+    assert {name for _, name, _ in r2.store.items()} == {'add'}
+
+
+def test_migrate_receipts_twice(tmpdir):
+    files = [Receipt(add, x, __dir__=tmpdir, __store__='file') for x in range(3)]
+    for r in files:
+        r.make()
+    assert slurmjobs.receipt.migrate_receipts(str(tmpdir)) == 3
+    # the sqlite database lives next to the receipt files, so it must not be imported (or removed)
+    assert {f for f in os.listdir(tmpdir) if f.startswith('receipts.sqlite')} >= {'receipts.sqlite'}
+    assert slurmjobs.receipt.migrate_receipts(str(tmpdir), remove=True) == 3
+    assert slurmjobs.receipt.migrate_receipts(str(tmpdir), remove=True) == 0
+    # the file store can't be migrated into itself
+    with pytest.raises(ValueError):
+        slurmjobs.receipt.migrate_receipts(str(tmpdir), store='file', remove=True)
+    assert os.path.isfile(os.path.join(tmpdir, 'receipts.sqlite'))
+    for r in files:
+        assert Receipt('add', receipt_id=r.id[len('add'):], __dir__=tmpdir, __store__='sqlite').exists
+
+
+def test_receipt_default_store(tmpdir):
+    # one file per receipt, which works across nodes on a network filesystem
+    r = Receipt(add, 1, __dir__=tmpdir)
+    assert isinstance(r.store, FileReceiptStore)
+    r.make()
+    assert os.listdir(tmpdir) == [r.id]
+
+
+def test_legacy_receipts(tmpdir):
+    # receipts made before the hash changed are picked up and copied to the new ID
+    old = Receipt(add, 1, y=2, __dir__=tmpdir)
+    old_id = 'add' + old.legacy_hash_args(1, y=2)
+    old.store.write(old_id, {'duration_secs': 5}, name='add')
+    r = Receipt(add, 1, y=2, __dir__=tmpdir)
+    assert r.id != old_id
+    assert r.exists and r.meta == {'duration_secs': 5}
+    assert r.store.exists(r.id)
+    assert not Receipt(add, 2, y=2, __dir__=tmpdir).exists
+
+    old.store.write('add' + old.legacy_hash_args(3), {}, name='add')
+    status = Receipt.bulk_status([((1,), {'y': 2}), ((3,), {}), ((4,), {})], add, __dir__=tmpdir)
+    assert [s['done'] for s in status] == [True, True, False]
+    assert Receipt(add, 3, __dir__=tmpdir).store.exists(status[1]['id'])
+
+
+class _Thing:
+    def __init__(self, x):
+        self.x = x
+
+class _Hashable:
+    def __init__(self, x):
+        self.x = x
+        self.cache = object()
+    def __receipt_hash__(self):
+        return {'x': self.x}
+
+class _SlottedBase:
+    __slots__ = ('__y',)
+
+class _Slotted(_SlottedBase):
+    __slots__ = 'x'
+    def __init__(self, *x):
+        if x:
+            self.x, = x
+        self._SlottedBase__y = 5
+
+
+def test_structural_hash():
+    H = slurmjobs.receipt.StructuralHasher.hexdigest
+    # dict order doesn't matter
+    assert H({'a': 1, 'b': [1, 2]}) == H({'b': [1, 2], 'a': 1})
+    # types matter
+    values = [1, 1.0, True, '1', b'1', [1], (1,), {1}, None, 0, '', [], ()]
+    assert len({H(v) for v in values}) == len(values)
+    assert H(('ab', 'c')) != H(('a', 'bc'))
+    # objects without a repr use their attributes, not their address
+    assert H(_Thing(1)) == H(_Thing(1)) != H(_Thing(2))
+    assert H(_Hashable(1)) == H(_Hashable(1)) != H(_Hashable(2))
+    # or their slots
+    assert H(_Slotted(1)) == H(_Slotted(1)) != H(_Slotted(2))
+    assert H(_Slotted(None)) != H(_Slotted())
+    with pytest.raises(TypeError):
+        H(object())
+    # objects that contain themselves
+    a, b, d = [1], [1], {'x': 1}
+    a.append(a); b.append([1, b]); d['self'] = d
+    assert H(a) == H(a) != H(b)
+    assert H(d) != H({'x': 1, 'self': {'x': 1}})
+
+    # receipt IDs are stable between processes
+    r = Receipt(add, _Thing(5), y={'a': 1, 'b': 2})
+    import subprocess, sys
+    code = (
+        f'import slurmjobs, {_Thing.__module__} as t;'
+        'print(slurmjobs.Receipt(t.add, t._Thing(5), y={"b": 2, "a": 1}).id)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=root,
+        env=dict(os.environ, PYTHONHASHSEED='123', PYTHONPATH=os.pathsep.join(sys.path)))
+    assert out.stdout.strip() == r.id
+
+
+def test_structural_hash_numpy():
+    np = pytest.importorskip('numpy')
+    H = slurmjobs.receipt.StructuralHasher.hexdigest
+    x = np.arange(100000, dtype=np.float32).reshape(100, 1000)
+    assert H(x) == H(x.copy()) == H(np.asfortranarray(x))
+    assert H(x) != H(x.astype(np.float64)) != H(x.reshape(1000, 100))
+    assert H(np.float64(1.5)) == H(1.5)
+    assert H(np.array(['a', None], dtype=object)) == H(np.array(['a', None], dtype=object))
+
+
+def test_result_cache(tmpdir):
+    calls = []
+    def compute(x):
+        calls.append(x)
+        return {'x': x, 'data': 'a' * 1000}
+
+    f = slurmjobs.use_receipt(compute, receipt_dir=str(tmpdir), cache_result=True)
+    assert f(1) == f(1) == {'x': 1, 'data': 'a' * 1000}
+    assert calls == [1]
+
+    # without caching, skipped steps return None
+    assert slurmjobs.use_receipt(compute, receipt_dir=str(tmpdir))(1) is None
+
+    # evicted results are recomputed
+    cache = slurmjobs.receipt.ResultCache(os.path.join(tmpdir, 'results'))
+    assert len(cache.gc(ttl=0)) == 1
+    assert f(1)['x'] == 1
+    assert calls == [1, 1]
+
+    # size-based eviction removes the least recently used results
+    rid = lambda x: Receipt(compute, x, __dir__=tmpdir).id
+    f = slurmjobs.use_receipt(compute, receipt_dir=str(tmpdir), cache_result=True, max_cache_bytes='2.7KB')
+    os.utime(cache._find(rid(1)), (0, 0))
+    f(2)
+    os.utime(cache._find(rid(2)), (1, 1))
+    f(1)  # loading bumps it to the most recently used
+    f(3)
+    assert cache.has(rid(1)) and not cache.has(rid(2)) and cache.has(rid(3))
+    assert calls == [1, 1, 2, 3]
+
+    slurmjobs.receipt.ReceiptCLI(str(tmpdir)).gc(max_bytes=0)
+    assert cache.gc() == [] and not os.listdir(cache.root)
+
+
+def test_result_cache_gc_threshold(tmpdir, monkeypatch):
+    cache = slurmjobs.receipt.ResultCache(str(tmpdir), max_bytes='10KB', ttl='1d')
+    scans = []
+    gc = cache.gc
+    monkeypatch.setattr(cache, 'gc', lambda **kw: scans.append(1) or gc(**kw))
+    for i in range(50):
+        cache.save(f'r{i}', b'a' * 100)
+    # one scan to get the cache size, then only when it goes over max_bytes
+    assert len(scans) == 1
+    for i in range(50, 100):
+        cache.save(f'r{i}', b'a' * 100)
+    assert 2 <= len(scans) < 10
+    assert sum(os.path.getsize(os.path.join(tmpdir, f)) for f in os.listdir(tmpdir)) <= 10 * 1024
+
+    # threads saving the same result don't clobber each other's temp files
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: cache.save('same', list(range(1000))), range(32)))
+    assert cache.load('same') == list(range(1000))
+    assert not [f for f in os.listdir(tmpdir) if f.endswith('.tmp')]
+
+
+def test_result_cache_numpy(tmpdir):
+    np = pytest.importorskip('numpy')
+    f = slurmjobs.use_receipt(np.arange, receipt_dir=str(tmpdir), cache_result=True)
+    x = f(10)
+    y = f(10)
+    assert isinstance(y, np.memmap)
+    assert np.array_equal(x, y)
+
+
+@pytest.mark.parametrize("store", ['sqlite', 'file'])
+def test_receipt_lease(tmpdir, store):
+    r = Receipt(add, 1, __dir__=tmpdir, __store__=store)
+    a, b = r.lease(ttl=0.5, heartbeat=10), r.lease(ttl=0.5, heartbeat=10)
+    assert a.acquire()
+    assert not b.acquire()
+    a.release()
+    assert b.acquire()
+    # a killed process stops renewing and its lease expires
+    b._stop.set(); b._thread.join()
+    assert not a.acquire()
+    time.sleep(0.6)
+    assert a.acquire()
+    a.release()
+
+
+def test_file_lease_takeover(tmpdir, monkeypatch):
+    store = FileReceiptStore(str(tmpdir))
+    assert store.claim('x', 'dead', ttl=1)
+    fname = store._lease_file('x')
+    os.utime(fname, (time.time() - 10, time.time() - 10))
+
+    # another process takes over the stale lease after we've seen it but before we take it over
+    real_stat, raced = os.stat, []
+    def racing_stat(path, *a, **kw):
+        st = real_stat(path, *a, **kw)
+        if not raced and path == fname:
+            raced.append(None)
+            raced[0] = store.claim('x', 'other', ttl=1)
+        return st
+    monkeypatch.setattr(os, 'stat', racing_stat)
+    assert not store.claim('x', 'me', ttl=1)
+    assert raced == [True]
+    assert store._lease_owner(fname) == 'other'
+    assert os.listdir(str(tmpdir)) == ['.x.lease']
+
+
+@pytest.mark.parametrize("store", ['sqlite', 'file'])
+def test_receipt_lease_concurrent(tmpdir, store):
+    calls = []
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.3)
+        return x * 2
+    f = slurmjobs.use_receipt(
+        slow, receipt_dir=str(tmpdir), store=store, cache_result=True, 
+        lease=True, poll_interval=0.05)
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(f, [1] * 8))
+    assert calls == [1]
+    assert results == [2] * 8
+
+    # don't wait for the other process
+    f = slurmjobs.use_receipt(slow, receipt_dir=str(tmpdir), store=store, lease=True, wait=False)
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(f, [5] * 4))
+    assert calls.count(5) == 1
+    assert sorted(results, key=str) == [10] + [None] * 3
+
+
+@pytest.mark.parametrize("store", ['sqlite', 'file'])
+def test_bulk_status(tmpdir, store):
+    f = slurmjobs.use_receipt(add, receipt_dir=str(tmpdir), store=store)
+    items = [{'x': x, 'y': y} for x in range(10) for y in range(3)]
+    for kw in items[::4]:
+        f(**kw)
+
+    status = f.status(items)
+    assert [s['item'] for s in status] == items
+    assert [s['done'] for s in status] == [i % 4 == 0 for i in range(len(items))]
+    for s in status:
+        r = Receipt(add, **s['item'], __dir__=tmpdir, __store__=store)
+        assert s['id'] == r.id and s['done'] == r.exists
+        assert ('duration_secs' in s['meta']) == s['done']
+    assert f.pending(items) == [kw for i, kw in enumerate(items) if i % 4]
+
+    # positional args, grid items, and custom receipt IDs
+    f(5)
+    Receipt('add', receipt_id='custom', __dir__=tmpdir, __store__=store).make()
+    grid = list(slurmjobs.Grid([('y', [1, 2])]))
+    status = Receipt.bulk_status(
+        [((5,), {}), ((6,), {}), {'receipt_id': 'custom'}] + grid, 'add', tmpdir, store)
+    assert [s['done'] for s in status] == [True, False, True, False, False]
+
+
+def test_async_receipt(tmpdir):
+    calls = []
+    async def fetch(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * 2
+    f = slurmjobs.use_receipt(fetch, receipt_dir=str(tmpdir), cache_result=True)
+    assert asyncio.iscoroutinefunction(f)
+    assert asyncio.run(f(1)) == 2
+    assert asyncio.run(f(1)) == 2
+    assert calls == [1]
+
+    async def fail(x):
+        raise ValueError(x)
+    g = slurmjobs.use_receipt(fail, receipt_dir=str(tmpdir))
+    with pytest.raises(ValueError):
+        asyncio.run(g(1))
+    assert not Receipt(fail, 1, __dir__=tmpdir).exists
+
+
+def test_run_steps(tmpdir):
+    from slurmjobs.receipt import Step, run_steps
+    lock = threading.Lock()
+    log = []
+    active = [0, 0]  # current, max
+    def download(x):
+        with lock:
+            log.append(('download', x))
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return x
+    async def merge(*xs):
+        log.append(('merge', xs))
+        return sum(xs)
+
+    downloads = [Step(download, x) for x in range(6)]
+    merged = Step(merge, *range(6), after=downloads)
+    assert run_steps([merged], max_workers=3, receipt_dir=str(tmpdir), cache_result=True) == [15]
+    assert log[-1] == ('merge', tuple(range(6)))
+    assert sorted(log[:-1]) == [('download', x) for x in range(6)]
+    assert 1 < active[1] <= 3
+
+    # existing receipts are skipped
+    log.clear()
+    downloads = [Step(download, x) for x in range(8)]
+    merged = Step(merge, 1, after=downloads)
+    assert run_steps(downloads + [merged], receipt_dir=str(tmpdir), cache_result=True) == list(range(8)) + [1]
+    assert sorted(log[:-1]) == [('download', 6), ('download', 7)]
+
+    # failed steps stop their dependents
+    def fail():
+        raise ValueError()
+    bad = Step(fail)
+    with pytest.raises(ValueError):
+        run_steps([Step(merge, 2, after=bad), Step(download, 10)], receipt_dir=str(tmpdir))
+    assert ('download', 10) in log and ('merge', (2,)) not in log
+
+    a = Step(download, 20)
+    b = Step(download, 21, after=a)
+    a.after.append(b)
+    with pytest.raises(ValueError):
+        run_steps([a, b], receipt_dir=str(tmpdir))
+
+
+def test_receipt_stats(tmpdir, capsys):
+    from slurmjobs.receipt import receipt_stats, ReceiptCLI
+    now = 1_000_000
+    for i in range(1, 101):
+        # 100 steps that took 1-100 seconds, finishing one every 10 seconds
+        Receipt('train', i, __dir__=tmpdir).make(duration_secs=i, time=now + 10 * i)
+    Receipt('eval', 1, __dir__=tmpdir).make(duration_secs=4, time=now)
+
+    stats = receipt_stats(str(tmpdir), remaining={'train': 50})
+    train = stats['train']
+    assert train['count'] == 100
+    assert train['p50'] == pytest.approx(50.5)
+    assert train['p95'] == pytest.approx(95.05)
+    assert train['max'] == 100
+    assert train['total'] == sum(range(1, 101))
+    # window: first start (now + 10 - 1) to last finish (now + 1000)
+    assert train['throughput'] == pytest.approx(100 / 991)
+    assert train['eta_secs'] == pytest.approx(50 * 991 / 100)
+    assert stats['eval']['eta_secs'] == 0
+    assert stats['eval']['throughput'] == pytest.approx(1 / 4)
+    assert set(receipt_stats(str(tmpdir), names='eval')) == {'eval'}
+
+    ReceiptCLI(str(tmpdir)).stats(remaining=50)
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].split() == ['name', 'count', 'p50', 'p95', 'max', 'per', 'hour', 'remaining', 'eta']
+    assert out[2].split()[:2] == ['train', '100']
+
+
+def test_receipt_logging(tmpdir, caplog):
+    f = slurmjobs.use_receipt(add, receipt_dir=str(tmpdir))
+    with caplog.at_level('INFO', logger='slurmjobs.receipt'):
+        f(1); f(1)
+    assert [r.levelname for r in caplog.records] == ['INFO', 'INFO']
+    assert 'Receipt written' in caplog.records[0].message
+    assert 'Skipping' in caplog.records[1].message
+
+    # test runs aren't computed, so they're shown even without logging configured
+    caplog.clear()
+    with caplog.at_level('WARNING', logger='slurmjobs.receipt'):
+        assert slurmjobs.use_receipt(add, receipt_dir=str(tmpdir), test=True)(5) is None
+    assert [r.levelname for r in caplog.records] == ['WARNING']
+    assert 'Test run of add' in caplog.records[0].message
+    assert not Receipt(add, 5, __dir__=tmpdir).exists